@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from metrics import ADMISSION_WAIT
+
+READ_METHODS = ('GET', 'HEAD')
+# Never queued or shed: health checks and metrics must answer under load.
+EXEMPT_ENDPOINTS = ('health', 'metrics', 'static')
+# Long-running responses that hold their thread until they finish: change streams for minutes while mostly
+# sleeping, and exports for the whole download. They get their own class, so they can't take the threads
+# of ordinary reads.
+STREAM_ENDPOINTS = ('stream_changes', 'export_teams', 'export_players')
+MAX_SUBJECTS = 10000
+
+
+# A priority class of requests with its own concurrency limit and bounded wait queue.
+# A request runs when fewer than limit requests of its class are running. Otherwise it waits, as long as
+# fewer than queue_size are already waiting, for at most queue_timeout seconds. Requests that can't queue or
+# time out are shed.
+class AdmissionClass:
+    def __init__(self, name, limit, queue_size, queue_timeout, retry_after=None, clock=time.monotonic):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # Seconds a shed client is told to wait; defaults to the queue timeout.
+        self.retry_after = retry_after or max(1, math.ceil(queue_timeout))
+        self.clock = clock
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self._condition = threading.Condition()
+
+    # Returns True once the request may run, or False when it is shed.
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.shed_queue_full += 1
+                return False
+
+            deadline = self.clock() + self.queue_timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        self.shed_timeout += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'queued': self.waiting,
+                'admitted': self.admitted,
+                'shed_queue_full': self.shed_queue_full,
+                'shed_timeout': self.shed_timeout,
+                'shed': self.shed_queue_full + self.shed_timeout,
+            }
+
+
+# Default limits for a worker with the given threads, as a {class name: limit} dict. Every thread is
+# budgeted: streams and exports get an eighth and writes a quarter, at least one each, two threads are kept
+# for the read and write queues, and reads get the rest. So with 8 threads, 1 stream, 2 writes and 3 reads
+# run at once and one read and one write can wait.
+def default_limits(threads):
+    stream = max(threads // 8, 1)
+    write = max(threads // 4, 1)
+    return {'stream': stream, 'read': max(threads - stream - write - 2, 1), 'write': write}
+
+
+# How many requests can wait in all queues together. A waiting request holds a gunicorn thread, so only the
+# threads the limits leave over can wait.
+def max_queue(threads, limits):
+    return max(threads - sum(limits.values()), 0)
+
+
+# Admission control for one worker. STREAM_ENDPOINTS go through the 'stream' class, other GET and HEAD
+# requests through 'read' and every other method through 'write', so a burst of slow writes or long
+# downloads can't take the threads that cheap reads need, and the other way round. Shed requests get a 503
+# with Retry-After right away instead of piling up until gunicorn's timeout. The limits and queues together
+# have to stay within the worker's thread count, see default_limits() and max_queue().
+class AdmissionController:
+    def __init__(self, read, write, stream):
+        self.classes = {'read': read, 'write': write, 'stream': stream}
+
+    def class_for(self, endpoint, method):
+        if endpoint in STREAM_ENDPOINTS:
+            return self.classes['stream']
+        return self.classes['read' if method in READ_METHODS else 'write']
+
+    def init_app(self, app):
+        @app.before_request
+        def admit():
+            if request.endpoint in EXEMPT_ENDPOINTS or request.method == 'OPTIONS':
+                return
+            admission_class = self.class_for(request.endpoint, request.method)
+            start = time.perf_counter()
+            admitted = admission_class.acquire()
+            ADMISSION_WAIT.observe(time.perf_counter() - start, admission_class.name)
+            if not admitted:
+                raise ServiceUnavailable(retry_after=admission_class.retry_after)
+            g.admission_class = admission_class
+
+        # Runs after streamed responses have finished too, so exports hold their slot while they stream.
+        @app.teardown_request
+        def release(exc):
+            admission_class = g.pop('admission_class', None)
+            if admission_class is not None:
+                admission_class.release()
+
+    def stats(self):
+        stats = {}
+        for name, admission_class in self.classes.items():
+            stats.update({'{}_{}'.format(name, key): value for key, value in admission_class.stats().items()})
+        return stats
+
+
+# Token-bucket rate limits per token subject (the JWT 'sub'), checked by requires_auth() once the token is
+# decoded. Each subject may send burst requests at once and per_minute requests a minute on average.
+# per_minute=0 turns it off.
+class SubjectRateLimiter:
+    def __init__(self, per_minute=0, burst=20, clock=time.monotonic):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.clock = clock
+
+        self.buckets = {}
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    # Raises TooManyRequests (429) with Retry-After when the subject has no request left.
+    def check(self, subject):
+        if not self.per_minute:
+            return
+        rate = self.per_minute / 60
+        now = self.clock()
+        with self._lock:
+            if len(self.buckets) >= MAX_SUBJECTS and subject not in self.buckets:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                                if bucket[0] + (now - bucket[1]) * rate < self.burst}
+            tokens, updated = self.buckets.get(subject, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self.buckets[subject] = (tokens, now)
+                self.limited += 1
+                raise TooManyRequests(retry_after=max(1, math.ceil((1 - tokens) / rate)))
+            self.buckets[subject] = (tokens - 1, now)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'per_minute': self.per_minute,
+                'subjects': len(self.buckets),
+                'limited': self.limited,
+            }
+
+
+# Configured from RATE_LIMIT_PER_MINUTE and RATE_LIMIT_BURST when the app is created.
+rate_limiter = SubjectRateLimiter()
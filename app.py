@@ -1,62 +1,508 @@
-from flask import Flask, request, abort, jsonify
+import io
+import json
+import os
+import time
+from datetime import timedelta, timezone
+from functools import wraps
+
+import click
+from flask import Flask, Response, g, request, abort, jsonify, make_response, stream_with_context
 from flask_cors import CORS
+from sqlalchemy import insert, or_, tuple_, update
+from sqlalchemy.exc import SQLAlchemyError
+
+import models
+from admission import AdmissionClass, AdmissionController, default_limits, max_queue, rate_limiter
+from auth import AuthError, check_permissions, configure_auth, requires_auth, jwks_store, token_cache
+from batch import MAX_BATCH_SIZE, run_batch
+from change_log import ChangeFeed, ChangesCompacted, changes_since, compact_changes, compacted_through, latest_change_id
+from compression import Compressor
+from idempotency import idempotency, store_from_setting
+from config import engine_options, env_int, gunicorn_threads, pool_status
+from metrics import init_metrics, register_stats
+from models import db, setup_db, migrate_db, bump_versions, current_versions, record_changes, replica_engines, database_engines, Team, Player
+from league_import import LeagueImporter, read_rows, reject_writer
+from league_stats import league_stats
+from replicas import PIN_HEADER, ReplicaRouter
+from serializers import (json_response, player_dicts, player_long, player_query, team_dicts, PLAYER_FIELDS,
+                         PLAYER_SHORT_FIELDS, TEAM_FIELDS)
+from slow_queries import SlowQueryLog
+from response_cache import response_cache, add_tags, backend_from_url, invalidate_after_commit, player_row_tags, team_tag
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+MAX_BULK_SIZE = 10000
+MAX_IMPORT_REJECTS = 1000
+
+# Reads an optional integer query parameter, rejecting malformed values with a 400.
+def int_arg(name, default=None, minimum=None, maximum=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        abort(400)
+    return value
+
+# Reads the comma-separated 'fields' query parameter of a sparse fieldset, rejecting fields that aren't in
+# allowed with a 400. Returns the fields in allowed's order, or default (all of allowed) when it is absent.
+def fields_arg(allowed, default=None):
+    value = request.args.get('fields')
+    if value is None or value == '':
+        return default or allowed
+    fields = {field.strip() for field in value.split(',')}
+    if not fields <= set(allowed):
+        abort(400)
+    return tuple(field for field in allowed if field in fields)
+
+# Applies keyset pagination on id from the 'limit' and 'after' query parameters.
+# Returns the rows of the page and the cursor of the next page, or None on the last page.
+def paginate(query, model):
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+    after = int_arg('after')
+
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+# Applies keyset pagination in (height_inches, id) order for sort=height. The 'after' cursor is
+# '<height_inches>:<id>' of the last player of the previous page.
+def paginate_by_height(query):
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+    after = request.args.get('after')
+
+    if after:
+        try:
+            inches, player_id = (int(part) for part in after.split(':'))
+        except ValueError:
+            abort(400)
+        query = query.filter(tuple_(Player.height_inches, Player.id) > (inches, player_id))
+    rows = query.add_columns(Player.height_inches).filter(Player.height_inches.isnot(None)) \
+        .order_by(Player.height_inches, Player.id).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, '{}:{}'.format(rows[-1].height_inches, rows[-1].id)
+    return rows, None
+
+# Streams the rows of a column query as newline-delimited JSON objects keyed by fields, one chunk per batch.
+# The query is read with yield_per, which uses a server-side cursor on PostgreSQL, so memory stays flat.
+def ndjson_response(query, fields):
+    def generate():
+        lines = []
+        for row in query.yield_per(EXPORT_BATCH_SIZE):
+            lines.append(json.dumps(dict(zip(fields, row)), separators=(',', ':')))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# SQLite hands back naive datetimes; they are stored in UTC.
+def as_utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+# Adds ETag and Last-Modified headers to a read endpoint and answers If-None-Match / If-Modified-Since
+# with a 304 before the route runs, so unchanged data is never loaded or serialized.
+# The validators come from the version counters of the given scopes (see models.DataVersion), so any
+# write to those tables changes them. Apply it below @requires_auth so permissions are checked first.
+def conditional(*scopes):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = current_versions(*scopes)
+            g.data_versions = versions
+            etag = '-'.join('{}{}'.format(scope[0], versions[scope][0]) for scope in scopes if scope in versions)
+            last_modified = None
+            if versions:
+                last_modified = max(as_utc(updated_at) for version, updated_at in versions.values()).replace(microsecond=0)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = last_modified is not None and since is not None and last_modified <= as_utc(since)
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return conditional_decorator
+
+def is_text(value):
+    return isinstance(value, str) and value.strip() != ''
+
+# Returns a team's name and its roster as Player.long() dicts, from one joined column query,
+# or None if the team does not exist.
+def team_roster(team_id):
+    rows = db.session.query(Team.name, Player.id, Player.name, Player.position, Player.height) \
+        .outerjoin(Player, Player.team_id == Team.id).filter(Team.id == team_id).order_by(Player.id).all()
+    if not rows:
+        return None
+    team_name = rows[0][0]
+    return team_name, [
+        player_long(player_id, name, position, height, team_name)
+        for _, player_id, name, position, height in rows if player_id is not None
+    ]
+
+# Reads the array of a bulk request body, given either as a bare list or as {key: [...]}.
+def bulk_items(key):
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get(key)
+    if not isinstance(body, list) or not body or len(body) > MAX_BULK_SIZE:
+        abort(422)
+    return body
 
-from auth import AuthError, requires_auth
-from models import setup_db, Team, Player
+# Validates every team of a bulk request, checking names against each other and the teams table in one query.
+# Returns the rows to insert and a list of {'index', 'message'} errors.
+def validate_teams(items):
+    rows, errors, seen = [], [], set()
+    names = [item.get('name') for item in items if isinstance(item, dict) and is_text(item.get('name'))]
+    existing = {name for (name,) in db.session.query(Team.name).filter(Team.name.in_(names))}
+
+    for index, item in enumerate(items):
+        name = item.get('name') if isinstance(item, dict) else None
+        if not is_text(name):
+            errors.append({'index': index, 'message': 'name is required'})
+        elif name in existing or name in seen:
+            errors.append({'index': index, 'message': 'team name already exists'})
+        else:
+            seen.add(name)
+            rows.append({'name': name})
+    return rows, errors
+
+# Validates every player of a bulk request, resolving all referenced teams in one query.
+# Returns the rows to insert, a map of team id to team name, and a list of {'index', 'message'} errors.
+def validate_players(items):
+    rows, errors = [], []
+    team_ids = {item.get('team_id') for item in items if isinstance(item, dict) and type(item.get('team_id')) is int}
+    team_names = dict(db.session.query(Team.id, Team.name).filter(Team.id.in_(team_ids)))
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'message': 'player must be an object'})
+            continue
+        missing = [field for field in ('name', 'position', 'height') if not is_text(item.get(field))]
+        team_id = item.get('team_id')
+        if missing:
+            errors.append({'index': index, 'message': '{} is required'.format(', '.join(missing))})
+        elif team_id is not None and (type(team_id) is not int or team_id not in team_names):
+            errors.append({'index': index, 'message': 'team does not exist'})
+        else:
+            rows.append({
+                'name': item['name'],
+                'position': item['position'],
+                'height': item['height'],
+                'team_id': team_id,
+            })
+    return rows, team_names, errors
+
+# The 422 response of a bulk request that failed validation.
+def bulk_errors(errors, start):
+    return jsonify(
+        {
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+        }
+    ), 422
 
 # This creates and configures the app.
 def create_app(test_config=None):
     app = Flask(__name__)
 
+    # Configuration is read here rather than at import, so importing the app is cheap and needs no
+    # environment. Nothing in create_app connects to the database.
+    configure_auth()
+
     if test_config is None:
-        setup_db(app)
+        database_path = models.database_path or os.environ.get('DATABASE_URL')
+        if not database_path:
+            raise RuntimeError('missing environment variable: DATABASE_URL')
+        replica_paths = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
     else:
         database_path = test_config.get('SQLALCHEMY_DATABASE_URI')
-        setup_db(app, database_path=database_path, test=True)
+        replica_paths = test_config.get('SQLALCHEMY_REPLICA_URIS', [])
+
+    # Pool size, overflow, recycling, pre-ping and PgBouncer mode come from the environment, see config.py
+    setup_db(app, database_path=database_path, test=test_config is not None,
+             engine_options=engine_options(database_path),
+             replicas=[(url, engine_options(url)) for url in replica_paths])
     
-    # CORS is set up to allow '*' for origins
-    CORS(app)
+    # CORS is set up to allow '*' for origins. Browser clients can read the replica pin header (see replicas.py)
+    CORS(app, expose_headers=[PIN_HEADER])
+
+    # Read endpoints are served from a write-invalidated response cache, see response_cache.py
+    response_cache.backend = backend_from_url(os.environ.get('RESPONSE_CACHE_URL', 'memory://'))
+
+    # Per-request timings, SQL statement counts and cache stats are exported on '/metrics'.
+    # SERVER_TIMING=true adds a Server-Timing header to every response instead of only when requested.
+    app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true')
+    init_metrics(app)
+    register_stats('bball_jwks', jwks_store.stats)
+    register_stats('bball_token_cache', token_cache.stats)
+    register_stats('bball_response_cache', response_cache.stats)
+
+    # Admission control per worker (see admission.py). Reads, writes and streams (change streams and exports)
+    # each get a concurrency limit, reads and writes also a bounded wait queue and a queue timeout, after which
+    # requests are shed with a 503. ADMISSION=off disables it.
+    # The defaults split GUNICORN_THREADS between the classes and their queues (see default_limits()), and the
+    # queues are clamped to the threads the limits leave over, since a waiting request holds a thread.
+    threads = gunicorn_threads()
+    limits = {name: env_int('ADMISSION_{}_LIMIT'.format(name.upper()), default)
+              for name, default in default_limits(threads).items()}
+    if os.environ.get('ADMISSION', '').lower() != 'off':
+        queue_limit = max_queue(threads, limits)
+        if not queue_limit:
+            app.logger.warning('admission: limits (%d reads, %d writes, %d streams) leave none of the %d threads '
+                               'to queue in', limits['read'], limits['write'], limits['stream'], threads)
+        read_queue = min(env_int('ADMISSION_READ_QUEUE', queue_limit - queue_limit // 2), queue_limit)
+        write_queue = min(env_int('ADMISSION_WRITE_QUEUE', queue_limit // 2), queue_limit - read_queue)
+        queue_timeout = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+        admission = AdmissionController(
+            read=AdmissionClass('read', limits['read'], read_queue, queue_timeout),
+            write=AdmissionClass('write', limits['write'], write_queue, queue_timeout),
+            # Streams run for minutes, so they don't queue, and shed clients are told to come back later
+            stream=AdmissionClass('stream', limits['stream'], 0, queue_timeout, retry_after=30),
+        )
+        admission.init_app(app)
+        app.extensions['admission'] = admission
+        register_stats('bball_admission', admission.stats)
+
+    # Requests per token subject, checked once the token is decoded. RATE_LIMIT_PER_MINUTE=0 (default) disables it.
+    rate_limiter.per_minute = env_int('RATE_LIMIT_PER_MINUTE', 0)
+    rate_limiter.burst = env_int('RATE_LIMIT_BURST', 20)
+    register_stats('bball_rate_limit', rate_limiter.stats)
+
+    # POST /teams and POST /players replay the stored response of a repeated Idempotency-Key for
+    # IDEMPOTENCY_TTL seconds (see idempotency.py). IDEMPOTENCY_STORE is 'db' (default), 'memory' or 'off'.
+    idempotency.store = store_from_setting(os.environ.get('IDEMPOTENCY_STORE', 'db'))
+    idempotency.ttl = env_int('IDEMPOTENCY_TTL', 24 * 3600)
+    idempotency.lock_timeout = env_int('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+    register_stats('bball_idempotency', idempotency.stats)
+
+    # Responses of at least COMPRESS_MIN_SIZE bytes are compressed with the first of COMPRESS_ENCODINGS
+    # the client accepts (see compression.py), and cached compressed. COMPRESS_ENCODINGS=off disables it.
+    response_cache.compressor = None
+    encodings = os.environ.get('COMPRESS_ENCODINGS', 'br,zstd,gzip')
+    if encodings != 'off':
+        compressor = Compressor(
+            min_size=env_int('COMPRESS_MIN_SIZE', 1024),
+            encodings=[encoding.strip() for encoding in encodings.split(',') if encoding.strip()],
+        )
+        compressor.init_app(app)
+        app.extensions['compressor'] = compressor
+        response_cache.compressor = compressor
+        register_stats('bball_compression', compressor.stats)
+
+    # With DATABASE_REPLICA_URLS set, GET requests read from the replicas, see replicas.py
+    response_cache.store_check = None
+    if replica_paths:
+        # The engines belong to the app, so they are looked up in its context.
+        with app.app_context():
+            engines = replica_engines()
+        router = ReplicaRouter(
+            engines,
+            retry_interval=env_int('REPLICA_RETRY_INTERVAL', 30),
+            pin_seconds=env_int('REPLICA_PIN_SECONDS', 5),
+        )
+        router.init_app(app)
+        app.extensions['replica_router'] = router
+        response_cache.store_check = router.caught_up
+        register_stats('bball_replicas', router.stats)
+
+    # Every client of '/changes/stream' holds a gunicorn thread, for at most CHANGES_STREAM_SECONDS before
+    # it reconnects. The stream polls the change log every CHANGES_POLL_INTERVAL seconds. At most
+    # CHANGES_MAX_STREAMS streams are open per worker (default: the admission stream limit, which exports
+    # share), so they stay within the threads budgeted for them even with ADMISSION=off; further streams get
+    # a 503.
+    change_feed = ChangeFeed(
+        stream_seconds=env_int('CHANGES_STREAM_SECONDS', 300),
+        poll_interval=float(os.environ.get('CHANGES_POLL_INTERVAL', 1)),
+        heartbeat=env_int('CHANGES_HEARTBEAT_SECONDS', 15),
+        max_streams=env_int('CHANGES_MAX_STREAMS', limits['stream']),
+    )
+    app.extensions['change_feed'] = change_feed
+    register_stats('bball_change_feed', change_feed.stats)
+
+    # SLOW_QUERY_MS enables the slow-query log, SLOW_QUERY_EXPLAIN_SAMPLE (0 to 1) the share of slow
+    # SELECTs whose plan is captured in the background. It covers the replicas too, where GETs run.
+    if os.environ.get('SLOW_QUERY_MS'):
+        with app.app_context():
+            engines = database_engines()
+        slow_query_log = SlowQueryLog(
+            engines,
+            float(os.environ['SLOW_QUERY_MS']),
+            explain_sample=float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', 0)),
+        )
+        app.extensions['slow_query_log'] = slow_query_log
+        register_stats('bball_slow_query', slow_query_log.stats)
+
+    # 'flask migrate' creates missing tables and indexes. Run it once per deploy, before the workers start.
+    @app.cli.command('migrate')
+    def migrate():
+        backfilled = migrate_db()
+        click.echo('Database schema is up to date ({} rows backfilled).'.format(backfilled))
+
+    # 'flask compact-changes' keeps the change log bounded (see change_log.py). Run it periodically, e.g. daily
+    # from a scheduler. Clients whose cursor is older than --retention-days have to reload the full lists.
+    @app.cli.command('compact-changes')
+    @click.option('--retention-days', default=7, show_default=True, help='How long deletes stay in the log.')
+    def compact_change_log(retention_days):
+        superseded, expired = compact_changes(timedelta(days=retention_days))
+        click.echo('Removed {} superseded changes and {} expired deletes.'.format(superseded, expired))
+
+    # 'flask purge-idempotency-keys' deletes expired Idempotency-Key responses. Workers also purge them
+    # as they go, so this is only needed after a quiet period.
+    @app.cli.command('purge-idempotency-keys')
+    def purge_idempotency_keys():
+        click.echo('Purged {} expired idempotency keys.'.format(idempotency.purge()))
+
+    # 'flask import-league roster.csv' loads a CSV or NDJSON roster file in chunks,
+    # writing rejected rows to a separate NDJSON file instead of aborting the import.
+    @app.cli.command('import-league')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default=None,
+                  help='File format, detected from the extension by default.')
+    @click.option('--rejects', default=None, help='Where to write rejected rows, default PATH.rejects.ndjson.')
+    @click.option('--chunk-size', default=5000, show_default=True)
+    @click.option('--no-create-teams', is_flag=True, help='Reject rows whose team does not exist yet.')
+    def import_league(path, file_format, rejects, chunk_size, no_create_teams):
+        file_format = file_format or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        rejects = rejects or path + '.rejects.ndjson'
+
+        def progress(stats):
+            click.echo('{rows} rows, {imported} imported, {rejected} rejected, {elapsed:.1f}s'.format(**stats))
+
+        with open(path, newline='', encoding='utf-8') as source, open(rejects, 'w') as rejects_file:
+            importer = LeagueImporter(chunk_size=chunk_size, reject=reject_writer(rejects_file), progress=progress,
+                                      create_teams=not no_create_teams)
+            stats = importer.run(read_rows(source, file_format))
+
+        click.echo('Done: {imported} players imported, {teams_created} teams created, {rejected} rows rejected '
+                   '({elapsed:.1f}s).'.format(**stats))
+        if stats['rejected']:
+            click.echo('Rejected rows written to {}'.format(rejects))
+
+    # The '/health' GET endpoint reports connection pool utilization from the pool's counters, for the
+    # primary and each replica, without opening a database connection, so it stays cheap when a pool is exhausted.
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify(
+            {
+                'success': True,
+                'database': pool_status(db.engine, app.config['SQLALCHEMY_ENGINE_OPTIONS']),
+                'replicas': [pool_status(engine, app.config['SQLALCHEMY_BINDS']['replica_{}'.format(index)])
+                             for index, engine in enumerate(replica_engines())],
+            }
+        ), 200
 
     # The '/teams' GET endpoint returns a success indicator, and a list of formatted teams
     # or an appropiate status code and message in case of failure.
+    # Rosters are loaded for all teams in one extra SELECT ... WHERE team_id IN (...) query.
+    # Both queries select columns rather than ORM objects, see serializers.py.
+    # Results are paginated by id with the 'limit' and 'after' query parameters.
+    # 'fields' picks the fields of each team (id, name, players); rosters are only loaded for 'players'.
     @app.route('/teams', methods=['GET'])
     @requires_auth('get:teams')
+    @conditional('teams', 'players')
+    @response_cache.cached
     def retrieve_teams(jwt):
-        team_list = Team.query.all()
+        fields = fields_arg(TEAM_FIELDS)
+        columns = [Team.id, Team.name] if 'name' in fields else [Team.id]
+        teams, next_cursor = paginate(db.session.query(*columns), Team)
+        rosters = []
+        if teams and 'players' in fields:
+            rosters = db.session.query(Player.team_id, Player.name) \
+                .filter(Player.team_id.in_([team.id for team in teams])).order_by(Player.id).all()
+        add_tags('teams:list', *(team_tag(team.id) for team in teams))
 
-        return jsonify(
+        return json_response(
             {
                 'success': True,
-                'teams': [team.format() for team in team_list],
+                'teams': team_dicts(teams, rosters, fields),
+                'next_cursor': next_cursor,
             }
         ), 200
     
+    # The '/teams/export' GET endpoint streams every team as newline-delimited JSON, ordered by id.
+    # The 'since' query parameter only exports teams with a greater id, for incremental exports, and
+    # 'fields' picks the exported fields.
+    @app.route('/teams/export', methods=['GET'])
+    @requires_auth('get:teams')
+    def export_teams(jwt):
+        since = int_arg('since', 0, minimum=0)
+        fields = fields_arg(('id', 'name'))
+        query = db.session.query(*(getattr(Team, field) for field in fields)).filter(Team.id > since).order_by(Team.id)
+
+        return ndjson_response(query, fields)
+
     # The '/teams/<int:id>' GET endpoint returns a success indicator, a team name, and a list of player names
     # or an appropiate status code and message in case of failure.
+    # The team and its roster come from a single joined column query, and each player reuses the team's name.
+    # 'fields' picks id, name and players (default name and players); without players only the name is read.
     @app.route('/teams/<int:id>', methods=['GET'])
     @requires_auth('get:teams/id')
+    @conditional('teams', 'players')
+    @response_cache.cached
     def retrieve_team(jwt, id):
-        team = Team.query.filter(Team.id == id).one_or_none()
+        fields = fields_arg(TEAM_FIELDS, default=('name', 'players'))
+        if 'players' in fields:
+            roster = team_roster(id)
+        else:
+            name = db.session.query(Team.name).filter(Team.id == id).scalar()
+            roster = None if name is None else (name, None)
 
-        if team is None:
+        if roster is None:
             abort(404)
-        
-        return jsonify(
+        add_tags(team_tag(id))
+        team = {'id': id, 'name': roster[0], 'players': roster[1]}
+
+        return json_response(
             {
                 'success': True,
-                'name': team.name,
-                'players': [player.long() for player in team.players],
+                **{field: team[field] for field in fields},
             }
         ), 200
     
     # The '/teams' POST endpoint creates a team and returns a success indicator, the team name, and an empty list of players,
     # or an appropiate status code and message in case of failure.
+    # Taken names are found with an index lookup before inserting, so they are rejected without taking the
+    # change log lock. Requests with an Idempotency-Key header are replayed when they are repeated.
     @app.route('/teams', methods=['POST'])
     @requires_auth('post:teams')
+    @idempotency.idempotent
     def create_team(jwt):
         try:
             body = request.get_json()
             new_name = body.get('name')
+            if db.session.query(Team.id).filter(Team.name == new_name).first() is not None:
+                abort(422)
 
             new_team = Team(name=new_name, players=[])
             new_team.insert()
@@ -71,6 +517,39 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    # The '/teams/bulk' POST endpoint creates many teams in one transaction with a single multi-row insert.
+    # Every team is validated first; if any is invalid nothing is inserted and the per-item errors are returned.
+    # On success it returns the created teams in request order and the time taken for the batch.
+    @app.route('/teams/bulk', methods=['POST'])
+    @requires_auth('post:teams')
+    def create_teams_bulk(jwt):
+        start = time.perf_counter()
+        items = bulk_items('teams')
+
+        rows, errors = validate_teams(items)
+        if errors:
+            return bulk_errors(errors, start)
+
+        try:
+            teams = db.session.scalars(insert(Team).returning(Team, sort_by_parameter_order=True), rows).all()
+            created = [{'id': team.id, 'name': team.name, 'players': []} for team in teams]
+            record_changes(db.session, 'teams', 'insert', [team.id for team in teams])
+            bump_versions('teams')
+            invalidate_after_commit(db.session, 'teams:list', *(team_tag(team['id']) for team in created))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify(
+            {
+                'success': True,
+                'created': len(created),
+                'teams': created,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+            }
+        ), 200
+
     # The '/teams/<int:id>' PATCH endpoint updates a team's name and returns a success indicator, the team name, 
     # and a list of players or an appropiate status code and message in case of failure.
     @app.route('/teams/<int:id>', methods=['PATCH'])
@@ -98,6 +577,64 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    # The '/teams/<int:id>/roster' PUT endpoint replaces a team's roster with the players in the body,
+    # given as a list of player ids or as {'players': [...]}. Listed players join the team (moving from
+    # their old team if needed) and players left out become free agents, with one set-based UPDATE each
+    # in a single transaction. Returns a success indicator, the assigned and released counts, and the
+    # resulting roster, or a 422 listing the ids that don't exist.
+    # It changes the players' team_id, so it needs patch:players as well as patch:teams, like the same
+    # change through PATCH '/players/<id>' or '/batch'.
+    @app.route('/teams/<int:id>/roster', methods=['PUT'])
+    @requires_auth('patch:teams')
+    def replace_roster(jwt, id):
+        check_permissions('patch:players', jwt)
+        start = time.perf_counter()
+        if db.session.get(Team, id) is None:
+            abort(404)
+
+        items = request.get_json(silent=True)
+        if isinstance(items, dict):
+            items = items.get('players')
+        if not isinstance(items, list) or len(items) > MAX_BULK_SIZE \
+                or not all(isinstance(item, int) and not isinstance(item, bool) for item in items):
+            abort(422)
+        player_ids = set(items)
+
+        current = dict(db.session.query(Player.id, Player.team_id)
+                       .filter(or_(Player.id.in_(player_ids), Player.team_id == id)))
+        missing = [index for index, player_id in enumerate(items) if player_id not in current]
+        if missing:
+            return bulk_errors([{'index': index, 'message': 'player does not exist'} for index in missing], start)
+
+        released = [player_id for player_id, team_id in current.items() if team_id == id and player_id not in player_ids]
+        assigned = [player_id for player_id in player_ids if current[player_id] != id]
+
+        try:
+            if released:
+                db.session.execute(update(Player).where(Player.team_id == id, Player.id.not_in(player_ids))
+                                   .values(team_id=None))
+            if assigned:
+                db.session.execute(update(Player).where(Player.id.in_(assigned)).values(team_id=id))
+            if released or assigned:
+                record_changes(db.session, 'players', 'update', released + assigned)
+                bump_versions('players')
+                invalidate_after_commit(db.session, team_tag(id), team_tag(None),
+                                        *(team_tag(current[player_id]) for player_id in assigned))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify(
+            {
+                'success': True,
+                'assigned': len(assigned),
+                'released': len(released),
+                'players': team_roster(id)[1],
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+            }
+        ), 200
+
     # The '/teams/<int:id>' DELETE endpoint deletes a team and returns a success indicator and the deleted id
     # or an appropiate status code and message in case of failure.
     @app.route('/teams/<int:id>', methods=['DELETE'])
@@ -109,8 +646,9 @@ def create_app(test_config=None):
             abort(404)
         
         try:
-            for player in team.players:
-                player.team = None
+            # delete() releases the roster with one UPDATE, which the mapper events don't see, so free
+            # agent pages are invalidated here (pages showing the team are covered by the team's tag).
+            invalidate_after_commit(db.session, team_tag(None))
             team.delete()
             return jsonify(
                 {
@@ -122,41 +660,226 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    # The '/batch' POST endpoint runs a list of create, update and delete operations on teams and players
+    # in one request and one transaction (see batch.py). The token is decoded once, and each operation is
+    # checked against its permissions. Body: {'operations': [...], 'atomic': false}.
+    # Returns per-operation results, or a 422 with the results so far when an atomic batch fails.
+    @app.route('/batch', methods=['POST'])
+    @requires_auth(None)
+    def run_operations(jwt):
+        start = time.perf_counter()
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+        operations = body.get('operations')
+        atomic = body.get('atomic', False)
+        if not isinstance(operations, list) or not operations or len(operations) > MAX_BATCH_SIZE \
+                or not isinstance(atomic, bool):
+            abort(422)
+
+        try:
+            results, ok = run_batch(operations, frozenset(jwt.get('permissions', ())), atomic=atomic)
+        except SQLAlchemyError:
+            abort(422)
+
+        if atomic and not ok:
+            return jsonify(
+                {
+                    'success': False,
+                    'error': 422,
+                    'message': 'unprocessable',
+                    'results': results,
+                    'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+                }
+            ), 422
+
+        return jsonify(
+            {
+                'success': ok,
+                'succeeded': sum(1 for result in results if result['status'] == 200),
+                'failed': sum(1 for result in results if result['status'] != 200),
+                'results': results,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+            }
+        ), 200
+
     # The '/players' GET endpoint returns a success indicator, and a list of players with abreviated information for each
     # or an appropiate status code and message in case of failure.
+    # Team names are joined into the same column query, serialized without loading ORM objects.
+    # Results are paginated by id with the 'limit' and 'after' query parameters, and can be filtered
+    # by 'team_id', 'position', 'free_agent=true', or 'min_height' and 'max_height' in inches.
+    # 'sort=height' orders by height instead; players whose height can't be parsed are left out then.
+    # 'fields' picks any of id, name, position, height and team (default id, name and team); teams are
+    # only joined for 'team'.
     @app.route('/players', methods=['GET'])
     @requires_auth('get:players')
+    @conditional('teams', 'players')
+    @response_cache.cached
     def retrieve_players(jwt):
-        player_list = Player.query.all()
+        fields = fields_arg(PLAYER_FIELDS, default=PLAYER_SHORT_FIELDS)
+        query = player_query(fields)
 
-        return jsonify(
+        team_id = int_arg('team_id')
+        if team_id is not None:
+            query = query.filter(Player.team_id == team_id)
+            add_tags(team_tag(team_id))
+        position = request.args.get('position')
+        if position:
+            query = query.filter(Player.position == position)
+            add_tags('position:{}'.format(position))
+        if request.args.get('free_agent', '').lower() in ('true', '1'):
+            query = query.filter(Player.team_id.is_(None))
+            add_tags(team_tag(None))
+        min_height = int_arg('min_height', minimum=0)
+        max_height = int_arg('max_height', minimum=0)
+        if min_height is not None:
+            query = query.filter(Player.height_inches >= min_height)
+        if max_height is not None:
+            query = query.filter(Player.height_inches <= max_height)
+        sort = request.args.get('sort', 'id')
+        if sort not in ('id', 'height'):
+            abort(400)
+        if min_height is not None or max_height is not None or sort == 'height':
+            add_tags('players:height')
+
+        if sort == 'height':
+            player_list, next_cursor = paginate_by_height(query)
+        else:
+            player_list, next_cursor = paginate(query, Player)
+        add_tags('players:list')
+        add_tags(*('player:{}'.format(player.id) for player in player_list))
+        if 'team' in fields:
+            add_tags(*(team_tag(player.team_id) for player in player_list))
+
+        return json_response(
             {
                 'success': True,
-                'players': [player.short() for player in player_list],
+                'players': player_dicts(player_list, fields),
+                'next_cursor': next_cursor,
             }
         ), 200
     
+    # The '/stats' GET endpoint returns league-wide aggregates: player, team and free agent counts, roster
+    # sizes per team, and player counts and height percentiles per position (see league_stats.py).
+    # It is tagged with every team and position it covers, so any write that changes the numbers evicts it.
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:players')
+    @conditional('teams', 'players')
+    @response_cache.cached
+    def retrieve_stats(jwt):
+        stats = league_stats()
+        add_tags('teams:list', 'players:list', 'players:height', team_tag(None),
+                 *(team_tag(team['id']) for team in stats['roster_sizes']),
+                 *('position:{}'.format(position) for position in stats['positions']))
+
+        return jsonify(
+            {
+                'success': True,
+                **stats,
+            }
+        ), 200
+
+    # The '/changes' GET endpoint returns the change log after the 'since' cursor: the teams and players that
+    # were inserted, updated or deleted, oldest first, with each row as it is now (see change_log.py).
+    # Without 'since' it returns no changes and the current cursor, to take before loading the full lists.
+    # Returns 410 when the cursor is older than the compacted part of the log.
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:players')
+    def retrieve_changes(jwt):
+        limit = int_arg('limit', DEFAULT_PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+        since = int_arg('since', minimum=0)
+        if since is None:
+            changes, more, cursor = [], False, latest_change_id()
+        else:
+            try:
+                changes, more = changes_since(since, limit)
+            except ChangesCompacted:
+                abort(410)
+            cursor = changes[-1]['id'] if changes else since
+
+        return json_response(
+            {
+                'success': True,
+                'changes': changes,
+                'cursor': cursor,
+                'more': more,
+            }
+        ), 200
+
+    # The '/changes/stream' GET endpoint sends the same changes as server-sent events, live. It resumes after
+    # the Last-Event-ID header an EventSource sends when it reconnects, or the 'since' cursor, and otherwise
+    # starts at the current end of the log.
+    # Returns 503 with Retry-After when the worker already has as many open streams as it allows.
+    @app.route('/changes/stream', methods=['GET'])
+    @requires_auth('get:players')
+    def stream_changes(jwt):
+        last_event_id = request.headers.get('Last-Event-ID')
+        if last_event_id:
+            if not last_event_id.isdigit():
+                abort(400)
+            since = int(last_event_id)
+        else:
+            since = int_arg('since', minimum=0)
+
+        if since is None:
+            since = latest_change_id()
+        elif since < compacted_through():
+            abort(410)
+        db.session.rollback()
+
+        if not change_feed.open_stream():
+            abort(503, retry_after=change_feed.busy_retry_after)
+        response = Response(stream_with_context(change_feed.events_since(since)), mimetype='text/event-stream')
+        response.call_on_close(change_feed.close_stream)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # The '/players/export' GET endpoint streams every player as newline-delimited JSON, ordered by id.
+    # The 'since' query parameter only exports players with a greater id, for incremental exports, and
+    # 'fields' picks the exported fields.
+    @app.route('/players/export', methods=['GET'])
+    @requires_auth('get:players')
+    def export_players(jwt):
+        since = int_arg('since', 0, minimum=0)
+        fields = fields_arg(('id', 'name', 'position', 'height', 'team_id', 'team'))
+        query = db.session.query(*(Team.name if field == 'team' else getattr(Player, field) for field in fields))
+        if 'team' in fields:
+            query = query.outerjoin(Team, Player.team_id == Team.id)
+        query = query.filter(Player.id > since).order_by(Player.id)
+
+        return ndjson_response(query, fields)
+
     # The '/players/<int:id>' GET endpoint returns a success indicator, and information about a player
     # or an appropiate status code and message in case of failure.
+    # The player comes from one column query of the fields picked by 'fields' (default all of them).
     @app.route('/players/<int:id>', methods=['GET'])
     @requires_auth('get:players/id')
+    @conditional('teams', 'players')
+    @response_cache.cached
     def retrieve_player(jwt, id):
-        player = Player.query.filter(Player.id == id).one_or_none()
+        fields = fields_arg(PLAYER_FIELDS)
+        player = player_query(fields).filter(Player.id == id).one_or_none()
 
         if player is None:
             abort(404)
+        add_tags('player:{}'.format(player.id))
+        if 'team' in fields:
+            add_tags(team_tag(player.team_id))
 
-        return jsonify(
+        return json_response(
             {
                 'success': True,
-                'player': player.long(),
+                'player': player_dicts([player], fields)[0],
             }
         ), 200
     
     # The '/players' POST endpoint creates a player and returns a success indicator and information about the player
     # or an appropiate status code and message in case of failure.
+    # Requests with an Idempotency-Key header are replayed when they are repeated, see idempotency.py.
     @app.route('/players', methods=['POST'])
     @requires_auth('post:players')
+    @idempotency.idempotent
     def create_player(jwt):
         try:
             body = request.get_json()
@@ -178,6 +901,83 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    # The '/players/bulk' POST endpoint creates many players in one transaction with a single multi-row insert.
+    # Every player is validated first; if any is invalid nothing is inserted and the per-item errors are returned.
+    # On success it returns the created players in request order and the time taken for the batch.
+    @app.route('/players/bulk', methods=['POST'])
+    @requires_auth('post:players')
+    def create_players_bulk(jwt):
+        start = time.perf_counter()
+        items = bulk_items('players')
+
+        rows, team_names, errors = validate_players(items)
+        if errors:
+            return bulk_errors(errors, start)
+
+        try:
+            players = db.session.scalars(insert(Player).returning(Player, sort_by_parameter_order=True), rows).all()
+            created = [player.long(team_name=team_names.get(player.team_id)) for player in players]
+            record_changes(db.session, 'players', 'insert', [player.id for player in players])
+            bump_versions('players')
+            invalidate_after_commit(db.session, *player_row_tags(rows))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify(
+            {
+                'success': True,
+                'created': len(created),
+                'players': created,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+            }
+        ), 200
+
+    # The '/players/import' POST endpoint streams a CSV or NDJSON roster upload (raw body or a 'file' form field)
+    # through the league importer and returns the import statistics. Rejected rows are returned separately
+    # (up to MAX_IMPORT_REJECTS of them) instead of aborting the import. Missing teams are only created for
+    # callers that may also create teams (post:teams); for the others those rows are rejected.
+    @app.route('/players/import', methods=['POST'])
+    @requires_auth('post:players')
+    def import_players(jwt):
+        upload = request.files.get('file')
+        stream = upload.stream if upload is not None else request.stream
+        file_format = request.args.get('format')
+        if file_format is None:
+            content_type = upload.mimetype if upload is not None else request.mimetype
+            file_format = 'ndjson' if content_type in ('application/x-ndjson', 'application/jsonl') else 'csv'
+        if file_format not in ('csv', 'ndjson'):
+            abort(400)
+
+        rejected = []
+
+        def reject(line, error, row):
+            if len(rejected) < MAX_IMPORT_REJECTS:
+                rejected.append({'line': line, 'error': error, 'row': row})
+
+        def progress(stats):
+            app.logger.info('import: %(rows)d rows, %(imported)d imported, %(rejected)d rejected', stats)
+
+        importer = LeagueImporter(reject=reject, progress=progress,
+                                  create_teams='post:teams' in jwt.get('permissions', ()))
+        try:
+            stats = importer.run(read_rows(io.TextIOWrapper(stream, encoding='utf-8', newline=''), file_format))
+        except UnicodeDecodeError:
+            abort(422)
+
+        return jsonify(
+            {
+                'success': True,
+                'rows': stats['rows'],
+                'imported': stats['imported'],
+                'rejected': stats['rejected'],
+                'teams_created': stats['teams_created'],
+                'elapsed_ms': round(stats['elapsed'] * 1000, 2),
+                'rejected_rows': rejected,
+            }
+        ), 200
+
     # The '/players/<int:id>' PATCH endpoint updates a player's information and returns a success indicator and updated 
     # information about the player or an appropiate status code and message in case of failure.
     @app.route('/players/<int:id>', methods=['PATCH'])
@@ -233,6 +1033,33 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+        "success": False,
+        "error": 400,
+        "message": "bad_request"
+    }), 400
+
+    @app.errorhandler(409)
+    def conflict(error):
+        response = jsonify({
+        "success": False,
+        "error": 409,
+        "message": "conflict"
+    })
+        if getattr(error, 'retry_after', None) is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 409
+
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+        "success": False,
+        "error": 410,
+        "message": "gone"
+    }), 410
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -257,6 +1084,28 @@ def create_app(test_config=None):
         "message": "bad_method"
     }), 405
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+        "success": False,
+        "error": 429,
+        "message": "too_many_requests"
+    })
+        if error.retry_after is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def unavailable(error):
+        response = jsonify({
+        "success": False,
+        "error": 503,
+        "message": "unavailable"
+    })
+        if error.retry_after is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         return jsonify({
@@ -267,7 +1116,5 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
-
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
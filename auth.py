@@ -1,14 +1,45 @@
 import os
-import json
+import time
 from flask import request, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 
+from admission import rate_limiter
+from jwks import JWKSKeyStore
+from metrics import record_timing
+from token_cache import TokenCache
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+
+# Auth0 settings are read from the environment by configure_auth() when the app is created, so
+# importing this module needs no configuration.
+AUTH0_DOMAIN = None
+ALGORITHMS = None
+API_AUDIENCE = None
+
+# Signing keys are cached in memory per 'kid' instead of being fetched on every request.
+# Its url is set by configure_auth().
+jwks_store = JWKSKeyStore(None)
+
+# Verified tokens are cached so repeat bearer tokens skip the RS256 signature check.
+# Entries are dropped when the JWKS keys rotate.
+token_cache = TokenCache(key_generation=lambda: jwks_store.generation)
+
+
+def configure_auth(environ=os.environ):
+    global AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE
+
+    missing = [name for name in ('AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE') if not environ.get(name)]
+    if missing:
+        raise RuntimeError('missing environment variables: {}'.format(', '.join(missing)))
+
+    AUTH0_DOMAIN = environ['AUTH0_DOMAIN']
+    ALGORITHMS = environ['ALGORITHMS']
+    API_AUDIENCE = environ['API_AUDIENCE']
+    # JWKS_URL can point at a local file:// or http:// JWKS document for testing.
+    jwks_store.url = environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+    jwks_store.default_ttl = int(environ.get('JWKS_TTL', 600))
+    jwks_store.min_refetch_interval = int(environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+    token_cache.maxsize = int(environ.get('TOKEN_CACHE_SIZE', 1024))
 
 ## AuthError Exception
 '''
@@ -52,16 +83,19 @@ def get_token_auth_header():
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        granted: optional set of the payload's permissions (from the token cache)
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
     return true otherwise
 '''
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
     if 'permissions' not in payload:
         raise AuthError({'code': 'no_permissions', 'description': 'Permissions not in token'}, 400)
-    if permission not in payload['permissions']:
+    if granted is None:
+        granted = payload['permissions']
+    if permission not in granted:
         raise AuthError({'code': 'invalid_permission', 'description': 'Required permission not found'}, 403)
     return True
 '''
@@ -70,7 +104,7 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json (cached in jwks_store)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -78,8 +112,6 @@ def check_permissions(permission, payload):
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -88,15 +120,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = jwks_store.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -135,20 +167,28 @@ def verify_decode_jwt(token):
         permission: string permission (i.e. 'post:drink')
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
+    it should use the token_cache, or the verify_decode_jwt method on a miss, to decode the jwt
+    it should use the check_permissions method validate claims and check the requested permission,
+        unless permission is None (the route checks permissions itself, like '/batch')
     return the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            start = time.perf_counter()
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-            check_permissions(permission, payload)
+            cached = token_cache.get(token)
+            if cached is None:
+                try:
+                    cached = token_cache.put(token, verify_decode_jwt(token))
+                except:
+                    abort(401)
+            payload, granted = cached
+            rate_limiter.check(payload.get('sub'))
+            if permission is not None:
+                check_permissions(permission, payload, granted)
+            record_timing('auth', time.perf_counter() - start)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
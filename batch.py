@@ -0,0 +1,105 @@
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, bump_versions, release_roster, Team, Player
+from response_cache import invalidate_after_commit, team_tag
+
+MAX_BATCH_SIZE = 1000
+
+# Permission verb of each operation, checked as '<verb>:<resource>' like the single-item endpoints.
+VERBS = {'create': 'post', 'update': 'patch', 'delete': 'delete'}
+MODELS = {'teams': Team, 'players': Player}
+FIELDS = {'teams': ('name',), 'players': ('name', 'position', 'height', 'team_id')}
+
+
+class OperationError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+# Runs the sub-operations of a POST /batch request in one transaction and returns (results, ok).
+# Each operation is {'op': 'create' | 'update' | 'delete', 'resource': 'teams' | 'players', 'id': ...,
+# 'data': {...}} and is authorized against the permissions decoded once for the whole batch.
+# By default every operation runs in its own SAVEPOINT, so a failed one is rolled back on its own and the
+# rest are committed together. With atomic=True the first failure rolls back the whole batch and the
+# remaining operations are not run. Version counters are bumped once, before the single commit.
+def run_batch(operations, granted, atomic=False):
+    results = []
+    scopes = set()
+    for index, operation in enumerate(operations):
+        try:
+            if atomic:
+                result, touched = perform(operation, granted)
+            else:
+                with db.session.begin_nested():
+                    result, touched = perform(operation, granted)
+        except OperationError as error:
+            results.append({'index': index, 'status': error.status, 'message': error.message})
+            if atomic:
+                db.session.rollback()
+                for earlier in results[:-1]:
+                    earlier['rolled_back'] = True
+                return results, False
+            continue
+
+        scopes.update(touched)
+        results.append({'index': index, 'status': 200, **result})
+
+    try:
+        if scopes:
+            bump_versions(*sorted(scopes))
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return results, all(result['status'] == 200 for result in results)
+
+
+# Applies one operation to the session and flushes it.
+# Returns the result body and the version scopes it touched, or raises OperationError.
+def perform(operation, granted):
+    if not isinstance(operation, dict):
+        raise OperationError(400, 'operation must be an object')
+    action = operation.get('op')
+    resource = operation.get('resource')
+    if action not in VERBS or resource not in MODELS:
+        raise OperationError(400, 'unknown operation')
+    if '{}:{}'.format(VERBS[action], resource) not in granted:
+        raise OperationError(403, 'Required permission not found')
+    data = operation.get('data', {})
+    if not isinstance(data, dict):
+        raise OperationError(400, 'data must be an object')
+
+    model = MODELS[resource]
+    if action == 'create':
+        if resource == 'teams':
+            target = Team(name=data.get('name'), players=[])
+        else:
+            target = Player(name=data.get('name'), position=data.get('position'), height=data.get('height'),
+                            team_id=data.get('team_id'))
+        db.session.add(target)
+    else:
+        target_id = operation.get('id')
+        target = db.session.get(model, target_id) if type(target_id) is int else None
+        if target is None:
+            raise OperationError(404, 'resource not found')
+        if action == 'update':
+            for field in FIELDS[resource]:
+                if field in data:
+                    setattr(target, field, data[field])
+        else:
+            if resource == 'teams':
+                release_roster(db.session, target_id)
+                invalidate_after_commit(db.session, team_tag(None))
+            db.session.delete(target)
+
+    try:
+        db.session.flush()
+    except SQLAlchemyError:
+        raise OperationError(422, 'unprocessable')
+
+    if action == 'delete':
+        return {'deleted': target_id}, ('teams', 'players') if resource == 'teams' else ('players',)
+    if resource == 'teams':
+        return {'team': target.format()}, ('teams',)
+    return {'player': target.long()}, ('players',)
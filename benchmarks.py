@@ -0,0 +1,342 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import statistics
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+
+# The benchmarks run against a throwaway SQLite database unless DATABASE_URL is already set.
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bball_bench.db'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bball')
+
+from sqlalchemy import event, insert, update
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import create_app
+from auth import token_cache
+from league_import import LeagueImporter, read_rows
+from league_stats import league_stats
+from models import db, count_queries, db_drop_and_create_all, migrate_db, Team, Player
+from compression import ENCODERS
+from response_cache import response_cache, LRUBackend
+from serializers import orjson, player_short, team_dicts
+
+app = create_app()
+app.app_context().push()
+migrate_db()
+
+# Importing the app and creating it in a fresh interpreter should stay within this budget, since
+# every gunicorn worker pays it at boot (or the master does once, with preload_app).
+COLD_START_BUDGET_MS = 1000
+COLD_START_SCRIPT = '''
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+'''
+
+BENCH_TOKEN = 'bench'
+ALL_PERMISSIONS = [
+    'get:teams', 'get:players', 'get:teams/id', 'get:players/id',
+    'post:teams', 'post:players', 'patch:teams', 'patch:players',
+    'delete:teams', 'delete:players',
+]
+AUTH_HEADER = {'Authorization': 'bearer ' + BENCH_TOKEN}
+
+
+# Seeds the token cache so benchmark requests skip Auth0 entirely
+def bench_client():
+    token_cache.put(BENCH_TOKEN, {'sub': 'bench', 'permissions': ALL_PERMISSIONS})
+    return app.test_client()
+
+
+# Returns the median wall time of fn in milliseconds
+def median_ms(fn, repeat=50):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def add_team(name, roster_size):
+    team = Team(name=name, players=[])
+    db.session.add(team)
+    db.session.flush()
+    db.session.add_all([
+        Player(name='Player {}'.format(i), position='Guard', height="6'5", team_id=team.id)
+        for i in range(roster_size)
+    ])
+    db.session.commit()
+    return team.id
+
+
+# GET /teams/<id> latency and statement count as the roster grows, without the response cache
+def bench_team_detail():
+    db_drop_and_create_all()
+    client = bench_client()
+
+    backend, response_cache.backend = response_cache.backend, None
+    try:
+        print('{:>8} {:>10} {:>8}'.format('roster', 'median_ms', 'queries'))
+        for roster_size in (5, 15, 50, 200, 1000):
+            team_id = add_team('Roster {}'.format(roster_size), roster_size)
+            path = '/teams/{}'.format(team_id)
+
+            with count_queries() as statements:
+                client.get(path, headers=AUTH_HEADER)
+            elapsed = median_ms(lambda: client.get(path, headers=AUTH_HEADER))
+            print('{:>8} {:>10.2f} {:>8}'.format(roster_size, elapsed, len(statements)))
+    finally:
+        response_cache.backend = backend
+
+
+def add_players(count, team_id=None):
+    rows = [
+        {'name': 'Player {}'.format(i), 'position': 'Forward', 'height': "6'8", 'team_id': team_id}
+        for i in range(count)
+    ]
+    db.session.execute(insert(Player), rows)
+    db.session.commit()
+
+
+# Peak Python memory while streaming GET /players/export, which should stay flat as the table grows
+def bench_export():
+    client = bench_client()
+
+    print('{:>8} {:>10} {:>12} {:>10}'.format('players', 'seconds', 'peak_kib', 'mib_out'))
+    for count in (10000, 100000):
+        db_drop_and_create_all()
+        add_players(count, team_id=1)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        res = client.get('/players/export', headers=AUTH_HEADER)
+        size = sum(len(chunk) for chunk in res.response)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:>8} {:>10.2f} {:>12.0f} {:>10.1f}'.format(count, elapsed, peak / 1024, size / 2 ** 20))
+
+
+# Seeds a league of 500 teams and 7,500 players through the bulk endpoints
+def bench_bulk_create():
+    db_drop_and_create_all()
+    client = bench_client()
+
+    teams = [{'name': 'Bulk Team {}'.format(i)} for i in range(500)]
+    with count_queries() as statements:
+        start = time.perf_counter()
+        res = client.post('/teams/bulk', json=teams, headers=AUTH_HEADER)
+        elapsed = time.perf_counter() - start
+    team_ids = [team['id'] for team in res.get_json()['teams']]
+    print('teams:   {} rows in {:.3f}s, {} statements'.format(len(team_ids), elapsed, len(statements)))
+
+    players = [
+        {'name': 'Bulk Player {}'.format(i), 'position': 'Guard', 'height': "6'4", 'team_id': team_ids[i % 500]}
+        for i in range(7500)
+    ]
+    with count_queries() as statements:
+        start = time.perf_counter()
+        res = client.post('/players/bulk', json=players, headers=AUTH_HEADER)
+        elapsed = time.perf_counter() - start
+    print('players: {} rows in {:.3f}s, {} statements'.format(res.get_json()['created'], elapsed, len(statements)))
+
+
+# Imports a 200,000 row CSV roster spread over 500 teams
+def bench_import():
+    db_drop_and_create_all()
+    lines = ['name,position,height,team']
+    lines += ['Player {0},Guard,"6\'{1}",Team {2}'.format(i, i % 12, i % 500) for i in range(200000)]
+    source = io.StringIO('\n'.join(lines) + '\n')
+
+    stats = LeagueImporter(chunk_size=5000).run(read_rows(source))
+    print('{imported} players, {teams_created} teams in {elapsed:.2f}s ({chunks} chunks)'.format(**stats))
+    print('{:.0f} rows/s'.format(stats['rows'] / stats['elapsed']))
+
+
+# 100 teams with 1,000 players each
+def seed_league():
+    db_drop_and_create_all()
+    team_ids = [add_team('League Team {}'.format(i), 0) for i in range(100)]
+    add_players(100000 - 3, team_id=None)
+    db.session.execute(update(Player).values(team_id=(Player.id % 100) + team_ids[0]))
+    db.session.commit()
+
+
+def timed(fn):
+    db.session.expunge_all()
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+# Builds and encodes a 100,000 player list and 100 teams with 1,000 players each, from ORM objects and
+# from column tuples, with the stdlib encoder jsonify() uses and with orjson when it is installed
+def bench_list_serialization():
+    seed_league()
+
+    encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+    players_orm = lambda: [player.short() for player in
+                           Player.query.options(joinedload(Player.team)).order_by(Player.id)]
+    players_rows = lambda: [player_short(*row) for row in db.session.query(
+        Player.id, Player.name, Player.team_id, Team.name).outerjoin(Team, Player.team_id == Team.id).order_by(Player.id)]
+    teams_orm = lambda: [team.format() for team in Team.query.options(selectinload(Team.players)).order_by(Team.id)]
+    teams_rows = lambda: team_dicts(db.session.query(Team.id, Team.name).order_by(Team.id).all(),
+                                    db.session.query(Player.team_id, Player.name).order_by(Player.id))
+
+    print('{:<10} {:<8} {:>10} {:>10} {:>12}'.format('list', 'read', 'load_ms', 'json_ms', 'orjson_ms'))
+    for name, variants in (('players', (('orm', players_orm), ('columns', players_rows))),
+                           ('teams', (('orm', teams_orm), ('columns', teams_rows)))):
+        outputs = []
+        for read, fn in variants:
+            payload, load = timed(fn)
+            body, dump = timed(lambda: encode(payload))
+            fast = timed(lambda: orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))[1] if orjson else float('nan')
+            outputs.append(body)
+            print('{:<10} {:<8} {:>10.0f} {:>10.0f} {:>12.0f}'.format(name, read, load * 1000, dump * 1000, fast * 1000))
+        print('{:<10} identical output: {}'.format(name, outputs[0] == outputs[1]))
+
+
+@contextmanager
+def sql_timer():
+    timings = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._bench_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings.append(time.perf_counter() - context._bench_start)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        yield timings
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.remove(db.engine, 'after_cursor_execute', after_cursor_execute)
+
+
+# Full pages of GET /players and GET /teams (100 teams with 1,000 players each) with every field and with
+# ?fields=id,name: request latency, time spent in SQL and response size, without the response cache
+def bench_fieldsets():
+    seed_league()
+    client = bench_client()
+
+    backend, response_cache.backend = response_cache.backend, None
+    try:
+        print('{:<56} {:>10} {:>8} {:>10}'.format('request', 'median_ms', 'sql_ms', 'bytes'))
+        for path in ('/players?limit=1000', '/players?limit=1000&fields=id,name',
+                     '/players?limit=1000&fields=id,name,position,height,team',
+                     '/teams?limit=100', '/teams?limit=100&fields=id,name'):
+            with sql_timer() as timings:
+                size = len(client.get(path, headers=AUTH_HEADER).get_data())
+            elapsed = median_ms(lambda: client.get(path, headers=AUTH_HEADER), repeat=20)
+            print('{:<56} {:>10.2f} {:>8.2f} {:>10}'.format(path, elapsed, sum(timings) * 1000, size))
+    finally:
+        response_cache.backend = backend
+
+
+# Compression time and size of a player detail, a page of 1,000 players and a page of 100 teams with full
+# rosters, for each installed encoding at several levels, then request latency with gzip when every request
+# is compressed and when the response cache serves precompressed bytes
+def bench_compression():
+    seed_league()
+    client = bench_client()
+    compressor = app.extensions['compressor']
+    backend, response_cache.backend = response_cache.backend, None
+    try:
+        bodies = [(path, client.get(path, headers=AUTH_HEADER).get_data())
+                  for path in ('/players/1', '/players?limit=1000', '/teams?limit=100')]
+        levels = {'gzip': (1, 6, 9), 'br': (1, 5, 9, 11), 'zstd': (1, 3, 9, 19)}
+
+        print('{:<20} {:<6} {:>6} {:>10} {:>10} {:>8}'.format('response', 'enc', 'level', 'bytes', 'compress_ms', 'ratio'))
+        for path, body in bodies:
+            print('{:<20} {:<6} {:>6} {:>10} {:>10} {:>8}'.format(path, 'none', '', len(body), '', ''))
+            for encoding in ENCODERS:
+                for level in levels[encoding]:
+                    compressed = ENCODERS[encoding](body, level)
+                    elapsed = median_ms(lambda: ENCODERS[encoding](body, level), repeat=10)
+                    print('{:<20} {:<6} {:>6} {:>10} {:>10.2f} {:>8.3f}'.format(
+                        path, encoding, level, len(compressed), elapsed, len(compressed) / len(body)))
+
+        gzip_header = {**AUTH_HEADER, 'Accept-Encoding': 'gzip'}
+        path = '/players?limit=1000'
+        print('{:<40} {:>10}'.format('GET ' + path, 'median_ms'))
+        print('{:<40} {:>10.2f}'.format('identity, no cache', median_ms(lambda: client.get(path, headers=AUTH_HEADER))))
+        print('{:<40} {:>10.2f}'.format('gzip, no cache', median_ms(lambda: client.get(path, headers=gzip_header))))
+        response_cache.backend = LRUBackend()
+        compressed = compressor.stats()['compressed']
+        print('{:<40} {:>10.2f}'.format('gzip, cached', median_ms(lambda: client.get(path, headers=gzip_header))))
+        print('compressions while cached: {}'.format(compressor.stats()['compressed'] - compressed))
+    finally:
+        response_cache.backend = backend
+
+
+# GET /stats over a million players should stay within this budget when it is not served from the cache.
+STATS_BUDGET_MS = 1000
+
+
+# Computes GET /stats over 1,000,000 players on 1,000 teams, without the response cache
+def bench_stats():
+    db_drop_and_create_all()
+    team_ids = [team['id'] for team in bench_client().post(
+        '/teams/bulk', json=[{'name': 'Stats Team {}'.format(i)} for i in range(1000)], headers=AUTH_HEADER
+    ).get_json()['teams']]
+    positions = ('Point Guard', 'Shooting Guard', 'Small Forward', 'Power Forward', 'Center')
+    for start in range(0, 1000000, 100000):
+        db.session.execute(insert(Player), [
+            {'name': 'Player {}'.format(i), 'position': positions[i % 5], 'height': "{}'{}".format(6 + i % 2, i % 12),
+             'team_id': team_ids[i % 1000] if i % 10 else None}
+            for i in range(start, start + 100000)
+        ])
+        db.session.commit()
+
+    elapsed = median_ms(league_stats, repeat=5)
+    print('1000000 players: {:.0f}ms (budget {}ms): {}'.format(
+        elapsed, STATS_BUDGET_MS, 'ok' if elapsed <= STATS_BUDGET_MS else 'OVER BUDGET'))
+
+
+# Import and create_app time of a new worker process, against the cold-start budget
+def bench_cold_start(repeat=5):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], check=True, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        runs.append([float(value) for value in output.split()])
+
+    import_ms = statistics.median(run[0] for run in runs)
+    create_ms = statistics.median(run[1] for run in runs)
+    total = import_ms + create_ms
+    print('import {:.0f}ms, create_app {:.0f}ms, total {:.0f}ms (budget {}ms): {}'.format(
+        import_ms, create_ms, total, COLD_START_BUDGET_MS, 'ok' if total <= COLD_START_BUDGET_MS else 'OVER BUDGET'))
+
+
+BENCHMARKS = {
+    'team_detail': bench_team_detail,
+    'export': bench_export,
+    'bulk_create': bench_bulk_create,
+    'import': bench_import,
+    'cold_start': bench_cold_start,
+    'list_serialization': bench_list_serialization,
+    'stats': bench_stats,
+    'fieldsets': bench_fieldsets,
+    'compression': bench_compression,
+}
+
+# Usage: python benchmarks.py [name ...]
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,191 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, delete, event, func, select
+from sqlalchemy.orm import Session, aliased
+
+from models import db, record_changes, Change, DataVersion, Team, Player
+
+DEFAULT_RETENTION = timedelta(days=7)
+
+PLAYER_FIELDS = ('id', 'name', 'position', 'height', 'team_id')
+TEAM_FIELDS = ('id', 'name')
+
+
+class ChangesCompacted(Exception):
+    pass
+
+
+# Records the teams and players a flush inserted, updated or deleted in the change log, in the flush's
+# transaction (or savepoint), so a rolled back write leaves no change behind.
+# Updates that only touch collections (a team's players list) change no team column and are skipped;
+# the players they move are recorded themselves.
+@event.listens_for(Session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    changes = {}
+    for op, targets in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for target in targets:
+            if isinstance(target, Team):
+                resource = 'teams'
+            elif isinstance(target, Player):
+                resource = 'players'
+            else:
+                continue
+            if op == 'update' and not session.is_modified(target, include_collections=False):
+                continue
+            changes.setdefault((resource, op), []).append(target.id)
+
+    for (resource, op), ids in sorted(changes.items()):
+        record_changes(session, resource, op, sorted(ids))
+
+
+# The id of the newest delete that compact_changes() removed. Clients behind it may have missed deletes.
+def compacted_through():
+    return db.session.query(DataVersion.version).filter(DataVersion.scope == 'changes_compacted').scalar() or 0
+
+
+# The cursor of the end of the log. Compaction may have removed the newest change, so it is never behind
+# compacted_through().
+def latest_change_id():
+    return max(db.session.query(func.max(Change.id)).scalar() or 0, compacted_through())
+
+
+# Returns the changes after the since cursor as dicts, oldest first, and whether more are waiting.
+# 'data' is the row as it is now, or None once it has been deleted, so clients apply inserts and updates as
+# upserts. Raises ChangesCompacted when the cursor is older than the compacted deletes.
+def changes_since(since, limit):
+    if since < compacted_through():
+        raise ChangesCompacted()
+
+    team = aliased(Team)
+    rows = db.session.query(
+        Change.id, Change.resource, Change.resource_id, Change.op,
+        Player.name, Player.position, Player.height, Player.team_id, team.name,
+    ).outerjoin(Player, and_(Change.resource == 'players', Player.id == Change.resource_id)) \
+        .outerjoin(team, and_(Change.resource == 'teams', team.id == Change.resource_id)) \
+        .filter(Change.id > since).order_by(Change.id).limit(limit + 1).all()
+
+    changes = [change_dict(*row) for row in rows[:limit]]
+    return changes, len(rows) > limit
+
+
+def change_dict(change_id, resource, resource_id, op, player_name, position, height, team_id, team_name):
+    data = None
+    if op != 'delete':
+        if resource == 'players' and player_name is not None:
+            data = dict(zip(PLAYER_FIELDS, (resource_id, player_name, position, height, team_id)))
+        elif resource == 'teams' and team_name is not None:
+            data = dict(zip(TEAM_FIELDS, (resource_id, team_name)))
+    return {'id': change_id, 'resource': resource, 'resource_id': resource_id, 'op': op, 'data': data}
+
+
+# Keeps the change log bounded by the size of the league:
+#   1. every change older than the newest change of the same row is removed. Feed entries carry the row as it
+#      is when read, so the newest change alone brings any client up to date.
+#   2. deletes older than retention are removed, and the cursor they reach is remembered; clients behind it get
+#      ChangesCompacted (410) and reload the full lists.
+# The log then holds at most one entry per live row plus the deletes of the retention window.
+# Returns (superseded, expired) counts. Run it periodically with 'flask compact-changes'.
+def compact_changes(retention=DEFAULT_RETENTION):
+    newer = aliased(Change)
+    superseded = db.session.execute(delete(Change).where(
+        select(newer.id).where(newer.resource == Change.resource, newer.resource_id == Change.resource_id,
+                               newer.id > Change.id).exists()
+    )).rowcount
+
+    cutoff = datetime.now(timezone.utc) - retention
+    expired = db.session.query(func.count(), func.max(Change.id)) \
+        .filter(Change.op == 'delete', Change.created_at < cutoff).one()
+    if expired[0]:
+        db.session.execute(delete(Change).where(Change.op == 'delete', Change.id <= expired[1],
+                                                Change.created_at < cutoff))
+        db.session.execute(
+            db.update(DataVersion)
+            .where(DataVersion.scope == 'changes_compacted', DataVersion.version < expired[1])
+            .values(version=expired[1], updated_at=datetime.now(timezone.utc))
+        )
+    db.session.commit()
+    return superseded, expired[0]
+
+
+# Server-sent events for GET /changes/stream. Each change is sent as an event whose id is its cursor, so
+# EventSource clients resume where they left off (Last-Event-ID) when they reconnect.
+# The feed polls the log every poll_interval seconds, releasing its database connection between polls, and
+# sends a comment every heartbeat seconds to keep proxies from closing an idle stream. Streams end after
+# stream_seconds so a gunicorn thread isn't held forever; clients reconnect after retry_ms.
+# A 'reset' event means compaction overtook the stream's cursor, and the client has to reload the full lists.
+# At most max_streams streams are open per worker (None for no limit), so streams can't take every thread;
+# open_stream() refuses the rest, which get a 503 asking them to come back after busy_retry_after seconds.
+class ChangeFeed:
+    def __init__(self, stream_seconds=300, poll_interval=1.0, heartbeat=15, retry_ms=1000, batch_size=500,
+                 max_streams=None, busy_retry_after=30, clock=time.monotonic, sleep=time.sleep):
+        self.stream_seconds = stream_seconds
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.retry_ms = retry_ms
+        self.batch_size = batch_size
+        self.max_streams = max_streams
+        self.busy_retry_after = busy_retry_after
+        self.clock = clock
+        self.sleep = sleep
+
+        self.streams = 0
+        self.open_streams = 0
+        self.refused = 0
+        self.events = 0
+        self._lock = threading.Lock()
+
+    # Takes a stream slot, or returns False when max_streams streams are already open.
+    # Give it back with close_stream() once the response is closed.
+    def open_stream(self):
+        with self._lock:
+            if self.max_streams is not None and self.open_streams >= self.max_streams:
+                self.refused += 1
+                return False
+            self.streams += 1
+            self.open_streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self.open_streams -= 1
+
+    # Yields the stream's text chunks, starting after the since cursor.
+    def events_since(self, since):
+        end = self.clock() + self.stream_seconds
+        quiet_since = self.clock()
+        yield 'retry: {}\n\n'.format(self.retry_ms)
+        while True:
+            try:
+                changes, more = changes_since(since, self.batch_size)
+            except ChangesCompacted:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            finally:
+                db.session.rollback()
+            if changes:
+                since = changes[-1]['id']
+                self.events += len(changes)
+                quiet_since = self.clock()
+                yield ''.join('id: {}\nevent: change\ndata: {}\n\n'.format(
+                    change['id'], json.dumps(change, separators=(',', ':'))) for change in changes)
+                if more:
+                    continue
+            elif self.clock() - quiet_since >= self.heartbeat:
+                quiet_since = self.clock()
+                yield ': heartbeat\n\n'
+
+            if self.clock() >= end:
+                return
+            self.sleep(self.poll_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': self.streams,
+                'open_streams': self.open_streams,
+                'refused': self.refused,
+                'events': self.events,
+            }
@@ -0,0 +1,111 @@
+import gzip
+import threading
+import time
+
+from flask import request
+
+from metrics import record_timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/csv')
+
+# Encoders by Accept-Encoding token, in the server's order of preference for equal client quality.
+# brotli and zstd are used when their packages are installed (pip install brotli zstandard).
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS['br'] = lambda data, level: brotli.compress(data, quality=level)
+if zstandard is not None:
+    ENCODERS['zstd'] = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+ENCODERS['gzip'] = lambda data, level: gzip.compress(data, compresslevel=level, mtime=0)
+
+# Levels that compress JSON well at a few milliseconds per 100 KB, see 'python benchmarks.py compression'.
+DEFAULT_LEVELS = {'br': 5, 'zstd': 3, 'gzip': 6}
+
+
+# Compresses responses for clients that accept it, negotiated through Accept-Encoding.
+# Bodies smaller than min_size are sent as they are: compressing them costs more CPU than the bytes it saves.
+# Streamed responses (exports, the change stream) are never compressed, so they aren't buffered.
+# The response cache stores the compressed bytes of the responses it caches, so each payload is compressed
+# once per encoding rather than once per request (see ResponseCache.cached).
+class Compressor:
+    def __init__(self, min_size=1024, encodings=None, levels=None):
+        self.min_size = min_size
+        self.encodings = tuple(encoding for encoding in (encodings or ENCODERS) if encoding in ENCODERS)
+        self.levels = {**DEFAULT_LEVELS, **(levels or {})}
+
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        @app.after_request
+        def compress_response(response):
+            return self.compress_response(response)
+
+    # Returns the encoding to use for the current request, or None for identity.
+    def negotiate(self):
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = request.accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compressible(self, response):
+        return response.status_code == 200 and response.mimetype in COMPRESSIBLE_TYPES \
+            and not response.is_streamed and not response.direct_passthrough \
+            and 'Content-Encoding' not in response.headers
+
+    # Compresses data with encoding, or returns None when it is below min_size.
+    def compress(self, data, encoding):
+        if len(data) < self.min_size:
+            with self._lock:
+                self.skipped += 1
+            return None
+        start = time.perf_counter()
+        compressed = ENCODERS[encoding](data, self.levels[encoding])
+        record_timing('compress', time.perf_counter() - start)
+        with self._lock:
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+        return compressed
+
+    def compress_response(self, response):
+        if not self.compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        compressed = self.compress(response.get_data(), encoding)
+        if compressed is not None:
+            set_encoded(response, compressed, encoding)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'compressed': self.compressed,
+                'skipped': self.skipped,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+            }
+
+
+def set_encoded(response, data, encoding):
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
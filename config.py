@@ -0,0 +1,77 @@
+import os
+
+from sqlalchemy.pool import NullPool
+
+from metrics import InstrumentedQueuePool
+
+# Threads per gunicorn worker when GUNICORN_THREADS isn't set; gunicorn.conf.py uses the same default.
+DEFAULT_THREADS = 8
+
+
+def env_int(name, default, environ=os.environ):
+    value = environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_flag(name, default=False, environ=os.environ):
+    value = environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def gunicorn_threads(environ=os.environ):
+    return max(env_int('GUNICORN_THREADS', DEFAULT_THREADS, environ), 1)
+
+
+def is_memory_sqlite(database_path):
+    return database_path.startswith('sqlite') and (database_path == 'sqlite://' or ':memory:' in database_path)
+
+
+# Builds the create_engine options for the connection pool from the environment.
+# Each gunicorn thread holds at most one connection at a time, so by default every worker gets
+# GUNICORN_THREADS pooled connections plus a small overflow for background work (EXPLAIN capture,
+# health checks). The database then sees up to
+#     WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# connections, which has to stay below its max_connections.
+# DB_PGBOUNCER=true hands pooling to PgBouncer: SQLAlchemy opens a connection per checkout (NullPool)
+# and skips the pre-ping, since PgBouncer already keeps server connections healthy.
+def engine_options(database_path, environ=os.environ):
+    if is_memory_sqlite(database_path):
+        # In-memory SQLite needs its single shared connection
+        return {}
+
+    if env_flag('DB_PGBOUNCER', environ=environ):
+        return {'poolclass': NullPool, 'pool_pre_ping': False}
+
+    threads = gunicorn_threads(environ)
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': env_int('DB_POOL_SIZE', max(threads, 2), environ),
+        'max_overflow': env_int('DB_MAX_OVERFLOW', 2, environ),
+        'pool_timeout': env_int('DB_POOL_TIMEOUT', 10, environ),
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800, environ),
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True, environ),
+    }
+
+
+# Reports pool utilization from the pool's public counters, without checking out a connection.
+# options are the engine_options() the engine was created with, for the overflow limit the pool doesn't
+# expose (SQLAlchemy's default of 10 when they don't set one).
+def pool_status(engine, options=None):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, InstrumentedQueuePool):
+        size = pool.size()
+        max_overflow = (options or {}).get('max_overflow', 10)
+        capacity = size + max(max_overflow, 0)
+        checked_out = pool.checkedout()
+        status.update({
+            'size': size,
+            'max_overflow': max_overflow,
+            'checked_in': pool.checkedin(),
+            'checked_out': checked_out,
+            'overflow': max(pool.overflow(), 0),
+            'utilization': round(checked_out / capacity, 3) if capacity else 0.0,
+        })
+    return status
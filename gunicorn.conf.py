@@ -0,0 +1,15 @@
+import os
+
+# Gunicorn reads this file on start-up. Worker and thread counts come from the environment so the
+# database pool can be sized to match (see config.engine_options and the README).
+# Threaded workers, so a slow request or an open '/changes/stream' doesn't hold the whole worker; the
+# default thread count matches config.DEFAULT_THREADS.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+# GUNICORN_PRELOAD=true imports and creates the app once in the master before forking, so workers
+# boot faster and share memory. create_app opens no connections, and each worker drops any pooled
+# connections inherited from the master (see models.setup_db).
+preload_app = os.environ.get('GUNICORN_PRELOAD', '').lower() in ('1', 'true', 'yes', 'on')
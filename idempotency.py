@@ -0,0 +1,230 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import Response, request
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest, Conflict, UnprocessableEntity
+
+from models import db, IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL = 24 * 3600
+# How long a claimed key stays locked when its request never finishes (the worker was killed).
+# Longer than gunicorn's timeout, so a running request never loses its claim.
+DEFAULT_LOCK_TIMEOUT = 60
+
+# A stored request: the fingerprint of its body, and the status and body of its response, which are None
+# while the request is running.
+Entry = namedtuple('Entry', ('fingerprint', 'status', 'body'))
+
+
+class RequestInProgress(Conflict):
+    description = 'A request with this Idempotency-Key is still in progress.'
+
+    def __init__(self, retry_after=1):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+# In-process store, for tests and single-process deployments. Expired keys are dropped when they are looked
+# up, and all of them once maxsize keys are held; past that the oldest keys go first.
+class MemoryStore:
+    def __init__(self, maxsize=10000, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Claims key for a new request and returns None, or returns the Entry already stored under it.
+    def claim(self, key, fingerprint, lock_timeout):
+        now = self.clock()
+        with self._lock:
+            current = self.entries.get(key)
+            if current is not None and current[1] > now:
+                return current[0]
+            self.entries.pop(key, None)
+            if len(self.entries) >= self.maxsize:
+                self._purge(now)
+                while len(self.entries) >= self.maxsize:
+                    self.entries.popitem(last=False)
+            self.entries[key] = (Entry(fingerprint, None, None), now + lock_timeout)
+            return None
+
+    def complete(self, key, fingerprint, status, body, ttl):
+        with self._lock:
+            self.entries[key] = (Entry(fingerprint, status, body), self.clock() + ttl)
+
+    # Gives up a claim whose request failed, so the key can be used again.
+    def release(self, key):
+        with self._lock:
+            current = self.entries.get(key)
+            if current is not None and current[0].status is None:
+                del self.entries[key]
+
+    def purge(self):
+        with self._lock:
+            return self._purge(self.clock())
+
+    def _purge(self, now):
+        expired = [key for key, (_, expires_at) in self.entries.items() if expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self.entries)}
+
+
+# Store in the idempotency_keys table, shared by every worker. Claims are inserts on the primary key, so of
+# concurrent requests with the same key exactly one inserts and the others find its row.
+# Every call runs in its own short transaction on the primary, outside the request's session, so a claim is
+# visible to other workers before the request writes anything. Expired rows are purged at most every
+# purge_interval seconds per worker, and by 'flask purge-idempotency-keys'.
+class DatabaseStore:
+    def __init__(self, purge_interval=60, clock=time.time):
+        self.purge_interval = purge_interval
+        self.clock = clock
+        self.purged_at = None
+
+    def _now(self):
+        return datetime.fromtimestamp(self.clock(), timezone.utc)
+
+    def claim(self, key, fingerprint, lock_timeout):
+        now = self._now()
+        if self.purged_at is None or (now - self.purged_at).total_seconds() >= self.purge_interval:
+            self.purge()
+
+        table = IdempotencyKey.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(delete(table).where(table.c.key == key, table.c.expires_at <= now))
+                conn.execute(insert(table).values(key=key, fingerprint=fingerprint,
+                                                  expires_at=now + timedelta(seconds=lock_timeout)))
+            return None
+        except IntegrityError:
+            pass
+
+        with db.engine.connect() as conn:
+            row = conn.execute(select(table.c.fingerprint, table.c.status, table.c.body)
+                               .where(table.c.key == key)).first()
+        # The request that held it failed and released it in between: report it as running, the client retries.
+        if row is None:
+            return Entry(fingerprint, None, None)
+        return Entry(*row)
+
+    def complete(self, key, fingerprint, status, body, ttl):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(update(table).where(table.c.key == key, table.c.fingerprint == fingerprint)
+                         .values(status=status, body=body, expires_at=self._now() + timedelta(seconds=ttl)))
+
+    def release(self, key):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.key == key, table.c.status.is_(None)))
+
+    def purge(self):
+        now = self._now()
+        self.purged_at = now
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            return conn.execute(delete(table).where(table.c.expires_at <= now)).rowcount
+
+    def stats(self):
+        return {}
+
+
+# Builds a store from IDEMPOTENCY_STORE: 'db' (default), 'memory' or 'off'.
+def store_from_setting(value):
+    if not value or value == 'db':
+        return DatabaseStore()
+    if value == 'memory':
+        return MemoryStore()
+    if value == 'off':
+        return None
+    raise ValueError('unsupported IDEMPOTENCY_STORE: {}'.format(value))
+
+
+# Idempotency-Key support for create endpoints, so a client can retry a POST whose response it never got
+# without creating the row twice. The first request with a key claims it and runs; its successful response
+# is stored for ttl seconds and sent back, with Idempotent-Replayed: true, to every retry with the same key
+# and body, without running the endpoint again. While the first request runs, retries get a 409 with
+# Retry-After. Reusing a key with a different body is a 422. Failed requests give their key up, so the
+# client can fix the request and retry with the same key.
+# Keys are scoped to the token subject and the route, so clients can't read each other's responses.
+class Idempotency:
+    def __init__(self, store=None, ttl=DEFAULT_TTL, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.store = store
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.stored = 0
+        self.replayed = 0
+        self.in_progress = 0
+        self.mismatched = 0
+
+    # Apply it below @requires_auth, which passes the decoded token first.
+    def idempotent(self, f):
+        @wraps(f)
+        def wrapper(jwt, *args, **kwargs):
+            client_key = request.headers.get(HEADER)
+            if self.store is None or client_key is None:
+                return f(jwt, *args, **kwargs)
+            if not client_key or len(client_key) > MAX_KEY_LENGTH:
+                raise BadRequest()
+
+            key = scoped_key(jwt.get('sub'), request.method, request.path, client_key)
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            entry = self.store.claim(key, fingerprint, self.lock_timeout)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    self.mismatched += 1
+                    raise UnprocessableEntity()
+                if entry.status is None:
+                    self.in_progress += 1
+                    raise RequestInProgress()
+                self.replayed += 1
+                response = Response(entry.body, status=entry.status, mimetype='application/json')
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = f(jwt, *args, **kwargs)
+            except BaseException:
+                self.store.release(key)
+                raise
+            body, status = response if isinstance(response, tuple) else (response, 200)
+            if isinstance(body, Response) and 200 <= status < 300:
+                self.store.complete(key, fingerprint, status, body.get_data(), self.ttl)
+                self.stored += 1
+            else:
+                self.store.release(key)
+            return response
+        return wrapper
+
+    def purge(self):
+        return self.store.purge() if self.store is not None else 0
+
+    def stats(self):
+        return {
+            'store': type(self.store).__name__ if self.store is not None else None,
+            'stored': self.stored,
+            'replayed': self.replayed,
+            'in_progress': self.in_progress,
+            'mismatched': self.mismatched,
+            **(self.store.stats() if self.store is not None else {}),
+        }
+
+
+def scoped_key(subject, method, path, client_key):
+    return hashlib.sha256('\0'.join((subject or '', method, path, client_key)).encode()).hexdigest()
+
+
+# Configured from IDEMPOTENCY_STORE, IDEMPOTENCY_TTL and IDEMPOTENCY_LOCK_TIMEOUT when the app is created.
+idempotency = Idempotency()
@@ -0,0 +1,145 @@
+import json
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+MAX_AGE_PATTERN = re.compile(r'max-age\s*=\s*(\d+)')
+
+# Keeps the signing keys of a JWKS document in memory, indexed by 'kid'.
+# Keys are served from memory until the document's Cache-Control max-age (or default_ttl) runs out.
+# A daemon thread refreshes the document shortly before it expires so requests never wait on the
+# identity provider, and an unknown 'kid' triggers at most one refetch per min_refetch_interval.
+# The url can be an https:// url, a local http:// stub server, or a file:// path for tests.
+class JWKSKeyStore:
+    def __init__(self, url, default_ttl=600, min_ttl=60, max_ttl=86400, min_refetch_interval=30,
+                 refresh_margin=30, timeout=5, background=True, clock=time.monotonic):
+        self.url = url
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.background = background
+        self.clock = clock
+
+        self.keys = {}
+        self.expires_at = 0
+        self.fetched_at = None
+        # Bumped every time the set of keys changes, so dependent caches can tell when keys rotated.
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.unknown_kid_refetches = 0
+
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    # Returns the JWK dict for a key id, or None if the provider does not publish that key.
+    def get_key(self, kid):
+        self._ensure_refresher()
+
+        if self.clock() >= self.expires_at:
+            self._refresh_or_keep_stale(self.fetches)
+
+        key = self.keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        # The provider may have rotated in a new key; look again, but only once per interval.
+        if self._may_refetch():
+            self.unknown_kid_refetches += 1
+            self._refresh_or_keep_stale(self.fetches)
+            return self.keys.get(kid)
+        return None
+
+    # Fetches the JWKS document and replaces the cached keys.
+    # 'seen' is the fetch count the caller observed; if another thread fetched since then, its keys are reused.
+    def refresh(self, seen=None):
+        with self._fetch_lock:
+            if seen is not None and self.fetches != seen:
+                return self.keys
+            self.fetches += 1
+            self.fetched_at = self.clock()
+            try:
+                response = urlopen(self.url, timeout=self.timeout)
+                document = json.loads(response.read())
+                ttl = self._ttl(getattr(response, 'headers', None))
+            except Exception:
+                self.fetch_errors += 1
+                raise
+
+            keys = {key['kid']: key for key in document.get('keys', []) if 'kid' in key}
+            with self._lock:
+                if keys != self.keys:
+                    self.generation += 1
+                self.keys = keys
+                self.expires_at = self.clock() + ttl
+            return keys
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'fetches': self.fetches,
+            'fetch_errors': self.fetch_errors,
+            'unknown_kid_refetches': self.unknown_kid_refetches,
+            'keys': len(self.keys),
+            'generation': self.generation,
+        }
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_or_keep_stale(self, seen=None):
+        try:
+            self.refresh(seen)
+        except Exception:
+            # Serve the previous keys while the provider is unreachable; fail only if there are none.
+            if not self.keys:
+                raise
+            self.expires_at = self.clock() + self.min_refetch_interval
+
+    def _may_refetch(self):
+        return self.fetched_at is None or self.clock() - self.fetched_at >= self.min_refetch_interval
+
+    def _ttl(self, headers):
+        ttl = self.default_ttl
+        if headers is not None:
+            cache_control = headers.get('Cache-Control') or ''
+            match = MAX_AGE_PATTERN.search(cache_control)
+            if match:
+                ttl = int(match.group(1))
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+    # The refresher thread is started lazily so that each forked gunicorn worker gets its own.
+    def _ensure_refresher(self):
+        if not self.background or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._refresh_loop, name='jwks-refresh', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            wait = self.expires_at - self.refresh_margin - self.clock()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            try:
+                self.refresh(self.fetches)
+            except Exception:
+                self._stop.wait(self.min_refetch_interval)
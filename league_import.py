@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+import time
+from itertools import islice
+
+from sqlalchemy import func, insert
+
+from models import db, bump_versions, lock_change_log, parse_height, record_changes, record_inserts_after, Team, Player
+from response_cache import invalidate_after_commit, player_row_tags
+
+PLAYER_COLUMNS = ('name', 'position', 'height', 'height_inches', 'team_id')
+DEFAULT_CHUNK_SIZE = 5000
+
+
+# Yields (line number, row dict) pairs from a CSV or NDJSON text stream without reading it all into memory.
+# CSV files need a header row with name, position, height and optionally team (a team name) or team_id.
+def read_rows(stream, format='csv'):
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'ndjson':
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = {'_raw': line.rstrip('\n'), '_error': 'invalid JSON'}
+            yield line_num, row
+    else:
+        raise ValueError('unsupported import format: {}'.format(format))
+
+
+# Loads players from read_rows() in chunks.
+# Team names are resolved to ids through an in-memory map loaded once; teams that do not exist yet are
+# created per chunk with one multi-row insert, only for rows whose own fields are valid, unless create_teams
+# is False, which rejects those rows instead. Rows go in through COPY on PostgreSQL (psycopg2) and a batched
+# executemany insert elsewhere, with one commit per chunk.
+# Invalid rows are passed to reject(line, error, row) instead of aborting the job, and progress(stats)
+# is called after every chunk.
+class LeagueImporter:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, reject=None, progress=None, create_teams=True):
+        self.chunk_size = chunk_size
+        self.reject = reject or (lambda line, error, row: None)
+        self.progress = progress or (lambda stats: None)
+        self.create_teams = create_teams
+
+        self.team_ids = {}
+        self.known_ids = set()
+        self.stats = {'rows': 0, 'imported': 0, 'rejected': 0, 'teams_created': 0, 'chunks': 0, 'elapsed': 0.0}
+
+    def run(self, rows):
+        start = time.perf_counter()
+        self.team_ids = dict(db.session.query(Team.name, Team.id))
+        self.known_ids = set(self.team_ids.values())
+
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            self.load_chunk(chunk)
+            self.stats['chunks'] += 1
+            self.stats['elapsed'] = time.perf_counter() - start
+            self.progress(dict(self.stats))
+
+        self.stats['elapsed'] = time.perf_counter() - start
+        return self.stats
+
+    def load_chunk(self, chunk):
+        self.stats['rows'] += len(chunk)
+        # Rows are checked before any team is created, so a rejected row never creates its team
+        checked, errors = [], {}
+        for index, (line, row) in enumerate(chunk):
+            values, error = self.check_fields(row)
+            if error is not None:
+                errors[index] = error
+            else:
+                checked.append((index, row, values))
+
+        if self.create_teams:
+            self.add_missing_teams(row for index, row, values in checked)
+
+        players = []
+        for index, row, values in checked:
+            player, error = self.with_team(row, values)
+            if error is not None:
+                errors[index] = error
+            else:
+                players.append(player)
+
+        for index in sorted(errors):
+            line, row = chunk[index]
+            self.stats['rejected'] += 1
+            self.reject(line, errors[index], row)
+
+        if players:
+            try:
+                # COPY doesn't return the new ids, so the inserts are recorded as every id past the
+                # largest one seen under the change log lock
+                lock_change_log(db.session)
+                after_id = db.session.query(func.max(Player.id)).scalar() or 0
+                self.insert_players(players)
+                record_inserts_after(db.session, 'players', after_id)
+                bump_versions('players')
+                invalidate_after_commit(db.session, *player_row_tags(players))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            self.stats['imported'] += len(players)
+
+    # Creates the teams named by rows (already checked by check_fields()) that don't exist yet.
+    def add_missing_teams(self, rows):
+        names = {
+            row['team'].strip() for row in rows if isinstance(row.get('team'), str) and row['team'].strip()
+        } - self.team_ids.keys()
+        if not names:
+            return
+        result = db.session.execute(insert(Team).returning(Team.id, Team.name), [{'name': name} for name in names])
+        for team_id, name in result:
+            self.team_ids[name] = team_id
+            self.known_ids.add(team_id)
+        record_changes(db.session, 'teams', 'insert', [self.team_ids[name] for name in names])
+        bump_versions('teams')
+        invalidate_after_commit(db.session, 'teams:list')
+        db.session.commit()
+        self.stats['teams_created'] += len(names)
+
+    # Checks the fields that don't depend on teams. Returns (values, None) or (None, error message).
+    def check_fields(self, row):
+        if not isinstance(row, dict):
+            return None, 'row must be an object'
+        if '_error' in row:
+            return None, row['_error']
+
+        values = {}
+        for field in ('name', 'position', 'height'):
+            value = row.get(field)
+            if not isinstance(value, str) or not value.strip():
+                return None, '{} is required'.format(field)
+            values[field] = value.strip()
+        return values, None
+
+    # Resolves the row's team to an id and completes the player row from check_fields()' values.
+    # Returns (player row, None) or (None, error message).
+    def with_team(self, row, values):
+        team = row.get('team')
+        team_id = row.get('team_id')
+        if isinstance(team, str) and team.strip():
+            team_id = self.team_ids.get(team.strip())
+            if team_id is None:
+                return None, 'team does not exist'
+        elif team_id not in (None, ''):
+            try:
+                team_id = int(team_id)
+            except (TypeError, ValueError):
+                return None, 'team_id must be an integer'
+            if team_id not in self.known_ids:
+                return None, 'team does not exist'
+        else:
+            team_id = None
+
+        values['team_id'] = team_id
+        # COPY skips column defaults, so the parsed height is filled in here
+        values['height_inches'] = parse_height(values['height'])
+        return values, None
+
+    def insert_players(self, players):
+        connection = db.session.connection()
+        if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+            copy_players(connection, players)
+        else:
+            db.session.execute(insert(Player), players)
+
+
+# Streams rows into the players table with COPY ... FROM STDIN, inside the session's transaction.
+def copy_players(connection, players):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for player in players:
+        writer.writerow([player[column] if player[column] is not None else '' for column in PLAYER_COLUMNS])
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY players ({}) FROM STDIN WITH (FORMAT csv)'.format(', '.join(PLAYER_COLUMNS)),
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+# Returns a reject() callback that writes each rejected row as a JSON line to a text stream.
+def reject_writer(stream):
+    def reject(line, error, row):
+        stream.write(json.dumps({'line': line, 'error': error, 'row': row}) + '\n')
+    return reject
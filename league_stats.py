@@ -0,0 +1,67 @@
+from bisect import bisect_right
+from itertools import groupby
+
+from sqlalchemy import func
+
+from models import db, Team, Player
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+# League-wide aggregates for GET /stats, from three GROUP BY queries whose results stay small however
+# many players there are:
+#   players per team_id         roster sizes and the free agent count (the team_id index covers it)
+#   team id and name            so empty teams are listed too
+#   players per (position, height_inches)
+# The last one is a height histogram per position. Heights are whole inches in a narrow range, so
+# percentiles are computed exactly from the cumulative counts instead of fetching every height.
+def league_stats():
+    per_team = dict(db.session.query(Player.team_id, func.count()).group_by(Player.team_id))
+    teams = db.session.query(Team.id, Team.name).order_by(Team.id).all()
+    histogram = db.session.query(Player.position, Player.height_inches, func.count()) \
+        .group_by(Player.position, Player.height_inches).order_by(Player.position, Player.height_inches).all()
+
+    positions = {}
+    for position, rows in groupby(histogram, key=lambda row: row[0]):
+        rows = list(rows)
+        heights = [(inches, count) for _, inches, count in rows if inches is not None]
+        positions[position] = {
+            'players': sum(count for _, _, count in rows),
+            'height_inches': height_summary(heights),
+        }
+
+    return {
+        'players': sum(per_team.values()),
+        'teams': len(teams),
+        'free_agents': per_team.get(None, 0),
+        'roster_sizes': [{'id': team_id, 'name': name, 'players': per_team.get(team_id, 0)} for team_id, name in teams],
+        'positions': positions,
+    }
+
+
+# Count, mean, min, max and percentiles of a sorted [(inches, count), ...] histogram, or None if it is empty.
+# Percentiles interpolate linearly between ranks, like numpy.percentile's default.
+def height_summary(heights):
+    if not heights:
+        return None
+    cumulative, total, weighted = [], 0, 0
+    for inches, count in heights:
+        total += count
+        weighted += inches * count
+        cumulative.append(total)
+
+    def value_at(rank):
+        return heights[bisect_right(cumulative, rank)][0]
+
+    summary = {
+        'count': total,
+        'mean': round(weighted / total, 2),
+        'min': heights[0][0],
+        'max': heights[-1][0],
+    }
+    for percentile in PERCENTILES:
+        rank = percentile / 100 * (total - 1)
+        lower = int(rank)
+        low, high = value_at(lower), value_at(min(lower + 1, total - 1))
+        summary['p{}'.format(percentile)] = round(low + (high - low) * (rank - lower), 2)
+    return summary
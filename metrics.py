@@ -0,0 +1,171 @@
+import bisect
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+# A Prometheus histogram with a fixed set of label names.
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for labels, (counts, total, sum_) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, label_text(self.labelnames, labels, le=bound), cumulative))
+                lines.append('{}_bucket{} {}'.format(self.name, label_text(self.labelnames, labels, le='+Inf'), total))
+                lines.append('{}_count{} {}'.format(self.name, label_text(self.labelnames, labels), total))
+                lines.append('{}_sum{} {}'.format(self.name, label_text(self.labelnames, labels), sum_))
+        return lines
+
+
+def label_text(names, values, le=None):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append('le="{}"'.format(le))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+REQUEST_DURATION = Histogram(
+    'bball_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method', 'status'))
+REQUEST_PHASE = Histogram(
+    'bball_request_phase_seconds', 'Time spent in auth, db, serialize and compress per request.', ('endpoint', 'phase'))
+REQUEST_QUERIES = Histogram(
+    'bball_request_queries', 'SQL statements executed per request.', ('endpoint',), buckets=COUNT_BUCKETS)
+POOL_CHECKOUT_WAIT = Histogram(
+    'bball_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled database connection.')
+
+ADMISSION_WAIT = Histogram(
+    'bball_admission_wait_seconds', 'Time spent waiting for an admission slot, by priority class.', ('class',))
+
+METRICS = [REQUEST_DURATION, REQUEST_PHASE, REQUEST_QUERIES, POOL_CHECKOUT_WAIT, ADMISSION_WAIT]
+
+# Callables returning {name: value} dicts (e.g. cache stats), rendered as gauges named prefix_name.
+STATS_SOURCES = {}
+
+
+def register_stats(prefix, stats):
+    STATS_SOURCES[prefix] = stats
+
+
+# Adds to a phase ('auth', 'db', 'serialize', 'compress', 'pool_wait' in seconds, or the 'queries' count) of the current request.
+def record_timing(phase, seconds):
+    if has_request_context() and 'request_timing' in g:
+        timing = g.request_timing
+        timing[phase] = timing.get(phase, 0) + seconds
+
+
+# The start time is kept on the statement's execution context, so a statement that raises (and never reaches
+# after_cursor_execute) leaves nothing behind on the connection.
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_start', None)
+    if start is not None:
+        record_timing('db', time.perf_counter() - start)
+    record_timing('queries', 1)
+
+
+# QueuePool that records how long each checkout took to hand out a connection, including waiting for a
+# free one and the pre-ping.
+class InstrumentedQueuePool(QueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            elapsed = time.perf_counter() - start
+            POOL_CHECKOUT_WAIT.observe(elapsed)
+            record_timing('pool_wait', elapsed)
+
+
+# Times jsonify() so serialization shows up as its own phase.
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            record_timing('serialize', time.perf_counter() - start)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, stats in STATS_SOURCES.items():
+        for key, value in sorted(stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = '{}_{}'.format(prefix, key)
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+# Records per-request latency, phase timings and statement counts, adds a Server-Timing header when the
+# request sends 'X-Server-Timing: 1' (or SERVER_TIMING is set in the app config), and serves /metrics.
+def init_metrics(app):
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timing():
+        g.request_timing = {'start': time.perf_counter()}
+
+    @app.after_request
+    def finish_timing(response):
+        timing = g.pop('request_timing', None)
+        if timing is None or request.endpoint == 'metrics':
+            return response
+
+        total = time.perf_counter() - timing['start']
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_DURATION.observe(total, endpoint, request.method, response.status_code)
+        for phase in ('auth', 'db', 'serialize', 'compress'):
+            REQUEST_PHASE.observe(timing.get(phase, 0.0), endpoint, phase)
+        REQUEST_QUERIES.observe(timing.get('queries', 0), endpoint)
+
+        if app.config.get('SERVER_TIMING') or request.headers.get('X-Server-Timing') == '1':
+            parts = ['{};dur={:.2f}'.format(phase, timing.get(phase, 0.0) * 1000)
+                     for phase in ('auth', 'db', 'serialize', 'compress', 'pool_wait')]
+            parts[1] += ';desc="{} queries"'.format(timing.get('queries', 0))
+            parts.append('total;dur={:.2f}'.format(total * 1000))
+            response.headers['Server-Timing'] = ', '.join(parts)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
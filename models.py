@@ -1,32 +1,152 @@
 import os
+import re
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, insert, inspect, literal, select, text, update
+from sqlalchemy.orm import validates
 
 # These are variables used to connect flask application to local database. Uncomment These out to run the app locally
 
 # database_name = 'bball_manager'
 # database_path = 'postgresql://{}:{}@{}/{}'.format('postgres', 'abc', 'localhost:5432', database_name)
 
-# Comment this out and uncomment the above database path variables to run locally
-database_path = os.environ['DATABASE_URL']
+# Leave this as None to use DATABASE_URL, which is read when the app is created
+database_path = None
 
-db = SQLAlchemy()
+# Session that sends reads to session.info['read_engine'] (a replica picked by replicas.py) when it is set.
+# Flushes always go to the primary.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        read_engine = self.info.get('read_engine')
+        if bind is None and read_engine is not None and not self._flushing:
+            return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Engines of every app created in this process, for the fork handler below. Held weakly, so engines of
+# apps that are gone are neither kept alive nor disposed.
+fork_engines = weakref.WeakSet()
+
+# With gunicorn's preload_app the app is created before the workers fork. Each worker drops the
+# pooled connections it inherited, without closing them under the parent. Registered once per process.
+def dispose_engines_after_fork():
+    for engine in list(fork_engines):
+        engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=dispose_engines_after_fork)
 
 # Binds the running flask application to a SQLAlchemy service.
-def setup_db(app, database_path=database_path, test=False):
+# engine_options are passed to create_engine (e.g. the pool class).
+# replicas is a list of (url, engine_options) pairs for read replicas, registered as the binds
+# 'replica_0', 'replica_1', ... Schema changes only run on the primary.
+# Nothing here connects to the database: creating engines is lazy, and the schema is created by
+# migrate_db() ('flask migrate'). Testing apps get a pushed app context and a freshly seeded database.
+def setup_db(app, database_path=None, test=False, engine_options=None, replicas=()):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options or {}
+    app.config["SQLALCHEMY_BINDS"] = {
+        'replica_{}'.format(index): {'url': url, **options} for index, (url, options) in enumerate(replicas)
+    }
     db.app = app
-    app.app_context().push()
     db.init_app(app)
-    db.create_all()
+
+    # Disposed in forked workers, see dispose_engines_after_fork()
+    with app.app_context():
+        fork_engines.update(db.engines.values())
+
     if test:
+        app.app_context().push()
         db_drop_and_create_all()
 
+# Creates missing tables, columns and indexes and backfills new columns. Run it once per deploy with
+# 'flask migrate'. Returns the number of backfilled rows.
+def migrate_db():
+    db.create_all(bind_key=None)
+    add_missing_columns()
+    seed_missing_versions()
+    backfilled = backfill_height_inches()
+    create_missing_indexes()
+    return backfilled
+
+# create_all() doesn't alter existing tables, so nullable columns added to a model are added here.
+def add_missing_columns():
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(dialect=conn.dialect))))
+
+# Fills players.height_inches for rows written before the column existed, in keyset batches.
+# Heights that can't be parsed stay NULL.
+def backfill_height_inches(batch_size=5000):
+    backfilled, after = 0, 0
+    while True:
+        rows = db.session.query(Player.id, Player.height).filter(Player.height_inches.is_(None), Player.id > after) \
+            .order_by(Player.id).limit(batch_size).all()
+        if not rows:
+            return backfilled
+        after = rows[-1].id
+        values = [{'id': player_id, 'height_inches': parse_height(height)} for player_id, height in rows]
+        values = [row for row in values if row['height_inches'] is not None]
+        if values:
+            db.session.execute(update(Player), values)
+        db.session.commit()
+        backfilled += len(values)
+
+# Makes every player of a team a free agent with one UPDATE, and records the changes.
+# Returns the released player ids.
+def release_roster(session, team_id):
+    released = session.execute(update(Player).where(Player.team_id == team_id).values(team_id=None)
+                               .returning(Player.id)).scalars().all()
+    record_changes(session, 'players', 'update', released)
+    return released
+
+# The read replica engines, in configuration order.
+def replica_engines():
+    count = sum(1 for key in db.engines if key is not None and key.startswith('replica_'))
+    return [db.engines['replica_{}'.format(index)] for index in range(count)]
+
+# The primary and replica engines by name: 'primary', 'replica_0', ...
+def database_engines():
+    engines = {'primary': db.engine}
+    engines.update(('replica_{}'.format(index), engine) for index, engine in enumerate(replica_engines()))
+    return engines
+
+# Counts the SQL statements executed on the primary inside the block, for the query-count tests and the
+# benchmarks: yields the list the statements are appended to.
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+# create_all() only creates missing tables, so indexes added to existing tables are created here.
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
 # Resets database and creates demo rows for testing
 def db_drop_and_create_all():
     db.session.close()
-    db.drop_all()
-    db.create_all()
+    db.drop_all(bind_key=None)
+    db.create_all(bind_key=None)
 
     team1 = Team(
         name = "Heat",
@@ -76,7 +196,9 @@ class Team(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
-    players = db.relationship('Player', backref='team', lazy=True)
+    # delete() releases the roster with one UPDATE first, so the ORM doesn't load the players to
+    # null them one at a time.
+    players = db.relationship('Player', backref='team', lazy=True, passive_deletes=True)
 
     def __init__(self, name, players):
         self.name = name
@@ -84,13 +206,18 @@ class Team(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('teams')
         db.session.commit()
 
     def update(self):
+        bump_versions('teams')
         db.session.commit()
 
+    # Deleting a team also releases its players, with a single UPDATE players SET team_id = NULL
     def delete(self):
+        release_roster(db.session, self.id)
         db.session.delete(self)
+        bump_versions('teams', 'players')
         db.session.commit()
 
     def format(self):
@@ -110,28 +237,51 @@ class Team(db.Model):
 #Creates a class that models the players table.
 class Player(db.Model):
     __tablename__ = 'players'
+    # (team_id, id) backs roster lookups, the team_id and free agent filters and keyset pagination within a team.
+    # (position, id) does the same for the position filter.
+    # (height_inches, id) backs the height range filters and sort=height, with keyset pagination.
+    # (position, height_inches, id) does the same within a position, and covers the per-position
+    # height histogram of GET /stats.
+    __table_args__ = (
+        db.Index('ix_players_team_id_id', 'team_id', 'id'),
+        db.Index('ix_players_position_id', 'position', 'id'),
+        db.Index('ix_players_height_inches_id', 'height_inches', 'id'),
+        db.Index('ix_players_position_height_inches_id', 'position', 'height_inches', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     position = db.Column(db.String(120), nullable=False)
     height = db.Column(db.String(120), nullable=False)
     team_id = db.Column(db.Integer, db.ForeignKey('teams.id'), nullable=True)
+    # height parsed to inches, or NULL when it can't be parsed. ORM writes keep it in sync through
+    # validate_height(), Core inserts through the column default, and COPY imports set it explicitly.
+    height_inches = db.Column(db.Integer, nullable=True, default=lambda context: parse_height(
+        context.get_current_parameters().get('height')))
 
     def __init__(self, name, position, height, team_id):
         self.name = name
         self.position = position
         self.height = height
         self.team_id = team_id
+
+    @validates('height')
+    def validate_height(self, key, height):
+        self.height_inches = parse_height(height)
+        return height
     
     def insert(self):
         db.session.add(self)
+        bump_versions('players')
         db.session.commit()
 
     def update(self):
+        bump_versions('players')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('players')
         db.session.commit()
 
     def short(self):
@@ -146,9 +296,12 @@ class Player(db.Model):
             'team': team,
         }
     
-    def long(self):
+    # team_name can be passed when the caller already knows the team, to skip loading self.team
+    def long(self, team_name=None):
         if self.team_id is None:
             team = "Free Agent"
+        elif team_name is not None:
+            team = team_name
         else:
             team = self.team.name
 
@@ -158,4 +311,138 @@ class Player(db.Model):
             'position': self.position,
             'height': self.height,
             'team': team,
-        }
\ No newline at end of file
+        }
+
+
+HEIGHT_PATTERN = re.compile(r'''^\s*(\d)\s*(?:'|ft\.?|-|\s)\s*(\d{1,2})?\s*(?:"|''|in\.?)?\s*$''')
+
+# Parses heights written as 6'9, 6'9", 6-9, 6 ft 9 in or 7' into inches.
+# Returns None for anything else.
+def parse_height(height):
+    if not isinstance(height, str):
+        return None
+    match = HEIGHT_PATTERN.match(height)
+    if match is None:
+        return None
+    inches = int(match.group(2) or 0)
+    if inches >= 12:
+        return None
+    return int(match.group(1)) * 12 + inches
+
+
+VERSION_SCOPES = ('teams', 'players')
+# Counters of the change log (see Change). 'changes' is bumped by every transaction that records changes,
+# and 'changes_compacted' holds the id of the newest delete that compaction removed from the log.
+CHANGE_LOG_SCOPES = ('changes', 'changes_compacted')
+
+# Creates a class that models the data_versions table.
+# Each row is a counter for one table that every write to that table bumps inside its own transaction,
+# so the read endpoints can build ETags from two cheap primary key lookups instead of loading rows.
+class DataVersion(db.Model):
+    __tablename__ = 'data_versions'
+
+    scope = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+# Seeds one counter per scope whenever the table is created.
+@event.listens_for(DataVersion.__table__, 'after_create')
+def seed_data_versions(target, connection, **kw):
+    now = datetime.now(timezone.utc)
+    connection.execute(target.insert(), [{'scope': scope, 'version': 0, 'updated_at': now}
+                                         for scope in VERSION_SCOPES + CHANGE_LOG_SCOPES])
+
+# Seeds the counters of scopes added after the table was created.
+def seed_missing_versions():
+    with db.engine.begin() as conn:
+        existing = set(conn.execute(select(DataVersion.scope)).scalars())
+        missing = [scope for scope in VERSION_SCOPES + CHANGE_LOG_SCOPES if scope not in existing]
+        if missing:
+            now = datetime.now(timezone.utc)
+            conn.execute(DataVersion.__table__.insert(),
+                         [{'scope': scope, 'version': 0, 'updated_at': now} for scope in missing])
+
+# Bumps the version counters of the given scopes in the current transaction.
+# Callers that write with bulk or Core statements instead of insert()/update()/delete() call this themselves.
+def bump_versions(*scopes):
+    db.session.execute(
+        db.update(DataVersion)
+        .where(DataVersion.scope.in_(scopes))
+        .values(version=DataVersion.version + 1, updated_at=datetime.now(timezone.utc))
+    )
+
+# Returns {scope: (version, updated_at)} for the given scopes in one query.
+def current_versions(*scopes):
+    rows = db.session.query(DataVersion.scope, DataVersion.version, DataVersion.updated_at) \
+        .filter(DataVersion.scope.in_(scopes))
+    return {scope: (version, updated_at) for scope, version, updated_at in rows}
+
+
+CHANGE_RESOURCES = {'teams': Team, 'players': Player}
+
+# Creates a class that models the changes table, the change log behind GET /changes.
+# Every transaction that inserts, updates or deletes teams or players adds one row per written row,
+# naming the row and the operation. Row data isn't copied: the feed joins the rows as they are when it
+# is read. The id is the feed's cursor and is never reused (AUTOINCREMENT on SQLite).
+class Change(db.Model):
+    __tablename__ = 'changes'
+    # (resource, resource_id, id) finds the newest change of each row, for compaction
+    __table_args__ = (
+        db.Index('ix_changes_resource_resource_id_id', 'resource', 'resource_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(20), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+# Creates a class that models the idempotency_keys table, the database store of idempotency.py.
+# A row is claimed with a NULL status when a request with a new Idempotency-Key starts, and holds the
+# response once it succeeds. key is a SHA-256 of the token subject, the route and the client's key, and
+# fingerprint a SHA-256 of the request body. Expired rows are purged by expires_at.
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+# Takes the change log's row lock (the 'changes' counter) until the transaction ends.
+# Transactions that record changes hold it from their first change to their commit, so change ids are
+# handed out in commit order and a reader that has seen id N can never see a smaller id commit later.
+# Take it before bump_versions() so every writer locks the counters in the same order.
+def lock_change_log(session):
+    session.connection().execute(
+        update(DataVersion)
+        .where(DataVersion.scope == 'changes')
+        .values(version=DataVersion.version + 1, updated_at=datetime.now(timezone.utc))
+    )
+
+# Records op ('insert', 'update' or 'delete') on the rows of resource ('teams' or 'players') with the given ids.
+# ORM writes are recorded by change_log.py at flush; callers that write with bulk or Core statements call
+# this themselves.
+def record_changes(session, resource, op, ids):
+    if not ids:
+        return
+    lock_change_log(session)
+    now = datetime.now(timezone.utc)
+    session.connection().execute(Change.__table__.insert(), [
+        {'resource': resource, 'resource_id': resource_id, 'op': op, 'created_at': now} for resource_id in ids
+    ])
+
+# Records inserts of every row of resource with an id greater than after_id, with one INSERT ... SELECT.
+# For inserts whose ids aren't returned (COPY): take lock_change_log() before reading after_id, so the
+# only rows past it this transaction can see are its own.
+def record_inserts_after(session, resource, after_id):
+    model = CHANGE_RESOURCES[resource]
+    now = datetime.now(timezone.utc)
+    lock_change_log(session)
+    session.connection().execute(insert(Change).from_select(
+        ['resource', 'resource_id', 'op', 'created_at'],
+        select(literal(resource), model.id, literal('insert'), literal(now, Change.created_at.type))
+        .where(model.id > after_id),
+    ))
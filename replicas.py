@@ -0,0 +1,158 @@
+import hashlib
+import math
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from models import db, DataVersion
+
+READ_METHODS = ('GET', 'HEAD')
+PIN_COOKIE = 'bball_read_primary_until'
+PIN_HEADER = 'X-Read-Primary-Until'
+MAX_PINS = 10000
+
+
+# Sends GET and HEAD requests to read replicas, round-robin over the healthy ones, and every other
+# request to the primary.
+# A replica leaves the rotation when a statement on it fails with an operational error (connection
+# refused, dropped connection, ...). After retry_interval seconds one request probes it with 'SELECT 1'
+# and puts it back if that works. When no replica is healthy, reads go to the primary.
+# Read-your-writes: a successful write pins its client to the primary for pin_seconds, which should be
+# longer than the replication lag. Within a worker clients are recognised by their Authorization header;
+# across workers by the pin's expiry, which the write's response sends both as a cookie and as the
+# X-Read-Primary-Until header, for API clients that don't keep cookies to echo back on their reads.
+class ReplicaRouter:
+    def __init__(self, engines, retry_interval=30, pin_seconds=5, clock=time.time):
+        self.engines = list(engines)
+        self.retry_interval = retry_interval
+        self.pin_seconds = pin_seconds
+        self.clock = clock
+
+        self.down = {}
+        self.pins = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.pinned_reads = 0
+        self.failures = 0
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self.handle_error)
+
+    def init_app(self, app):
+        @app.before_request
+        def route_reads():
+            if request.method not in READ_METHODS:
+                return
+            if self.pinned():
+                self.pinned_reads += 1
+                return
+            engine = self.pick()
+            if engine is None:
+                self.primary_reads += 1
+                return
+            self.replica_reads += 1
+            db.session.info['read_engine'] = engine
+
+        @app.after_request
+        def pin_writers(response):
+            if request.method not in READ_METHODS and response.status_code < 400:
+                self.pin(response)
+            return response
+
+        # Ends the replica transaction so the session starts on the primary again.
+        @app.teardown_request
+        def release_replica(exc):
+            if db.session.info.pop('read_engine', None) is not None:
+                db.session.rollback()
+
+    # Returns the next healthy replica, or None to read from the primary.
+    def pick(self):
+        now = self.clock()
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = self.engines[self._next]
+                self._next = (self._next + 1) % len(self.engines)
+                retry_at = self.down.get(engine)
+                if retry_at is not None:
+                    if retry_at > now:
+                        continue
+                    # Other requests keep skipping the replica while this one probes it
+                    self.down[engine] = now + self.retry_interval
+            if retry_at is None or self.probe(engine):
+                return engine
+        return None
+
+    def probe(self, engine):
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+        except DBAPIError:
+            return False
+        with self._lock:
+            self.down.pop(engine, None)
+        return True
+
+    def handle_error(self, context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            with self._lock:
+                self.down[context.engine] = self.clock() + self.retry_interval
+                self.failures += 1
+
+    def client_key(self):
+        authorization = request.headers.get('Authorization')
+        if authorization:
+            return hashlib.sha256(authorization.encode()).hexdigest()
+        return request.remote_addr
+
+    def pinned(self):
+        now = self.clock()
+        for value in (request.cookies.get(PIN_COOKIE), request.headers.get(PIN_HEADER)):
+            try:
+                if value is not None and float(value) > now:
+                    return True
+            except ValueError:
+                pass
+        return self.pins.get(self.client_key(), 0) > now
+
+    def pin(self, response):
+        now = self.clock()
+        until = now + self.pin_seconds
+        with self._lock:
+            if len(self.pins) >= MAX_PINS:
+                self.pins = {key: value for key, value in self.pins.items() if value > now}
+            self.pins[self.client_key()] = until
+        response.set_cookie(PIN_COOKIE, '{:.3f}'.format(until), max_age=math.ceil(self.pin_seconds),
+                            httponly=True, samesite='Lax')
+        response.headers[PIN_HEADER] = '{:.3f}'.format(until)
+
+    # Used as the response cache's store check. Writes invalidate the cache when they commit on the
+    # primary, so a page read from a replica that has not replayed them yet must not be stored.
+    # It is stored only when the data versions the replica reported before the page was built
+    # (g.data_versions, set by conditional()) match the primary's.
+    def caught_up(self):
+        if db.session.info.get('read_engine') is None:
+            return True
+        seen = g.get('data_versions')
+        if seen is None:
+            return False
+        with db.engine.connect() as conn:
+            primary = dict(conn.execute(select(DataVersion.scope, DataVersion.version)).all())
+        return all(primary.get(scope) == version for scope, (version, updated_at) in seen.items())
+
+    def stats(self):
+        with self._lock:
+            down = len(self.down)
+        return {
+            'replicas': len(self.engines),
+            'healthy': len(self.engines) - down,
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'pinned_reads': self.pinned_reads,
+            'failures': self.failures,
+        }
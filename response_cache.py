@@ -0,0 +1,454 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, g, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from compression import set_encoded
+from models import Team, Player
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:
+    class WatchError(Exception):
+        pass
+
+# Response cache for the read endpoints.
+# Entries hold the serialized JSON bytes of a 200 response, keyed by path, query string and the data versions
+# @conditional read for the request, and carry tags naming the rows they were built from:
+#   'teams:list' / 'players:list'  every list page (rows added or removed)
+#   'team:<id>' / 'player:<id>'    pages and details that show that team or player
+#   'team:none'                    pages that show free agents
+#   'position:<name>'              player pages filtered on that position
+#   'players:height'               player pages filtered or sorted by height
+# SQLAlchemy mapper events on Team and Player turn each write into the tags it affects, which are
+# invalidated at flush and again after commit, so a reader that loaded the old rows in between can't
+# leave them cached. Writes that bypass the ORM events (bulk inserts, COPY, UPDATE statements) call
+# invalidate_after_commit() themselves.
+# Tags evict entries in the process (or shared backend) that saw the write. The data versions in the key cover
+# the rest: after a write in another worker, or while a replica lags, requests read other versions and never
+# hit the entries built from older data.
+
+
+# In-process LRU backend. It only sees invalidations from its own process; entries of other workers' writes
+# stop being hit because the versions in their keys are out of date, and age out of the LRU. With several
+# gunicorn workers each one holds its own copy, so a shared backend uses less memory and misses less.
+class LRUBackend:
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.tags = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    # The tags of the entry under key, or None if there is none.
+    def entry_tags(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry[1] if entry is not None else None
+
+    # Stores an entry unless something was invalidated since epoch was read, when the value may be stale.
+    def set(self, key, value, tags, epoch):
+        with self._lock:
+            if epoch != self._epoch:
+                return False
+            self._remove(key)
+            self.entries[key] = (value, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+            return True
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._epoch += 1
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self._remove(key)
+
+    def epoch(self):
+        return self._epoch
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[1]:
+                keys = self.tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tags[tag]
+
+
+# Shared backend on top of a Redis-compatible client (get, set, delete, sadd, smembers, incr, expire),
+# so every worker sees the same entries and invalidations. Each entry's tags are kept next to it in an
+# 'entry-tags:' set, so entries derived from it can be stored with the same tags.
+class RedisBackend:
+    def __init__(self, client, prefix='bball:cache:', ttl=3600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(self.prefix + 'entry:' + key)
+
+    def entry_tags(self, key):
+        if not self.client.get(self.prefix + 'entry:' + key):
+            return None
+        return frozenset(_text(tag) for tag in self.client.smembers(self.prefix + 'entry-tags:' + key))
+
+    # The epoch is WATCHed and the entry and its tags are written in one MULTI, so an invalidation that lands
+    # between the epoch check and the write makes the write fail instead of storing a stale entry.
+    def set(self, key, value, tags, epoch):
+        epoch_key = self.prefix + 'epoch'
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(epoch_key)
+                if int(pipe.get(epoch_key) or 0) != epoch:
+                    return False
+                pipe.multi()
+                pipe.set(self.prefix + 'entry:' + key, value, ex=self.ttl)
+                entry_tags_key = self.prefix + 'entry-tags:' + key
+                pipe.delete(entry_tags_key)
+                if tags:
+                    pipe.sadd(entry_tags_key, *tags)
+                    pipe.expire(entry_tags_key, self.ttl)
+                for tag in tags:
+                    tag_key = self.prefix + 'tag:' + tag
+                    pipe.sadd(tag_key, key)
+                    pipe.expire(tag_key, self.ttl)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def invalidate(self, tags):
+        self.client.incr(self.prefix + 'epoch')
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag_key)
+            if keys:
+                self.client.delete(*[self.prefix + kind + _text(key)
+                                     for key in keys for kind in ('entry:', 'entry-tags:')])
+            self.client.delete(tag_key)
+
+    def epoch(self):
+        return int(self.client.get(self.prefix + 'epoch') or 0)
+
+    def clear(self):
+        self.client.incr(self.prefix + 'epoch')
+        keys = [key for kind in ('entry:', 'entry-tags:', 'tag:')
+                for key in self.client.scan_iter(match=self.prefix + kind + '*')]
+        if keys:
+            self.client.delete(*keys)
+
+
+# A thread-safe in-memory stand-in for the subset of the Redis client API that RedisBackend uses,
+# including WATCH/MULTI pipelines. Expiry is not enforced. Used by the tests and for single-process development.
+class LocalRedis:
+    def __init__(self):
+        self.data = {}
+        self.revisions = {}
+        self._lock = threading.RLock()
+
+    def pipeline(self):
+        return LocalPipeline(self)
+
+    def _touch(self, key):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self.data[key] = value
+            self._touch(key)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self.data.pop(key, None)
+                self._touch(key)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self.data.setdefault(key, set()).update(members)
+            self._touch(key)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self.data.get(key, ()))
+
+    def incr(self, key):
+        with self._lock:
+            self.data[key] = int(self.data.get(key, 0)) + 1
+            self._touch(key)
+            return self.data[key]
+
+    def expire(self, key, seconds):
+        pass
+
+    def scan_iter(self, match):
+        prefix = match.rstrip('*')
+        with self._lock:
+            return [key for key in self.data if key.startswith(prefix)]
+
+
+# A LocalRedis pipeline. Commands run right away until multi(), then are queued until execute(), which
+# raises WatchError without running them if a watched key was written since watch().
+class LocalPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.watched = {}
+        self.commands = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def watch(self, *keys):
+        with self.client._lock:
+            self.watched.update({key: self.client.revisions.get(key, 0) for key in keys})
+
+    def multi(self):
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        if self.commands is None:
+            return command
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        try:
+            with self.client._lock:
+                if any(self.client.revisions.get(key, 0) != revision for key, revision in self.watched.items()):
+                    raise WatchError()
+                return [command(*args, **kwargs) for command, args, kwargs in self.commands or ()]
+        finally:
+            self.reset()
+
+    def reset(self):
+        self.watched = {}
+        self.commands = None
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# Builds a backend from RESPONSE_CACHE_URL: 'memory://' (default), 'local://' for the LocalRedis
+# stand-in, 'redis://...' for a Redis server (needs the redis package) or 'off'.
+def backend_from_url(url):
+    if not url or url == 'off':
+        return None
+    if url.startswith('memory://'):
+        return LRUBackend()
+    if url.startswith('local://'):
+        return RedisBackend(LocalRedis())
+    if url.startswith(('redis://', 'rediss://')):
+        import redis
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError('unsupported RESPONSE_CACHE_URL: {}'.format(url))
+
+
+class ResponseCache:
+    # store_check, when set, is called before a response is stored and can veto it (see replicas.py).
+    # compressor, when set, compresses responses before they are stored (see compression.py).
+    def __init__(self, backend=None, store_check=None, compressor=None):
+        self.backend = backend
+        self.store_check = store_check
+        self.compressor = compressor
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    # Serves a route from the cache, or runs it and caches its 200 response with the tags it added.
+    # Apply it below @requires_auth so permissions are checked before anything is served, and below
+    # @conditional so the data versions are part of the key (see cache_key()).
+    # With a compressor, responses large enough to compress are stored compressed under
+    # '<encoding>:<key>', and the rest under the key, so clients that negotiate an encoding look for
+    # the compressed entry first. When only the uncompressed entry is there (an identity client came
+    # first), it is compressed once and stored under '<encoding>:<key>' with the same tags.
+    def cached(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self.backend is None:
+                return f(*args, **kwargs)
+
+            key = cache_key()
+            encoding = self.compressor.negotiate() if self.compressor is not None else None
+            if encoding is not None:
+                body = self.backend.get(encoding + ':' + key)
+                if body is not None:
+                    self.hits += 1
+                    response = Response(status=200, mimetype='application/json')
+                    set_encoded(response, body, encoding)
+                    return response
+            epoch = self.backend.epoch()
+            body = self.backend.get(key)
+            if body is not None:
+                self.hits += 1
+                response = Response(body, status=200, mimetype='application/json')
+                if encoding is not None:
+                    self.store_encoded(response, key, body, encoding, epoch)
+                return response
+
+            self.misses += 1
+            g.cache_tags = set()
+            try:
+                response = f(*args, **kwargs)
+                body, status = response if isinstance(response, tuple) else (response, 200)
+                if status == 200 and isinstance(body, Response) and (self.store_check is None or self.store_check()):
+                    data = body.get_data()
+                    if encoding is not None and self.compressor.compressible(body):
+                        compressed = self.compressor.compress(data, encoding)
+                        if compressed is not None:
+                            set_encoded(body, compressed, encoding)
+                            key, data = encoding + ':' + key, compressed
+                    if self.backend.set(key, data, frozenset(g.cache_tags), epoch):
+                        self.stores += 1
+            finally:
+                g.pop('cache_tags', None)
+            return response
+        return wrapper
+
+    # Compresses the uncompressed entry body into response and stores it under '<encoding>:<key>'.
+    def store_encoded(self, response, key, body, encoding, epoch):
+        compressed = self.compressor.compress(body, encoding)
+        if compressed is None:
+            return
+        set_encoded(response, compressed, encoding)
+        tags = self.backend.entry_tags(key)
+        if tags is not None and self.backend.set(encoding + ':' + key, compressed, tags, epoch):
+            self.stores += 1
+
+    def invalidate(self, tags):
+        if self.backend is not None and tags:
+            self.invalidations += 1
+            self.backend.invalidate(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'stores': self.stores,
+            'invalidations': self.invalidations,
+        }
+
+
+response_cache = ResponseCache(LRUBackend())
+
+
+# The request's path and query string, and the versions @conditional read for it, like '/teams?@players7-teams3'.
+def cache_key():
+    key = request.full_path
+    versions = g.get('data_versions')
+    if versions:
+        key += '@' + '-'.join('{}{}'.format(scope, versions[scope][0]) for scope in sorted(versions))
+    return key
+
+
+# Tags the response being built by the current request with the rows it shows.
+def add_tags(*tags):
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+
+def team_tag(team_id):
+    return 'team:none' if team_id is None else 'team:{}'.format(team_id)
+
+
+# Invalidates tags now and again once the session commits.
+def invalidate_after_commit(session, *tags):
+    response_cache.invalidate(tags)
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+# Tags for rows written by a bulk insert, which does not fire the mapper events.
+def player_row_tags(rows):
+    tags = {'players:list'}
+    for row in rows:
+        tags.add(team_tag(row.get('team_id')))
+        tags.add('position:{}'.format(row.get('position')))
+    return tags
+
+def _history(target, attribute):
+    history = inspect(target).attrs[attribute].history
+    return set(history.deleted) | set(history.added) | set(history.unchanged)
+
+
+@event.listens_for(Team, 'after_insert')
+def team_inserted(mapper, connection, target):
+    invalidate_after_commit(object_session(target), 'teams:list', team_tag(target.id))
+
+@event.listens_for(Team, 'after_update')
+def team_updated(mapper, connection, target):
+    invalidate_after_commit(object_session(target), team_tag(target.id))
+
+@event.listens_for(Team, 'after_delete')
+def team_deleted(mapper, connection, target):
+    invalidate_after_commit(object_session(target), 'teams:list', team_tag(target.id))
+
+@event.listens_for(Player, 'after_insert')
+def player_inserted(mapper, connection, target):
+    invalidate_after_commit(object_session(target), 'players:list', team_tag(target.team_id),
+                            'position:{}'.format(target.position))
+
+# A player's old and new team and position both change, so both sides are invalidated.
+@event.listens_for(Player, 'after_update')
+def player_updated(mapper, connection, target):
+    tags = {'player:{}'.format(target.id)}
+    tags.update(team_tag(team_id) for team_id in _history(target, 'team_id'))
+    tags.update('position:{}'.format(position) for position in _history(target, 'position'))
+    if inspect(target).attrs['height_inches'].history.has_changes():
+        tags.add('players:height')
+    invalidate_after_commit(object_session(target), *tags)
+
+@event.listens_for(Player, 'after_delete')
+def player_deleted(mapper, connection, target):
+    invalidate_after_commit(object_session(target), 'players:list', 'player:{}'.format(target.id),
+                            team_tag(target.team_id), 'position:{}'.format(target.position))
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        response_cache.invalidate(tags)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_rolled_back(session, previous_transaction):
+    session.info.pop('cache_tags', None)
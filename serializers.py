@@ -0,0 +1,100 @@
+import time
+
+from flask import current_app, jsonify
+
+from metrics import record_timing
+from models import db, Team, Player
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FREE_AGENT = 'Free Agent'
+
+# Serializers for the list reads. They work on the column tuples (SQLAlchemy Rows) of queries that
+# select only what a response shows, so large pages skip ORM identity-map bookkeeping and attribute
+# instrumentation, and they build the same dicts as Team.format(), Player.short() and Player.long().
+
+
+# Sparse fieldsets (?fields=id,name). Each read endpoint accepts a whitelist of fields and selects only the
+# columns those fields are read from: players join teams only for 'team', and team reads load rosters only
+# for 'players'. Player.id and Team.id are always selected, for pagination cursors and cache tags.
+TEAM_FIELDS = ('id', 'name', 'players')
+PLAYER_FIELDS = ('id', 'name', 'position', 'height', 'team')
+PLAYER_SHORT_FIELDS = ('id', 'name', 'team')
+
+PLAYER_VALUES = {
+    'id': lambda row: row.id,
+    'name': lambda row: row.name,
+    'position': lambda row: row.position,
+    'height': lambda row: row.height,
+    'team': lambda row: FREE_AGENT if row.team_id is None else row.team_name,
+}
+
+
+# A column query for the given player fields, with the teams join only when 'team' is one of them.
+def player_query(fields):
+    columns = [Player.id]
+    for field in fields:
+        if field == 'team':
+            columns += [Player.team_id, Team.name.label('team_name')]
+        elif field != 'id':
+            columns.append(getattr(Player, field))
+    query = db.session.query(*columns)
+    if 'team' in fields:
+        query = query.outerjoin(Team, Player.team_id == Team.id)
+    return query
+
+
+# Player dicts with the given fields, from rows of player_query(fields).
+def player_dicts(rows, fields):
+    values = [(field, PLAYER_VALUES[field]) for field in fields]
+    return [{field: value(row) for field, value in values} for row in rows]
+
+
+# teams are rows with id and name and rosters (team_id, player name) rows ordered by player id.
+# With fields, name and rosters are only needed for the fields listed.
+def team_dicts(teams, rosters, fields=TEAM_FIELDS):
+    names = {team.id: [] for team in teams}
+    for team_id, name in rosters:
+        names[team_id].append(name)
+    values = {'id': lambda team: team.id, 'name': lambda team: team.name, 'players': lambda team: names[team.id]}
+    return [{field: values[field](team) for field in fields} for team in teams]
+
+
+def player_short(player_id, name, team_id, team_name):
+    return {
+        'id': player_id,
+        'name': name,
+        'team': FREE_AGENT if team_id is None else team_name,
+    }
+
+
+def player_long(player_id, name, position, height, team_name):
+    return {
+        'id': player_id,
+        'name': name,
+        'position': position,
+        'height': height,
+        'team': FREE_AGENT if team_name is None else team_name,
+    }
+
+
+# Like jsonify(), but encodes with orjson (in requirements.txt; jsonify() is the fallback without it).
+# The output is byte-for-byte what jsonify() produces in production (sorted keys, compact separators,
+# trailing newline). orjson writes non-ASCII text as UTF-8 where jsonify() escapes it, so those
+# payloads, and everything in debug mode where jsonify() indents, go through jsonify() instead.
+# Only use it for payloads of strings, integers, booleans, None, lists and dicts: orjson formats
+# floats and dates differently.
+def json_response(payload):
+    if orjson is None or current_app.debug:
+        return jsonify(payload)
+
+    start = time.perf_counter()
+    body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    if not body.isascii():
+        return jsonify(payload)
+    response = current_app.response_class(body + b'\n', mimetype='application/json')
+    record_timing('serialize', time.perf_counter() - start)
+    return response
@@ -0,0 +1,129 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger('bball.slow_query')
+
+MAX_PARAMETER_LENGTH = 500
+
+
+# Logs every statement slower than threshold_ms with its SQL, bind parameters, endpoint, duration and
+# database, on each of engines ({name: engine}, e.g. the primary and the read replicas).
+# A sample of slow SELECTs (explain_sample, 0 to 1) is also run through EXPLAIN (ANALYZE, BUFFERS) on
+# PostgreSQL, or EXPLAIN QUERY PLAN on SQLite, on a background thread with its own connection to the same
+# database, and the plan is logged with a flag for sequential scans. At most max_pending plans are queued
+# at a time. Nothing is hooked into the engines when the log is disabled, so it costs nothing then.
+class SlowQueryLog:
+    def __init__(self, engines, threshold_ms, explain_sample=0.0, max_pending=4):
+        self.engines = dict(engines)
+        self.names = {engine: name for name, engine in self.engines.items()}
+        self.threshold = threshold_ms / 1000
+        self.explain_sample = explain_sample
+        self.max_pending = max_pending
+
+        self.logged = 0
+        self.explained = 0
+        self.skipped_explains = 0
+
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+        for engine in self.engines.values():
+            event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def close(self):
+        for engine in self.engines.values():
+            event.remove(engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', self.after_cursor_execute)
+        self._executor.shutdown(wait=True)
+
+    # Waits for queued EXPLAINs to finish, for tests and shutdown.
+    def flush(self):
+        for _ in range(self.max_pending):
+            self._pending.acquire()
+        for _ in range(self.max_pending):
+            self._pending.release()
+
+    # Kept on the execution context, like the metrics timing, so a statement that raises leaves nothing behind.
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._slow_query_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_slow_query_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed < self.threshold or conn.info.get('slow_query_explain'):
+            return
+
+        entry = {
+            'duration_ms': round(elapsed * 1000, 2),
+            'endpoint': request.endpoint if has_request_context() else None,
+            'statement': statement,
+            'parameters': format_parameters(parameters),
+            'database': self.names.get(conn.engine),
+        }
+        self.logged += 1
+        logger.warning('slow query %s', json.dumps(entry))
+
+        if self.should_explain(conn, statement, executemany):
+            if self._pending.acquire(blocking=False):
+                self._executor.submit(self.explain, conn.engine, statement, parameters, entry)
+            else:
+                self.skipped_explains += 1
+
+    def should_explain(self, conn, statement, executemany):
+        return (
+            not executemany
+            and conn.dialect.name in ('postgresql', 'sqlite')
+            and statement.lstrip().upper().startswith('SELECT')
+            and random.random() < self.explain_sample
+        )
+
+    # EXPLAIN ANALYZE runs the statement again, so it happens inside a transaction that is rolled back.
+    def explain(self, engine, statement, parameters, entry):
+        try:
+            if engine.dialect.name == 'postgresql':
+                explain_sql = 'EXPLAIN (ANALYZE, BUFFERS) ' + statement
+            else:
+                explain_sql = 'EXPLAIN QUERY PLAN ' + statement
+            with engine.connect() as conn:
+                conn.info['slow_query_explain'] = True
+                try:
+                    rows = conn.exec_driver_sql(explain_sql, parameters).fetchall()
+                    conn.rollback()
+                finally:
+                    conn.info.pop('slow_query_explain', None)
+
+            plan = '\n'.join(str(row[-1]) for row in rows)
+            self.explained += 1
+            logger.warning('slow query plan %s', json.dumps({
+                **entry,
+                'plan': plan,
+                'seq_scan': 'Seq Scan' in plan or any(line.startswith('SCAN ') for line in plan.splitlines()),
+            }))
+        except Exception:
+            logger.exception('could not explain slow query')
+        finally:
+            self._pending.release()
+
+    def stats(self):
+        return {
+            'logged': self.logged,
+            'explained': self.explained,
+            'skipped_explains': self.skipped_explains,
+        }
+
+
+def format_parameters(parameters):
+    text = repr(parameters)
+    if len(text) > MAX_PARAMETER_LENGTH:
+        text = text[:MAX_PARAMETER_LENGTH] + '...'
+    return text
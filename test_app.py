@@ -1,8 +1,31 @@
+import gzip
 import os
 import unittest
 import json
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import config
+import models
+import serializers
+from flask import jsonify
+from admission import AdmissionClass, rate_limiter
+from auth import token_cache
+from idempotency import DatabaseStore, MemoryStore
 from app import create_app
-from models import db_drop_and_create_all
+from jwks import JWKSKeyStore
+from metrics import POOL_CHECKOUT_WAIT
+from league_stats import PERCENTILES, height_summary
+from token_cache import TokenCache
+from sqlalchemy import create_engine, event, inspect, update
+from sqlalchemy.pool import NullPool
+from models import db, bump_versions, count_queries, database_engines, db_drop_and_create_all, migrate_db, parse_height, Team, Player
+from response_cache import response_cache, RedisBackend, LocalRedis
+from replicas import ReplicaRouter
+from slow_queries import SlowQueryLog
 
 auth_header_admin = {'Authorization': os.environ['ADMIN_TOKEN']}
 auth_header_analyst = {'Authorization': os.environ['ANALYST_TOKEN']}
@@ -255,5 +278,1554 @@ class ManagerTestCase(unittest.TestCase):
         self.assertEqual(data['player']['name'], 'Vince Carter')
         self.assertEqual(data['player']['team'], 'Free Agent')
 
+
+class SeededAppTestCase(unittest.TestCase):
+
+    # Sets up a freshly seeded testing app for the test case
+    @classmethod
+    def setUpClass(self):
+        self.database_name = 'bball_test'
+        self.database_path = 'postgresql://{}:{}@{}/{}'.format('postgres', 'abc', 'localhost:5432', self.database_name)
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path
+        })
+        self.client = self.app.test_client
+
+
+class AdmissionTestCase(SeededAppTestCase):
+
+    # A full class queues requests up to its queue size and sheds them once they wait too long
+    def test_admission_class_queue(self):
+        admission_class = AdmissionClass('read', limit=1, queue_size=1, queue_timeout=0.05)
+        self.assertTrue(admission_class.acquire())
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(admission_class.acquire()))
+        waiter.start()
+        while admission_class.stats()['queued'] == 0:
+            pass
+        self.assertFalse(admission_class.acquire())
+        waiter.join()
+
+        self.assertEqual(results, [False])
+        self.assertEqual((admission_class.shed_queue_full, admission_class.shed_timeout), (1, 1))
+
+        waiter = threading.Thread(target=lambda: results.append(admission_class.acquire()))
+        waiter.start()
+        admission_class.release()
+        waiter.join()
+        self.assertEqual(results, [False, True])
+
+    # Shed requests get a 503 with Retry-After; writes, health checks and metrics are not affected
+    def test_shed_reads(self):
+        read = self.app.extensions['admission'].classes['read']
+        with mock.patch.object(read, 'limit', 0), mock.patch.object(read, 'queue_size', 0):
+            res = self.client().get('/teams', headers=auth_header_admin)
+            data = json.loads(res.data)
+            health = self.client().get('/health')
+            metrics = self.client().get('/metrics').get_data(as_text=True)
+            write = self.client().post('/teams', json={'name': 'Admitted Team', 'players': []},
+                                       headers=auth_header_admin)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['message'], 'unavailable')
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(health.status_code, 200)
+        self.assertIn('bball_admission_read_shed 1', metrics)
+        self.assertIn('bball_admission_read_queued 0', metrics)
+        self.assertEqual(write.status_code, 200)
+        self.assertEqual(read.stats()['active'], 0)
+
+    # The defaults budget every thread, streams and queues included, and leave reads a queue
+    def test_default_limits(self):
+        environ = {key: value for key, value in os.environ.items() if not key.startswith(('GUNICORN_', 'ADMISSION'))}
+        environ['DATABASE_URL'] = 'sqlite:////nonexistent/bball.db'
+        for threads, expected in (('16', {'read': (8, 1), 'write': (4, 1), 'stream': (2, 0)}),
+                                  (None, {'read': (3, 1), 'write': (2, 1), 'stream': (1, 0)})):
+            with mock.patch.dict(os.environ, environ, clear=True):
+                if threads is not None:
+                    os.environ['GUNICORN_THREADS'] = threads
+                app = create_app()
+            classes = app.extensions['admission'].classes
+            self.assertEqual({name: (admission_class.limit, admission_class.queue_size)
+                              for name, admission_class in classes.items()}, expected)
+            self.assertEqual(sum(sum(limits) for limits in expected.values()), int(threads or 8))
+            self.assertEqual(app.extensions['change_feed'].max_streams, expected['stream'][0])
+
+        read = classes['read']
+        for _ in range(read.limit):
+            self.assertTrue(read.acquire())
+        try:
+            with mock.patch.object(read, 'queue_timeout', 0.05):
+                res = app.test_client().get('/teams')
+            health = app.test_client().get('/health')
+        finally:
+            for _ in range(read.limit):
+                read.release()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(read.shed_timeout, 1)
+        self.assertEqual(health.status_code, 200)
+
+    # Exports and change streams share the stream class, so they can't take the threads of ordinary reads
+    def test_shed_streams(self):
+        stream = self.app.extensions['admission'].classes['stream']
+        with mock.patch.object(stream, 'limit', 0):
+            export = self.client().get('/players/export', headers=auth_header_admin)
+            changes = self.client().get('/changes/stream', headers=auth_header_admin, buffered=True)
+            teams = self.client().get('/teams', headers=auth_header_admin)
+
+        self.assertEqual(export.status_code, 503)
+        self.assertEqual(changes.status_code, 503)
+        self.assertEqual(changes.headers['Retry-After'], '30')
+        self.assertEqual(teams.status_code, 200)
+        self.assertEqual(stream.stats()['shed_queue_full'], 2)
+
+    # Requests are rate limited per token subject
+    def test_rate_limit_per_subject(self):
+        with mock.patch.object(rate_limiter, 'per_minute', 60), mock.patch.object(rate_limiter, 'burst', 2), \
+                mock.patch.object(rate_limiter, 'buckets', {}):
+            statuses = [self.client().get('/teams', headers=auth_header_admin).status_code for _ in range(3)]
+            limited = self.client().get('/teams', headers=auth_header_admin)
+            other = self.client().get('/teams', headers=auth_header_analyst)
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(limited.headers['Retry-After'], '1')
+        self.assertEqual(other.status_code, 200)
+
+
+class BatchTestCase(SeededAppTestCase):
+
+    # POST '/batch' runs every operation and commits the ones that succeed together
+    def test_batch_operations(self):
+        player = Player(name='Batch Player', position='Guard', height="6'1", team_id=None)
+        player.insert()
+        player_id = player.id
+
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'create', 'resource': 'teams', 'data': {'name': 'Batch Team'}},
+            {'op': 'update', 'resource': 'players', 'id': player_id, 'data': {'position': 'Center'}},
+            {'op': 'update', 'resource': 'players', 'id': 999999, 'data': {'position': 'Center'}},
+            {'op': 'create', 'resource': 'teams', 'data': {}},
+            {'op': 'delete', 'resource': 'players', 'id': player_id},
+        ]}, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['status'] for result in data['results']], [200, 200, 404, 422, 200])
+        self.assertEqual((data['succeeded'], data['failed']), (3, 2))
+        self.assertEqual(data['results'][1]['player']['position'], 'Center')
+        self.assertEqual(Team.query.filter_by(name='Batch Team').count(), 1)
+        self.assertIsNone(db.session.get(Player, player_id))
+
+    # An atomic batch is rolled back entirely when one operation fails
+    def test_atomic_batch_rolls_back(self):
+        res = self.client().post('/batch', json={'atomic': True, 'operations': [
+            {'op': 'create', 'resource': 'teams', 'data': {'name': 'Atomic Team'}},
+            {'op': 'delete', 'resource': 'teams', 'id': 999999},
+        ]}, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertTrue(data['results'][0]['rolled_back'])
+        self.assertEqual(data['results'][1]['status'], 404)
+        self.assertEqual(Team.query.filter_by(name='Atomic Team').count(), 0)
+
+    # Each operation is checked against the token's permissions
+    def test_batch_checks_permissions(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'create', 'resource': 'teams', 'data': {'name': 'Analyst Team'}},
+        ]}, headers=auth_header_analyst)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['status'], 403)
+        self.assertEqual(Team.query.filter_by(name='Analyst Team').count(), 0)
+
+    # Boolean ids are not ids: true doesn't address row 1
+    def test_batch_rejects_boolean_id(self):
+        res = self.client().post('/batch', json={'operations': [
+            {'op': 'update', 'resource': 'teams', 'id': True, 'data': {'name': 'Renamed By Boolean'}},
+        ]}, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['results'][0]['status'], 404)
+        self.assertEqual(Team.query.filter_by(name='Renamed By Boolean').count(), 0)
+
+    def test_422_batch_without_operations(self):
+        res = self.client().post('/batch', json={'operations': []}, headers=auth_header_admin)
+        self.assertEqual(res.status_code, 422)
+
+
+class BulkCreateTestCase(SeededAppTestCase):
+
+    # POST '/teams/bulk' creates every team and returns them in request order
+    def test_create_teams_bulk(self):
+        teams = [{'name': 'Bulk Team {}'.format(i)} for i in range(5)]
+        res = self.client().post('/teams/bulk', json=teams, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 5)
+        self.assertEqual([team['name'] for team in data['teams']], [team['name'] for team in teams])
+        self.assertIn('elapsed_ms', data)
+
+    # POST '/players/bulk' creates every player with its team name
+    def test_create_players_bulk(self):
+        players = [
+            {'name': 'Bulk Player 1', 'position': 'Center', 'height': "7'1", 'team_id': 1},
+            {'name': 'Bulk Player 2', 'position': 'Guard', 'height': "6'1"},
+        ]
+        res = self.client().post('/players/bulk', json={'players': players}, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['players'][0]['team'], 'Heat')
+        self.assertEqual(data['players'][1]['team'], 'Free Agent')
+
+    # An invalid item rejects the whole batch with per-item errors
+    def test_422_create_players_bulk_invalid_item(self):
+        players = [
+            {'name': 'Valid Player', 'position': 'Center', 'height': "7'1"},
+            {'name': 'No Team Player', 'position': 'Center', 'height': "7'1", 'team_id': 999},
+            {'name': 'No Height Player', 'position': 'Center'},
+        ]
+        count = Player.query.count()
+        res = self.client().post('/players/bulk', json=players, headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([error['index'] for error in data['errors']], [1, 2])
+        self.assertEqual(Player.query.count(), count)
+
+    # Duplicate team names are rejected before anything is inserted
+    def test_422_create_teams_bulk_duplicate_name(self):
+        res = self.client().post('/teams/bulk', json=[{'name': 'Heat'}, {'name': 'Lakers'}, {'name': 'Lakers'}],
+                                 headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([error['index'] for error in data['errors']], [0, 2])
+
+    # The analyst role cannot create in bulk
+    def test_403_analyst_create_teams_bulk(self):
+        res = self.client().post('/teams/bulk', json=[{'name': 'Lakers'}], headers=auth_header_analyst)
+
+        self.assertEqual(res.status_code, 403)
+
+
+class ChangeFeedTestCase(SeededAppTestCase):
+
+    def changes(self, since):
+        res = self.client().get('/changes?since={}'.format(since), headers=auth_header_admin)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def cursor(self):
+        return json.loads(self.client().get('/changes', headers=auth_header_admin).data)['cursor']
+
+    # GET '/changes' returns inserts, updates and deletes after the cursor, with each row as it is now
+    def test_changes_since_cursor(self):
+        cursor = self.cursor()
+        player_id = json.loads(self.client().post('/players', json=new_player, headers=auth_header_admin).data)['player']['id']
+        self.client().patch('/players/{}'.format(player_id), json={'team_id': 1}, headers=auth_header_admin)
+        self.client().delete('/players/{}'.format(player_id), headers=auth_header_admin)
+        data = self.changes(cursor)
+
+        self.assertEqual([(change['resource'], change['resource_id'], change['op']) for change in data['changes']],
+                         [('players', player_id, 'insert'), ('players', player_id, 'update'),
+                          ('players', player_id, 'delete')])
+        self.assertEqual([change['data'] for change in data['changes']], [None, None, None])
+        self.assertEqual(data['cursor'], data['changes'][-1]['id'])
+        self.assertEqual(self.changes(data['cursor'])['changes'], [])
+
+        team_id = json.loads(self.client().post('/teams', json={'name': 'Change Team', 'players': []},
+                                                headers=auth_header_admin).data)['team']['id']
+        change = self.changes(data['cursor'])['changes'][0]
+        self.assertEqual(change['data'], {'id': team_id, 'name': 'Change Team'})
+
+    # Set-based writes (roster replacement, team deletion, bulk creates) are logged too
+    def test_set_based_writes_are_logged(self):
+        team_id = json.loads(self.client().post('/teams/bulk', json=[{'name': 'Bulk Change Team'}],
+                                                headers=auth_header_admin).data)['teams'][0]['id']
+        players = json.loads(self.client().post('/players/bulk', json=[
+            {'name': 'Change {}'.format(i), 'position': 'Guard', 'height': "6'0"} for i in range(2)
+        ], headers=auth_header_admin).data)['players']
+        player_ids = [player['id'] for player in players]
+        cursor = self.cursor()
+
+        self.client().put('/teams/{}/roster'.format(team_id), json=player_ids, headers=auth_header_admin)
+        self.client().delete('/teams/{}'.format(team_id), headers=auth_header_admin)
+        changes = self.changes(cursor)['changes']
+
+        self.assertEqual([(change['resource_id'], change['op']) for change in changes],
+                         [(player_ids[0], 'update'), (player_ids[1], 'update'), (player_ids[0], 'update'),
+                          (player_ids[1], 'update'), (team_id, 'delete')])
+        self.assertIsNone(changes[0]['data']['team_id'])
+
+    # Operations rolled back in a batch savepoint leave nothing in the log
+    def test_rolled_back_operations_are_not_logged(self):
+        cursor = self.cursor()
+        self.client().post('/batch', json={'operations': [
+            {'op': 'create', 'resource': 'teams', 'data': {'name': 'Logged Team'}},
+            {'op': 'create', 'resource': 'teams', 'data': {'name': 'Logged Team'}},
+        ]}, headers=auth_header_admin)
+
+        changes = self.changes(cursor)['changes']
+        self.assertEqual([(change['resource'], change['op']) for change in changes], [('teams', 'insert')])
+
+    # Compaction keeps the newest change per row and expires old deletes; older cursors get a 410
+    def test_compaction(self):
+        cursor = self.cursor()
+        player = Player(name='Compacted Player', position='Guard', height="6'0", team_id=None)
+        player.insert()
+        player.position = 'Center'
+        player.update()
+        deleted = Player(name='Deleted Player', position='Guard', height="6'0", team_id=None)
+        deleted.insert()
+        deleted.delete()
+
+        result = self.app.test_cli_runner().invoke(args=['compact-changes'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        changes = self.changes(cursor)['changes']
+        self.assertEqual([(change['resource_id'], change['op']) for change in changes],
+                         [(player.id, 'update'), (deleted.id, 'delete')])
+        self.assertEqual(changes[0]['data']['position'], 'Center')
+
+        result = self.app.test_cli_runner().invoke(args=['compact-changes', '--retention-days', '-1'])
+        self.assertIn('1 expired deletes', result.output)
+        res = self.client().get('/changes?since={}'.format(cursor), headers=auth_header_admin)
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(self.changes(self.cursor())['changes'], [])
+
+    # GET '/changes/stream' sends the changes as server-sent events, resuming after Last-Event-ID
+    def test_change_stream(self):
+        cursor = self.cursor()
+        team = Team(name='Streamed Team', players=[])
+        team.insert()
+        feed = self.app.extensions['change_feed']
+        with mock.patch.object(feed, 'stream_seconds', 0):
+            res = self.client().get('/changes/stream', headers={**auth_header_admin, 'Last-Event-ID': str(cursor)},
+                                    buffered=True)
+            body = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = [event for event in body.split('\n\n') if event.startswith('id: ')]
+        self.assertEqual(len(events), 1)
+        event_id, event_type, data = events[0].split('\n')
+        self.assertEqual(event_type, 'event: change')
+        self.assertEqual(json.loads(data[len('data: '):])['data'], {'id': team.id, 'name': 'Streamed Team'})
+        self.assertEqual(int(event_id[len('id: '):]), self.cursor())
+
+    # Streams past the worker's limit get a 503 with Retry-After, and closed streams give their slot back
+    def test_change_stream_limit(self):
+        feed = self.app.extensions['change_feed']
+        headers = {**auth_header_admin, 'Last-Event-ID': str(self.cursor())}
+        stream = self.app.extensions['admission'].classes['stream']
+        with mock.patch.object(feed, 'stream_seconds', 0), mock.patch.object(feed, 'max_streams', 1), \
+                mock.patch.object(stream, 'limit', 2):
+            first = self.client().get('/changes/stream', headers=headers, buffered=False)
+            refused = self.client().get('/changes/stream', headers=headers, buffered=True)
+            first.get_data()
+            first.close()
+            again = self.client().get('/changes/stream', headers=headers, buffered=True)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(refused.status_code, 503)
+        self.assertEqual(refused.headers['Retry-After'], '30')
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(feed.stats()['open_streams'], 0)
+        self.assertEqual(feed.stats()['refused'], 1)
+
+    def test_400_changes_with_invalid_cursor(self):
+        res = self.client().get('/changes?since=abc', headers=auth_header_admin)
+        self.assertEqual(res.status_code, 400)
+
+
+class CompressionTestCase(SeededAppTestCase):
+
+    def setUp(self):
+        response_cache.clear()
+        self.compressor = response_cache.compressor
+        patcher = mock.patch.object(self.compressor, 'min_size', 100)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Responses above the size threshold are compressed with an encoding the client accepts
+    def test_gzip_response(self):
+        plain = self.client().get('/teams/1', headers=auth_header_admin)
+        res = self.client().get('/teams/1', headers={**auth_header_admin, 'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    # Small responses, refused encodings and streamed responses are sent as they are
+    def test_uncompressed_responses(self):
+        small = self.client().get('/teams?fields=id', headers={**auth_header_admin, 'Accept-Encoding': 'gzip'})
+        refused = self.client().get('/teams/1', headers={**auth_header_admin, 'Accept-Encoding': 'gzip;q=0'})
+        streamed = self.client().get('/players/export', headers={**auth_header_admin, 'Accept-Encoding': 'gzip'})
+
+        for res in (small, refused, streamed):
+            self.assertEqual(res.status_code, 200)
+            self.assertIsNone(res.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', small.headers['Vary'])
+
+    # The response cache stores the compressed bytes, so repeated requests aren't compressed again
+    def test_cache_holds_compressed_bytes(self):
+        headers = {**auth_header_admin, 'Accept-Encoding': 'gzip, deflate'}
+        first = self.client().get('/players', headers=headers)
+        compressed = self.compressor.stats()['compressed']
+        hits = response_cache.hits
+        second = self.client().get('/players', headers=headers)
+
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertEqual(self.compressor.stats()['compressed'], compressed)
+
+        plain = self.client().get('/players', headers=auth_header_admin)
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(plain.data, gzip.decompress(first.data))
+
+    # An entry cached for an identity client first is compressed once, then served compressed from the cache
+    def test_identity_entry_compressed_once(self):
+        for backend in (response_cache.backend, RedisBackend(LocalRedis())):
+            with mock.patch.object(response_cache, 'backend', backend):
+                response_cache.clear()
+                plain = self.client().get('/players', headers=auth_header_admin)
+                compressed = self.compressor.stats()['compressed']
+                responses = [self.client().get('/players', headers={**auth_header_admin, 'Accept-Encoding': 'gzip'})
+                             for _ in range(3)]
+
+                self.assertEqual(self.compressor.stats()['compressed'], compressed + 1)
+                for res in responses:
+                    self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+                    self.assertEqual(gzip.decompress(res.data), plain.data)
+
+                self.client().patch('/players/1', json={'name': 'LeBron James'}, headers=auth_header_admin)
+                res = self.client().get('/players', headers={**auth_header_admin, 'Accept-Encoding': 'gzip'})
+                self.assertIn(b'LeBron James', gzip.decompress(res.data))
+
+
+class ConditionalGetTestCase(SeededAppTestCase):
+
+    # A matching If-None-Match gets a 304 without the rows being loaded
+    def test_304_if_none_match(self):
+        res = self.client().get('/teams', headers=auth_header_admin)
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Last-Modified', res.headers)
+
+        with count_queries() as statements:
+            res = self.client().get('/teams', headers={**auth_header_admin, 'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(len(statements), 1)
+
+    # A write changes the ETag of the list and detail endpoints
+    def test_etag_changes_after_write(self):
+        etag = self.client().get('/players/1', headers=auth_header_admin).headers['ETag']
+
+        self.client().patch('/teams/1', json={'name': 'Miami Heat'}, headers=auth_header_admin)
+        res = self.client().get('/players/1', headers={**auth_header_admin, 'If-None-Match': etag})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['player']['team'], 'Miami Heat')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # A current If-Modified-Since gets a 304
+    def test_304_if_modified_since(self):
+        last_modified = self.client().get('/teams/1', headers=auth_header_admin).headers['Last-Modified']
+        res = self.client().get('/teams/1', headers={**auth_header_admin, 'If-Modified-Since': last_modified})
+
+        self.assertEqual(res.status_code, 304)
+
+    # Permissions are still checked before a 304 is returned
+    def test_401_if_none_match_without_authorization(self):
+        etag = self.client().get('/players', headers=auth_header_admin).headers['ETag']
+        res = self.client().get('/players', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 401)
+
+
+class ExportTestCase(SeededAppTestCase):
+
+    def read_ndjson(self, res):
+        return [json.loads(line) for line in res.data.decode().splitlines()]
+
+    # GET '/players/export' streams one JSON object per player
+    def test_export_players(self):
+        res = self.client().get('/players/export', headers=auth_header_admin)
+        rows = self.read_ndjson(res)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3])
+        self.assertEqual(rows[0]['team'], 'Heat')
+        self.assertIsNone(rows[2]['team_id'])
+
+    # GET '/players/export' with since only streams newer players
+    def test_export_players_since(self):
+        res = self.client().get('/players/export?since=2', headers=auth_header_admin)
+        rows = self.read_ndjson(res)
+
+        self.assertEqual([row['name'] for row in rows], ['Luka Doncic'])
+
+    # GET '/teams/export' streams one JSON object per team
+    def test_export_teams(self):
+        res = self.client().get('/teams/export', headers=auth_header_analyst)
+        rows = self.read_ndjson(res)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([row['name'] for row in rows], ['Heat', 'Knicks', 'Nets'])
+
+
+class FieldsetTestCase(SeededAppTestCase):
+
+    # GET '/players?fields=' returns only the requested fields and only joins teams for 'team'
+    def test_players_fields(self):
+        with count_queries() as statements:
+            res = self.client().get('/players?fields=id,name', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['players'][0], {'id': 1, 'name': 'Lebron James'})
+        self.assertFalse(any('JOIN teams' in statement for statement in statements))
+
+        data = json.loads(self.client().get('/players?fields=height,team', headers=auth_header_admin).data)
+        self.assertEqual(data['players'][2], {'height': "6'7", 'team': 'Free Agent'})
+
+    # GET '/teams?fields=' skips the roster query unless 'players' is requested
+    def test_teams_fields(self):
+        with count_queries() as statements:
+            res = self.client().get('/teams?fields=name', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['teams'], [{'name': 'Heat'}, {'name': 'Knicks'}, {'name': 'Nets'}])
+        self.assertFalse(any('FROM players' in statement for statement in statements))
+
+    # Detail endpoints take fields too
+    def test_detail_fields(self):
+        team = json.loads(self.client().get('/teams/1?fields=id,name', headers=auth_header_admin).data)
+        player = json.loads(self.client().get('/players/1?fields=position', headers=auth_header_admin).data)
+
+        self.assertEqual(team, {'success': True, 'id': 1, 'name': 'Heat'})
+        self.assertEqual(player['player'], {'position': 'Small Forward'})
+        self.assertEqual(self.client().get('/teams/999?fields=name', headers=auth_header_admin).status_code, 404)
+
+    # Exports stream only the requested fields
+    def test_export_fields(self):
+        res = self.client().get('/players/export?fields=id,team', headers=auth_header_admin)
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(rows[0], {'id': 1, 'team': 'Heat'})
+
+    # Fields outside the endpoint's whitelist are rejected
+    def test_400_unknown_field(self):
+        for path in ('/players?fields=id,salary', '/teams?fields=position', '/players/1?fields=password',
+                     '/teams/export?fields=players'):
+            res = self.client().get(path, headers=auth_header_admin)
+            self.assertEqual(res.status_code, 400, path)
+
+
+class IdempotencyTestCase(SeededAppTestCase):
+
+    def post_player(self, key, player=new_player):
+        return self.client().post('/players', json=player, headers={**auth_header_admin, 'Idempotency-Key': key})
+
+    # A repeated key gets the stored response back without touching the players table
+    def test_replay(self):
+        with self.app.app_context():
+            before = Player.query.count()
+        first = self.post_player('replay-1')
+        with count_queries() as statements:
+            second = self.post_player('replay-1')
+        with self.app.app_context():
+            after = Player.query.count()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertFalse(any('players' in statement or 'teams' in statement for statement in statements))
+        self.assertEqual(after, before + 1)
+
+    # Reusing a key with another body is a 422, and a key whose request is still running is a 409
+    def test_mismatch_and_in_progress(self):
+        self.post_player('mismatch-1')
+        mismatch = self.post_player('mismatch-1', player=new_player2)
+
+        started, finish, results = threading.Event(), threading.Event(), []
+        insert = Player.insert
+
+        def slow_insert(player):
+            started.set()
+            finish.wait(5)
+            insert(player)
+
+        write = self.app.extensions['admission'].classes['write']
+        with mock.patch.object(Player, 'insert', slow_insert), mock.patch.object(write, 'limit', 2):
+            first = threading.Thread(target=lambda: results.append(self.post_player('running-1', player=new_player2)))
+            first.start()
+            started.wait(5)
+            running = self.post_player('running-1', player=new_player2)
+            finish.set()
+            first.join()
+
+        self.assertEqual(mismatch.status_code, 422)
+        self.assertEqual(running.status_code, 409)
+        self.assertEqual(running.headers['Retry-After'], '1')
+        self.assertEqual(results[0].status_code, 200)
+        self.assertEqual(self.post_player('running-1', player=new_player2).data, results[0].data)
+
+    # Failed requests give their key up, and taken team names are rejected before inserting
+    def test_failure_releases_key(self):
+        headers = {**auth_header_admin, 'Idempotency-Key': 'taken-1'}
+        with count_queries() as statements:
+            first = self.client().post('/teams', json={'name': 'Heat'}, headers=headers)
+        second = self.client().post('/teams', json={'name': 'Heat'}, headers=headers)
+
+        self.assertEqual(first.status_code, 422)
+        self.assertFalse(any(statement.startswith('INSERT INTO teams') for statement in statements))
+        self.assertEqual(second.status_code, 422)
+        self.assertNotIn('Idempotent-Replayed', second.headers)
+
+    # Only one of many concurrent claims of a key wins, in both stores
+    def test_concurrent_claims(self):
+        for store in (MemoryStore(), DatabaseStore()):
+            results = []
+
+            def claim():
+                with self.app.app_context():
+                    results.append(store.claim('concurrent-' + type(store).__name__, 'f' * 64, 60))
+
+            threads = [threading.Thread(target=claim) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(results.count(None), 1, type(store).__name__)
+            self.assertTrue(all(entry is None or entry.status is None for entry in results))
+
+    # Stored responses expire after their TTL and are purged
+    def test_ttl_eviction(self):
+        clock = FakeClock()
+        for store in (MemoryStore(clock=clock), DatabaseStore(clock=clock)):
+            with self.app.app_context():
+                self.assertIsNone(store.claim('ttl-1', 'a' * 64, 60))
+                store.complete('ttl-1', 'a' * 64, 200, b'{}', 10)
+                self.assertEqual(store.claim('ttl-1', 'a' * 64, 60).body, b'{}')
+
+                clock.now += 11
+                self.assertEqual(store.purge(), 1)
+                self.assertIsNone(store.claim('ttl-1', 'a' * 64, 60))
+                clock.now += 61
+                self.assertIsNone(store.claim('ttl-1', 'a' * 64, 60))
+                store.release('ttl-1')
+            clock.now = 1000.0
+
+
+class ImportTestCase(SeededAppTestCase):
+
+    roster_csv = (
+        'name,position,height,team\n'
+        'Stephen Curry,Point Guard,"6\'2",Warriors\n'
+        'Klay Thompson,Shooting Guard,"6\'6",Warriors\n'
+        'Bam Adebayo,Center,"6\'9",Heat\n'
+        'No Position,,"6\'0",Heat\n'
+        'Kyrie Irving,Point Guard,"6\'2",\n'
+    )
+
+    # POST '/players/import' loads valid rows, creates new teams and reports rejected rows
+    def test_import_players_csv(self):
+        res = self.client().post('/players/import', data=self.roster_csv, content_type='text/csv',
+                                 headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['rows'], 5)
+        self.assertEqual(data['imported'], 4)
+        self.assertEqual(data['teams_created'], 1)
+        self.assertEqual(data['rejected_rows'][0]['line'], 5)
+        self.assertEqual(data['rejected_rows'][0]['error'], 'position is required')
+
+        warriors = Team.query.filter(Team.name == 'Warriors').one()
+        self.assertEqual(sorted(player.name for player in warriors.players), ['Klay Thompson', 'Stephen Curry'])
+
+    # POST '/players/import' accepts NDJSON and rejects unknown team ids
+    def test_import_players_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'name': 'Nikola Jokic', 'position': 'Center', 'height': "6'11", 'team_id': 2}),
+            json.dumps({'name': 'Ghost', 'position': 'Center', 'height': "7'0", 'team_id': 999}),
+            'not json',
+        ])
+        res = self.client().post('/players/import', data=body, content_type='application/x-ndjson',
+                                 headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual([row['error'] for row in data['rejected_rows']], ['team does not exist', 'invalid JSON'])
+
+    # Teams are only created for rows that pass validation
+    def test_import_rejected_row_creates_no_team(self):
+        res = self.client().post('/players/import', data='name,position,height,team\n,,,Ghost Team\n',
+                                 content_type='text/csv', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual((data['imported'], data['rejected'], data['teams_created']), (0, 1, 0))
+        self.assertEqual(data['rejected_rows'][0]['error'], 'name is required')
+        self.assertIsNone(Team.query.filter(Team.name == 'Ghost Team').one_or_none())
+
+    # Without post:teams the import rejects rows naming a new team instead of creating it
+    def test_import_without_post_teams_creates_no_team(self):
+        payload = {'sub': 'players-only', 'permissions': ['post:players']}
+        with mock.patch.object(token_cache, 'get', return_value=(payload, frozenset(payload['permissions']))):
+            res = self.client().post('/players/import', data='name,position,height,team\nA,Center,"7\'0",Brand New Team\n',
+                                     content_type='text/csv', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['imported'], data['rejected'], data['teams_created']), (0, 1, 0))
+        self.assertEqual(data['rejected_rows'][0]['error'], 'team does not exist')
+        self.assertIsNone(Team.query.filter(Team.name == 'Brand New Team').one_or_none())
+
+    # 'flask import-league' writes rejected rows to a separate file
+    def test_import_league_command(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'roster.csv')
+        with open(path, 'w') as f:
+            f.write('name,position,height,team_id\nAnthony Edwards,Shooting Guard,"6\'4",\nBad Team,Center,"7\'0",abc\n')
+
+        result = self.app.test_cli_runner().invoke(args=['import-league', path, '--chunk-size', '1'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 players imported', result.output)
+        with open(path + '.rejects.ndjson') as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual(rejects[0]['error'], 'team_id must be an integer')
+
+
+class LazyStartupTestCase(unittest.TestCase):
+
+    # Importing the app needs no environment variables
+    def test_import_needs_no_environment(self):
+        environ = {key: value for key, value in os.environ.items()
+                   if key not in ('DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE')}
+        result = subprocess.run([sys.executable, '-c', 'import app'], env=environ, capture_output=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    # create_app() opens no database connection, so it works before the database is reachable
+    def test_create_app_does_not_connect(self):
+        with mock.patch.dict(os.environ, {'DATABASE_URL': 'sqlite:////nonexistent/bball.db'}):
+            app = create_app()
+
+        res = app.test_client().get('/health')
+        self.assertEqual(res.status_code, 200)
+
+    # The slow-query log and replicas attach to the app's engines without a context pushed by the caller,
+    # as under gunicorn (a fresh process, since the test cases leave contexts pushed)
+    def test_create_app_with_slow_query_log_and_replicas(self):
+        environ = {**os.environ, 'DATABASE_URL': 'sqlite:////nonexistent/bball.db', 'SLOW_QUERY_MS': '10',
+                   'DATABASE_REPLICA_URLS': 'sqlite:////nonexistent/replica.db'}
+        result = subprocess.run([sys.executable, '-c', 'from app import create_app; create_app()'], env=environ,
+                                capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    # The fork handler is registered once per process; each app only adds its engines to the ones it disposes
+    def test_create_app_registers_no_fork_handler(self):
+        with mock.patch.dict(os.environ, {'DATABASE_URL': 'sqlite:////nonexistent/bball.db'}), \
+                mock.patch.object(os, 'register_at_fork') as register_at_fork:
+            app = create_app()
+
+        register_at_fork.assert_not_called()
+        with app.app_context():
+            self.assertIn(db.engine, models.fork_engines)
+
+    # 'flask migrate' creates the schema
+    def test_migrate_command(self):
+        database_path = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'migrate.db')
+        with mock.patch.dict(os.environ, {'DATABASE_URL': database_path}):
+            app = create_app()
+
+        with app.app_context():
+            result = app.test_cli_runner().invoke(args=['migrate'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        tables = inspect(create_engine(database_path)).get_table_names()
+        self.assertTrue({'teams', 'players', 'data_versions'} <= set(tables))
+
+
+class MetricsTestCase(SeededAppTestCase):
+
+    # GET '/metrics' reports per-endpoint latency, phase timings and statement counts
+    def test_metrics_endpoint(self):
+        self.client().get('/teams', headers=auth_header_admin)
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('bball_request_duration_seconds_count{endpoint="retrieve_teams",method="GET",status="200"}', text)
+        self.assertIn('bball_request_phase_seconds_count{endpoint="retrieve_teams",phase="auth"}', text)
+        self.assertIn('bball_request_queries_bucket{endpoint="retrieve_teams",le="+Inf"}', text)
+        self.assertIn('bball_token_cache_hit_rate', text)
+
+    # Responses carry a Server-Timing header when it is requested
+    def test_server_timing_header(self):
+        res = self.client().get('/players/1', headers={**auth_header_admin, 'X-Server-Timing': '1'})
+        timing = res.headers['Server-Timing']
+
+        self.assertIn('auth;dur=', timing)
+        self.assertIn('db;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertNotIn('Server-Timing', self.client().get('/players/1', headers=auth_header_admin).headers)
+
+    # A failing statement leaves no start time behind on its pooled connection, and checkouts are timed
+    def test_failed_statement_timing(self):
+        with self.app.app_context():
+            checkouts = sum(series[1] for series in POOL_CHECKOUT_WAIT.series.values())
+            with db.engine.connect() as conn:
+                with self.assertRaises(Exception):
+                    conn.exec_driver_sql('SELECT * FROM no_such_table')
+                conn.rollback()
+                conn.exec_driver_sql('SELECT 1')
+                info = dict(conn.info)
+
+        self.assertEqual([key for key in info if 'start' in key], [])
+        self.assertEqual(sum(series[1] for series in POOL_CHECKOUT_WAIT.series.values()), checkouts + 1)
+
+
+class PoolHealthTestCase(SeededAppTestCase):
+
+    # GET '/health' reports pool utilization from the pool counters, without checking out a connection
+    def test_pool_health(self):
+        checkouts = []
+
+        def on_checkout(*args):
+            checkouts.append(args)
+
+        with self.app.app_context():
+            event.listen(db.engine, 'checkout', on_checkout)
+            try:
+                res = self.client().get('/health')
+            finally:
+                event.remove(db.engine, 'checkout', on_checkout)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database']['pool'], 'InstrumentedQueuePool')
+        self.assertIn('utilization', data['database'])
+        self.assertEqual(data['database']['max_overflow'], self.app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow'])
+        self.assertEqual(checkouts, [])
+
+    # Pool settings come from the environment, and PgBouncer mode hands pooling to PgBouncer
+    def test_engine_options_from_env(self):
+        options = config.engine_options('postgresql://db/bball', {'GUNICORN_THREADS': '8', 'DB_MAX_OVERFLOW': '0'})
+        self.assertEqual(options['pool_size'], 8)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+
+        options = config.engine_options('postgresql://db/bball', {'DB_PGBOUNCER': 'true'})
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertEqual(config.engine_options('sqlite://', {}), {})
+
+
+class PaginationTestCase(SeededAppTestCase):
+
+    # Pages through GET '/players' with limit and after
+    def test_players_keyset_pagination(self):
+        res = self.client().get('/players?limit=2', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([player['id'] for player in data['players']], [1, 2])
+        self.assertEqual(data['next_cursor'], 2)
+
+        res = self.client().get('/players?limit=2&after=2', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual([player['id'] for player in data['players']], [3])
+        self.assertIsNone(data['next_cursor'])
+
+    # Pages through GET '/teams' with limit and after
+    def test_teams_keyset_pagination(self):
+        res = self.client().get('/teams?limit=1&after=1', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['teams'][0]['name'], 'Knicks')
+        self.assertEqual(data['next_cursor'], 2)
+
+    # Filters GET '/players' by team, position and free agency
+    def test_players_filters(self):
+        res = self.client().get('/players?team_id=1', headers=auth_header_admin)
+        self.assertEqual([player['name'] for player in json.loads(res.data)['players']], ['Lebron James'])
+
+        res = self.client().get('/players?position=Point%20Guard', headers=auth_header_admin)
+        self.assertEqual(len(json.loads(res.data)['players']), 2)
+
+        res = self.client().get('/players?free_agent=true', headers=auth_header_admin)
+        self.assertEqual([player['team'] for player in json.loads(res.data)['players']], ['Free Agent'])
+
+    # Malformed pagination parameters are rejected
+    def test_400_invalid_limit(self):
+        res = self.client().get('/players?limit=abc', headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # GET '/players' filters on parsed heights and pages through them in height order
+    def test_players_height_range_and_sort(self):
+        for name, height in (('Short Guard', "5'11"), ('Tall Center', '7-2'), ('Unknown Height', 'tall')):
+            player = Player(name=name, position='Guard', height=height, team_id=None)
+            player.insert()
+            self.addCleanup(player.delete)
+
+        names, cursor = [], None
+        while True:
+            path = '/players?min_height=72&max_height=86&sort=height&limit=2'
+            res = self.client().get(path + ('&after=' + cursor if cursor else ''), headers=auth_header_admin)
+            data = json.loads(res.data)
+            names += [player['name'] for player in data['players']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        expected = Player.query.filter(Player.height_inches.between(72, 86)) \
+            .order_by(Player.height_inches, Player.id)
+        self.assertEqual(names, [player.name for player in expected])
+        self.assertIn('Tall Center', names)
+        self.assertNotIn('Short Guard', names)
+        self.assertNotIn('Unknown Height', names)
+        self.assertEqual(self.client().get('/players?sort=weight', headers=auth_header_admin).status_code, 400)
+
+    def test_parse_height(self):
+        self.assertEqual([parse_height(h) for h in ("6'9", '6\'9"', '6-9', '6 ft 9 in', "7'")], [81, 81, 81, 81, 84])
+        self.assertEqual([parse_height(h) for h in ('tall', "6'13", '', None)], [None, None, None, None])
+
+    # height_inches follows height on updates, and 'flask migrate' backfills rows written without it
+    def test_height_inches_sync_and_backfill(self):
+        res = self.client().patch('/players/1', json={'height': "7'1"}, headers=auth_header_admin)
+        self.assertEqual(res.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Player, 1).height_inches, 85)
+
+        db.session.execute(update(Player).values(height_inches=None))
+        db.session.commit()
+        self.assertGreaterEqual(migrate_db(), 3)
+        self.assertEqual(db.session.get(Player, 2).height_inches, 74)
+
+
+class QueryCountTestCase(SeededAppTestCase):
+
+    # Measures the database path, so responses are not served from the response cache
+    @classmethod
+    def setUpClass(self):
+        super().setUpClass()
+        response_cache.backend = None
+
+    # Adds teams with a couple of players each
+    def add_teams(self, count):
+        for i in range(count):
+            team = Team(name='Query Count Team {}'.format(Team.query.count() + 1), players=[])
+            team.insert()
+            for j in range(2):
+                Player(name='Player {}'.format(j), position='Center', height="7'0", team_id=team.id).insert()
+
+    def assert_fixed_query_count(self, path):
+        self.client().get(path, headers=auth_header_admin)
+        with count_queries() as before:
+            self.client().get(path, headers=auth_header_admin)
+
+        self.add_teams(20)
+        with count_queries() as after:
+            res = self.client().get(path, headers=auth_header_admin)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(after), len(before))
+        return after
+
+    # GET '/teams' loads teams and rosters in two queries (plus the ETag version lookup) however many rows there are
+    def test_get_teams_query_count(self):
+        statements = self.assert_fixed_query_count('/teams')
+        self.assertLessEqual(len(statements), 3)
+
+    # GET '/players' loads players and their teams in one query (plus the ETag version lookup) however many rows there are
+    def test_get_players_query_count(self):
+        statements = self.assert_fixed_query_count('/players')
+        self.assertEqual(len(statements), 2)
+
+    # GET '/teams/<int:id>' loads the team and its roster in a single joined query (plus the ETag version lookup)
+    def test_get_team_by_id_query_count(self):
+        team = Team(name='Query Count Roster', players=[])
+        team.insert()
+        for i in range(10):
+            Player(name='Player {}'.format(i), position='Guard', height="6'3", team_id=team.id).insert()
+        team_id = team.id
+        db.session.expire_all()
+
+        with count_queries() as statements:
+            res = self.client().get('/teams/{}'.format(team_id), headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['players']), 10)
+        self.assertEqual(data['players'][0]['team'], 'Query Count Roster')
+        self.assertEqual(len(statements), 2)
+
+
+class RosterTestCase(SeededAppTestCase):
+
+    def add_team(self, name, *players):
+        team = Team(name=name, players=[])
+        team.insert()
+        ids = []
+        for player_name in players:
+            player = Player(name=player_name, position='Guard', height="6'3", team_id=team.id)
+            player.insert()
+            ids.append(player.id)
+        return team.id, ids
+
+    # DELETE '/teams/<id>' releases the whole roster with a single UPDATE
+    def test_delete_team_releases_roster_in_one_update(self):
+        team_id, player_ids = self.add_team('Deleted Team', *('Released {}'.format(i) for i in range(5)))
+
+        with count_queries() as statements:
+            res = self.client().delete('/teams/{}'.format(team_id), headers=auth_header_admin)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([s for s in statements if s.lstrip().upper().startswith('UPDATE PLAYERS')]), 1)
+        db.session.expire_all()
+        self.assertTrue(all(db.session.get(Player, player_id).team_id is None for player_id in player_ids))
+
+    # PUT '/teams/<id>/roster' assigns listed players, moving them from other teams, and releases the rest
+    def test_replace_roster(self):
+        team_id, (kept, dropped) = self.add_team('Roster Team', 'Kept Player', 'Dropped Player')
+        other_id, (moved,) = self.add_team('Other Roster Team', 'Moved Player')
+        free_agent = Player(name='Signed Player', position='Center', height="7'0", team_id=None)
+        free_agent.insert()
+        signed = free_agent.id
+
+        self.client().get('/teams/{}'.format(other_id), headers=auth_header_admin)
+        res = self.client().put('/teams/{}/roster'.format(team_id), json={'players': [kept, moved, signed]},
+                                headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['assigned'], data['released']), (2, 1))
+        self.assertEqual([player['id'] for player in data['players']], sorted([kept, moved, signed]))
+        other = json.loads(self.client().get('/teams/{}'.format(other_id), headers=auth_header_admin).data)
+        self.assertEqual(other['players'], [])
+        dropped_player = json.loads(self.client().get('/players/{}'.format(dropped), headers=auth_header_admin).data)
+        self.assertEqual(dropped_player['player']['team'], 'Free Agent')
+
+    # Unknown player ids are rejected without changing the roster
+    def test_replace_roster_unknown_player(self):
+        team_id, (player_id,) = self.add_team('Unchanged Roster Team', 'Only Player')
+
+        res = self.client().put('/teams/{}/roster'.format(team_id), json=[999999], headers=auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], [{'index': 0, 'message': 'player does not exist'}])
+        self.assertEqual(db.session.get(Player, player_id).team_id, team_id)
+
+    def test_403_replace_roster_analyst(self):
+        res = self.client().put('/teams/1/roster', json=[], headers=auth_header_analyst)
+        self.assertEqual(res.status_code, 403)
+
+    # Moving players needs patch:players too, not only patch:teams
+    def test_403_replace_roster_without_patch_players(self):
+        payload = {'sub': 'teams-only', 'permissions': ['patch:teams']}
+        with mock.patch.object(token_cache, 'get', return_value=(payload, frozenset(payload['permissions']))):
+            res = self.client().put('/teams/1/roster', json=[3], headers=auth_header_admin)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertIsNone(db.session.get(Player, 3).team_id)
+
+
+class ReplicaTestCase(unittest.TestCase):
+
+    # Sets up a testing app with a replica that has its own, different rows
+    @classmethod
+    def setUpClass(self):
+        self.database_name = 'bball_test'
+        self.database_path = 'postgresql://{}:{}@{}/{}'.format('postgres', 'abc', 'localhost:5432', self.database_name)
+        self.replica_path = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_REPLICA_URIS': [self.replica_path],
+        })
+        self.client = self.app.test_client
+        self.router = self.app.extensions['replica_router']
+
+        replica = self.router.engines[0]
+        db.metadata.create_all(replica)
+        with replica.begin() as conn:
+            conn.execute(Team.__table__.insert(), [{'name': 'Replica Team'}])
+
+    def team_names(self, client):
+        res = client.get('/teams', headers=auth_header_admin)
+        self.assertEqual(res.status_code, 200)
+        return [team['name'] for team in json.loads(res.data)['teams']]
+
+    # Slow reads on a replica are logged with its name, and GET '/health' reports the replica pools
+    def test_replica_slow_queries_and_health(self):
+        self.router.pins.clear()
+        with self.app.app_context():
+            slow_query_log = SlowQueryLog(database_engines(), threshold_ms=0)
+        try:
+            with self.assertLogs('bball.slow_query', level='WARNING') as logs:
+                self.client().get('/teams', headers=auth_header_admin)
+        finally:
+            slow_query_log.close()
+        health = json.loads(self.client().get('/health').data)
+
+        self.assertIn('replica_0', [json.loads(record.args[0])['database'] for record in logs.records])
+        self.assertEqual(len(health['replicas']), 1)
+        self.assertIn('pool', health['replicas'][0])
+
+    # GET requests read from the replica, and a client that just wrote reads from the primary
+    def test_reads_go_to_replica_until_a_write(self):
+        client = self.client()
+        self.assertEqual(self.team_names(client), ['Replica Team'])
+
+        res = client.post('/teams', json={'name': 'Primary Team', 'players': []}, headers=auth_header_admin)
+        self.assertEqual(res.status_code, 200)
+
+        self.assertIn('Primary Team', self.team_names(client))
+        self.assertIn('Primary Team', self.team_names(self.client()))
+        self.assertGreaterEqual(self.router.stats()['pinned_reads'], 2)
+
+    # A client without cookies stays on the primary in other workers by echoing the pin header back
+    def test_pin_header_without_cookies(self):
+        self.router.pins.clear()
+        client = self.app.test_client(use_cookies=False)
+        res = client.post('/teams', json={'name': 'Header Pin Team', 'players': []}, headers=auth_header_admin)
+        until = res.headers['X-Read-Primary-Until']
+        self.assertIn('X-Read-Primary-Until', res.headers['Access-Control-Expose-Headers'])
+
+        # As seen by another worker, which holds no pin for this client
+        self.router.pins.clear()
+        res = client.get('/teams', headers={**auth_header_admin, 'X-Read-Primary-Until': until})
+        self.assertIn('Header Pin Team', [team['name'] for team in json.loads(res.data)['teams']])
+        self.assertEqual(self.team_names(client), ['Replica Team'])
+
+    # Pages read from a replica that lags behind the primary are not cached
+    def test_lagging_replica_pages_are_not_cached(self):
+        self.router.pins.clear()
+        stores = response_cache.stores
+
+        self.assertEqual(self.team_names(self.client()), ['Replica Team'])
+        self.assertEqual(self.team_names(self.client()), ['Replica Team'])
+        self.assertEqual(response_cache.stores, stores)
+
+    # A failing replica leaves the rotation and returns once a probe succeeds
+    def test_replica_health_checks(self):
+        clock = FakeClock()
+        broken = create_engine('sqlite:////nonexistent/replica.db')
+        router = ReplicaRouter([broken], retry_interval=30, clock=clock)
+
+        self.assertIs(router.pick(), broken)
+        with self.assertRaises(Exception):
+            broken.connect()
+        self.assertIsNone(router.pick())
+        self.assertEqual(router.stats()['healthy'], 0)
+
+        clock.now += 31
+        self.assertIsNone(router.pick())
+        self.assertEqual(router.stats()['failures'], 2)
+
+        healthy = self.router.engines[0]
+        router = ReplicaRouter([healthy], retry_interval=30, clock=clock)
+        router.down[healthy] = clock.now - 1
+        self.assertIs(router.pick(), healthy)
+        self.assertEqual(router.stats()['healthy'], 1)
+
+
+class ResponseCacheTestCase(SeededAppTestCase):
+
+    # A repeated GET is served from the cache without loading any rows
+    def test_repeat_get_served_from_cache(self):
+        first = self.client().get('/teams', headers=auth_header_admin)
+        with count_queries() as statements:
+            second = self.client().get('/teams', headers=auth_header_admin)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(statements), 1)
+
+    # Renaming a team invalidates the cached player entries that show its name
+    def test_team_rename_invalidates_players(self):
+        self.client().get('/players', headers=auth_header_admin)
+        self.client().get('/players/2', headers=auth_header_admin)
+
+        self.client().patch('/teams/2', json={'name': 'New York Knicks'}, headers=auth_header_admin)
+        players = json.loads(self.client().get('/players', headers=auth_header_admin).data)['players']
+        player = json.loads(self.client().get('/players/2', headers=auth_header_admin).data)['player']
+
+        self.assertEqual(players[1]['team'], 'New York Knicks')
+        self.assertEqual(player['team'], 'New York Knicks')
+
+    # Moving a player invalidates the roster of both teams and the free agent list
+    def test_player_move_invalidates_both_teams(self):
+        self.client().get('/teams/1', headers=auth_header_admin)
+        self.client().get('/players?free_agent=true', headers=auth_header_admin)
+
+        self.client().patch('/players/3', json={'team_id': 1}, headers=auth_header_admin)
+        team = json.loads(self.client().get('/teams/1', headers=auth_header_admin).data)
+        free_agents = json.loads(self.client().get('/players?free_agent=true', headers=auth_header_admin).data)
+
+        self.assertIn('Luka Doncic', [player['name'] for player in team['players']])
+        self.assertNotIn('Luka Doncic', [player['name'] for player in free_agents['players']])
+
+    # Cached responses still require authorization
+    def test_401_cached_response_without_authorization(self):
+        self.client().get('/teams/3', headers=auth_header_admin)
+        res = self.client().get('/teams/3')
+
+        self.assertEqual(res.status_code, 401)
+
+    # The shared backend invalidates the same way as the in-process one
+    def test_shared_backend(self):
+        backend = response_cache.backend
+        response_cache.backend = RedisBackend(LocalRedis())
+        try:
+            self.client().get('/players/1', headers=auth_header_admin)
+            self.client().patch('/players/1', json={'name': 'LeBron James'}, headers=auth_header_admin)
+            res = self.client().get('/players/1', headers=auth_header_admin)
+
+            self.assertEqual(json.loads(res.data)['player']['name'], 'LeBron James')
+            self.assertGreater(response_cache.stats()['invalidations'], 0)
+        finally:
+            response_cache.backend = backend
+
+    # A write whose invalidation never reaches this worker (another worker's) still isn't served stale,
+    # because the cache key carries the data versions
+    def test_write_in_other_worker(self):
+        self.client().get('/teams/3', headers=auth_header_admin)
+        with self.app.app_context():
+            db.session.execute(update(Team).where(Team.id == 3).values(name='Brooklyn Nets'))
+            bump_versions('teams')
+            db.session.commit()
+        res = self.client().get('/teams/3', headers=auth_header_admin)
+
+        self.assertEqual(json.loads(res.data)['name'], 'Brooklyn Nets')
+
+    # An invalidation between the shared backend's epoch check and its write makes the write fail
+    def test_shared_backend_set_is_atomic(self):
+        client = LocalRedis()
+        backend = RedisBackend(client)
+        pipeline = client.pipeline
+
+        def racing_pipeline():
+            pipe = pipeline()
+            multi = pipe.multi
+
+            def invalidate_then_multi():
+                backend.invalidate({'team:1'})
+                multi()
+            pipe.multi = invalidate_then_multi
+            return pipe
+
+        with mock.patch.object(client, 'pipeline', racing_pipeline):
+            self.assertFalse(backend.set('/teams/1', b'{}', frozenset({'team:1'}), 0))
+        self.assertIsNone(backend.get('/teams/1'))
+        self.assertTrue(backend.set('/teams/1', b'{}', frozenset({'team:1'}), 1))
+        self.assertEqual(backend.get('/teams/1'), b'{}')
+
+
+class SerializerTestCase(SeededAppTestCase):
+
+    # The column-based list reads return exactly the bytes the ORM serializers produce
+    def test_list_reads_match_orm_serializers(self):
+        with self.app.app_context():
+            team = Team(name='Serializer Team', players=[])
+            team.insert()
+            for name in ('Zach Edey', 'Nikola Jokić', 'Amen Thompson'):
+                Player(name=name, position='Center', height="7'0", team_id=team.id).insert()
+            ascii_team = Team(name='Ascii Team', players=[])
+            ascii_team.insert()
+            Player(name='Jalen Green', position='Guard', height="6'4", team_id=ascii_team.id).insert()
+            team_id, ascii_team_id = team.id, ascii_team.id
+
+        cases = [
+            ('/teams?limit=1000', lambda: {
+                'success': True,
+                'teams': [t.format() for t in Team.query.order_by(Team.id)],
+                'next_cursor': None,
+            }),
+            ('/players?limit=1000', lambda: {
+                'success': True,
+                'players': [p.short() for p in Player.query.order_by(Player.id)],
+                'next_cursor': None,
+            }),
+            ('/players?team_id={}'.format(ascii_team_id), lambda: {
+                'success': True,
+                'players': [p.short() for p in Player.query.filter_by(team_id=ascii_team_id).order_by(Player.id)],
+                'next_cursor': None,
+            }),
+            ('/teams/{}'.format(team_id), lambda: {
+                'success': True,
+                'name': 'Serializer Team',
+                'players': [p.long() for p in Player.query.filter_by(team_id=team_id).order_by(Player.id)],
+            }),
+        ]
+        for path, expected in cases:
+            res = self.client().get(path, headers=auth_header_admin)
+            with self.app.test_request_context():
+                self.assertEqual(res.data, jsonify(expected()).get_data(), path)
+
+    # json_response() encodes with orjson (a requirement) and falls back to jsonify() without it, with the same bytes
+    def test_json_response_with_and_without_orjson(self):
+        payload = {'success': True, 'teams': [{'id': 1, 'name': 'Heat', 'players': ['Jimmy Butler']}], 'next': None}
+        with self.app.test_request_context():
+            expected = jsonify(payload).get_data()
+            self.assertIsNotNone(serializers.orjson)
+            with mock.patch.object(serializers, 'jsonify', wraps=jsonify) as fallback:
+                fast = serializers.json_response(payload)
+                self.assertFalse(fallback.called)
+                with mock.patch.object(serializers, 'orjson', None):
+                    slow = serializers.json_response(payload)
+                self.assertTrue(fallback.called)
+
+        self.assertEqual(fast.get_data(), expected)
+        self.assertEqual(slow.get_data(), expected)
+        self.assertEqual(fast.mimetype, slow.mimetype)
+
+
+class StatsTestCase(SeededAppTestCase):
+
+    # GET '/stats' aggregates the league and is refreshed after writes
+    def test_stats(self):
+        res = self.client().get('/stats', headers=auth_header_analyst)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['players'], data['teams'], data['free_agents']), (3, 3, 1))
+        self.assertEqual([team['players'] for team in data['roster_sizes']], [1, 1, 0])
+        guards = data['positions']['Point Guard']
+        self.assertEqual(guards['players'], 2)
+        self.assertEqual((guards['height_inches']['p10'], guards['height_inches']['p50']), (74.5, 76.5))
+
+        self.client().patch('/players/2', json={'height': "6'0"}, headers=auth_header_admin)
+        data = json.loads(self.client().get('/stats', headers=auth_header_analyst).data)
+        self.assertEqual(data['positions']['Point Guard']['height_inches']['p50'], 75.5)
+
+    # Percentiles from the height histogram match linear interpolation over every height
+    def test_height_summary_matches_raw_percentiles(self):
+        heights = sorted((70 + (i * 7919) % 20) for i in range(999))
+        histogram = [(inches, heights.count(inches)) for inches in sorted(set(heights))]
+        summary = height_summary(histogram)
+
+        for percentile in PERCENTILES:
+            rank = percentile / 100 * (len(heights) - 1)
+            lower = int(rank)
+            upper = min(lower + 1, len(heights) - 1)
+            expected = heights[lower] + (heights[upper] - heights[lower]) * (rank - lower)
+            self.assertAlmostEqual(summary['p{}'.format(percentile)], round(expected, 2))
+        self.assertEqual((summary['min'], summary['max'], summary['count']), (70, 89, 999))
+
+
+class SlowQueryLogTestCase(SeededAppTestCase):
+
+    def setUp(self):
+        self.slow_query_log = SlowQueryLog({'primary': db.engine}, threshold_ms=0, explain_sample=1.0)
+
+    def tearDown(self):
+        self.slow_query_log.close()
+
+    # Statements over the threshold are logged with their endpoint, and their plan is captured
+    def test_slow_query_logged_with_plan(self):
+        with self.assertLogs('bball.slow_query', level='WARNING') as logs:
+            self.client().get('/players?team_id=1', headers=auth_header_admin)
+            self.slow_query_log.flush()
+
+        entries = [json.loads(record.args[0]) for record in logs.records if record.msg == 'slow query %s']
+        plans = [json.loads(record.args[0]) for record in logs.records if record.msg == 'slow query plan %s']
+
+        self.assertIn('retrieve_players', [entry['endpoint'] for entry in entries])
+        self.assertTrue(any('FROM players' in entry['statement'] for entry in entries))
+        self.assertGreater(len(plans), 0)
+        self.assertIn('plan', plans[0])
+
+    # Nothing is logged under the threshold
+    def test_fast_queries_not_logged(self):
+        self.slow_query_log.close()
+        self.slow_query_log = SlowQueryLog({'primary': db.engine}, threshold_ms=60000)
+
+        self.client().get('/teams/2', headers=auth_header_admin)
+
+        self.assertEqual(self.slow_query_log.stats()['logged'], 0)
+
+    # A statement that raises leaves no start time on the connection for the next one to pick up
+    def test_failed_statement_not_leaked(self):
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                with self.assertRaises(Exception):
+                    conn.exec_driver_sql('SELECT * FROM no_such_table')
+                conn.rollback()
+                with self.assertLogs('bball.slow_query', level='WARNING') as logs:
+                    conn.exec_driver_sql('SELECT 1')
+                    self.slow_query_log.flush()
+                info = dict(conn.info)
+
+        self.assertNotIn('slow_query_start', info)
+        self.assertEqual(json.loads(logs.records[0].args[0])['statement'], 'SELECT 1')
+
+
+# A clock the key store tests can move forward by hand.
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def jwks_document(*kids):
+    return {'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'abc', 'e': 'AQAB'} for kid in kids]}
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_keys('key1')
+        self.clock = FakeClock()
+        self.store = JWKSKeyStore('file://' + self.jwks_file.name, default_ttl=600, min_refetch_interval=30,
+                                  background=False, clock=self.clock)
+
+    def tearDown(self):
+        os.unlink(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump(jwks_document(*kids), f)
+
+    # Known keys are served from memory until the TTL runs out
+    def test_keys_cached_until_ttl(self):
+        self.assertEqual(self.store.get_key('key1')['kid'], 'key1')
+        self.assertEqual(self.store.get_key('key1')['kid'], 'key1')
+        self.assertEqual(self.store.fetches, 1)
+        self.assertEqual(self.store.stats()['hits'], 2)
+
+        self.clock.now += 601
+        self.store.get_key('key1')
+        self.assertEqual(self.store.fetches, 2)
+
+    # An unknown kid triggers one refetch, then further refetches are rate limited
+    def test_unknown_kid_refetch_rate_limited(self):
+        self.store.get_key('key1')
+        self.write_keys('key1', 'key2')
+
+        self.assertIsNone(self.store.get_key('key3'))
+        self.assertEqual(self.store.fetches, 1)
+
+        self.clock.now += 31
+        self.assertEqual(self.store.get_key('key2')['kid'], 'key2')
+        self.assertEqual(self.store.fetches, 2)
+        self.assertIsNone(self.store.get_key('key3'))
+        self.assertEqual(self.store.fetches, 2)
+        self.assertEqual(self.store.stats()['misses'], 3)
+        self.assertEqual(self.store.generation, 2)
+
+    # Stale keys keep being served when the provider is unreachable
+    def test_stale_keys_served_on_fetch_error(self):
+        self.store.get_key('key1')
+        os.unlink(self.jwks_file.name)
+        self.clock.now += 601
+
+        self.assertEqual(self.store.get_key('key1')['kid'], 'key1')
+        self.assertEqual(self.store.fetch_errors, 1)
+        self.write_keys('key1')
+
+    # Cache-Control max-age from a stub HTTP server sets the TTL
+    def test_cache_control_max_age(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(jwks_document('key1')).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'public, max-age=120')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            store = JWKSKeyStore('http://127.0.0.1:{}/.well-known/jwks.json'.format(server.server_port),
+                                 background=False, clock=self.clock)
+            self.assertEqual(store.get_key('key1')['kid'], 'key1')
+            self.assertEqual(store.expires_at, self.clock.now + 120)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.generation = 1
+        self.cache = TokenCache(maxsize=2, key_generation=lambda: self.generation, clock=self.clock)
+        self.payload = {'sub': 'user', 'exp': self.clock.now + 60, 'permissions': ['get:teams', 'get:players']}
+
+    # A cached token returns its claims and a frozenset of permissions
+    def test_hit_returns_permissions(self):
+        self.assertIsNone(self.cache.get('token1'))
+        self.cache.put('token1', self.payload)
+        payload, granted = self.cache.get('token1')
+
+        self.assertEqual(payload['sub'], 'user')
+        self.assertEqual(granted, frozenset(['get:teams', 'get:players']))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Entries expire at the token's exp claim
+    def test_entry_expires_at_exp(self):
+        self.cache.put('token1', self.payload)
+        self.clock.now += 61
+
+        self.assertIsNone(self.cache.get('token1'))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    # The least recently used token is evicted when the cache is full
+    def test_lru_eviction(self):
+        self.cache.put('token1', self.payload)
+        self.cache.put('token2', self.payload)
+        self.cache.get('token1')
+        self.cache.put('token3', self.payload)
+
+        self.assertIsNone(self.cache.get('token2'))
+        self.assertIsNotNone(self.cache.get('token1'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    # Rotating the signing keys empties the cache
+    def test_key_rotation_evicts(self):
+        self.cache.put('token1', self.payload)
+        self.generation = 2
+
+        self.assertIsNone(self.cache.get('token1'))
+        self.assertEqual(self.cache.stats()['rotations'], 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
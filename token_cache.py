@@ -0,0 +1,94 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Bounded LRU of already verified bearer tokens, keyed by a SHA-256 of the token so raw tokens are never kept.
+# Each entry holds the decoded claims and a frozenset of the granted permissions, and expires at the token's
+# 'exp' (or after max_ttl for tokens without one). When key_generation() changes, meaning the JWKS signing keys
+# rotated, every entry is dropped so tokens get verified again against the new keys.
+class TokenCache:
+    def __init__(self, maxsize=1024, max_ttl=3600, key_generation=None, clock=time.time):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.key_generation = key_generation or (lambda: 0)
+        self.clock = clock
+
+        self.entries = OrderedDict()
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rotations = 0
+
+        self._lock = threading.Lock()
+
+    # Returns (payload, permissions) for a cached token, or None if it has to be verified.
+    def get(self, token):
+        digest = self._digest(token)
+        with self._lock:
+            self._check_rotation()
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, permissions, expires_at = entry
+            if self.clock() >= expires_at:
+                del self.entries[digest]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return payload, permissions
+
+    # Stores a verified payload and returns the same (payload, permissions) pair get() would.
+    def put(self, token, payload):
+        permissions = frozenset(payload.get('permissions') or ())
+        expires_at = self.clock() + self.max_ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        digest = self._digest(token)
+        with self._lock:
+            self._check_rotation()
+            self.entries[digest] = (payload, permissions, expires_at)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'rotations': self.rotations,
+        }
+
+    def _check_rotation(self):
+        generation = self.key_generation()
+        if generation != self.generation:
+            if self.generation is not None and self.entries:
+                self.rotations += 1
+                self.evictions += len(self.entries)
+            self.entries.clear()
+            self.generation = generation
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()